@@ -9,9 +9,53 @@ log = logging.getLogger(__name__)
 
 none_found = object()
 
+# A crit-bit (PATRICIA) trie: every internal node splits its entries on the
+# highest bit they don't all share, so there are exactly len - 1 of them, and
+# removing an entry removes its parent node with it. Keys are stored as ints
+# (big endian), so all keys in a trie must have the same length.
+
+class TrieNode(object):
+    __slots__ = ("mask", "zero", "one")
+
+    def __init__(self, mask, zero, one):
+        self.mask = mask # The crit bit, an int from _masks.
+        self.zero = zero
+        self.one = one
+
+class TrieLeaf(object):
+    __slots__ = ("key", "value")
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+# Shared (1 << n) ints, as testing a bit with a mask is about twice as fast as
+# shifting a wide key and the nodes then don't each hold a copy.
+_masks = []
+
+def _mask(bit):
+    while len(_masks) <= bit:
+        _masks.append(1 << len(_masks))
+
+    return _masks[bit]
+
+def _key_int(key):
+    t = type(key)
+    if t is int:
+        return key
+    if t is XorKey:
+        return key.asint()
+    if t is ZeroKey:
+        return 0
+    return int.from_bytes(key, "big")
+
 class BitTrie(object):
     def __init__(self):
-        self.trie = [None] * 0x10
+        self.root = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
 
     def get(self, key, default=None):
         r = self._get(key)
@@ -32,9 +76,7 @@ class BitTrie(object):
         buf = "["
         first = True
 
-        for x in self.find(ZeroKey()):
-            if not x:
-                continue
+        for x in self:
             if not first:
                 buf += ", "
             else:
@@ -46,10 +88,17 @@ class BitTrie(object):
         return buf
 
     def __iter__(self):
-        for item in self.find(ZeroKey()):
-            if item is none_found:
+        stack = [self.root] if self.root else []
+
+        while stack:
+            node = stack.pop()
+
+            if type(node) is TrieLeaf:
+                yield node.value
                 continue
-            yield item
+
+            stack.append(node.one)
+            stack.append(node.zero)
 
     def __delitem__(self, key):
         self._del(key)
@@ -73,202 +122,201 @@ class BitTrie(object):
             return default
         return r
 
-    def put(self, key, value, replace=True):
-        node = self.trie
-
-        keylen = len(key)
-        for i in range(keylen):
-            char = key[i]
-            for j in range(4, -1, -4):
-                bit = (char >> j) & 0x0F
-                next_node = node[bit]
+    def _best_leaf(self, key):
+        "Returns the leaf reached by following the bits of key; the only one"\
+        " that can match it, and the one sharing the most leading bits with"\
+        " it. The root must not be None."
 
-                if not next_node:
-                    node[bit] = TrieLeaf(key, value)
-                    return None
+        node = self.root
+        while type(node) is TrieNode:
+            node = node.one if key & node.mask else node.zero
 
-                if type(next_node) is TrieLeaf:
-                    other = next_node
+        return node
 
-                    o_key = other.key
-                    if j == 0:
-                        ii = i + 1
-                        if ii == keylen:
-                            if replace:
-                                node[bit] = TrieLeaf(key, value)
-                            return other.value
+    def put(self, key, value, replace=True):
+        "Returns the previous value of key, or None if there was none."
 
-                        next_o_bit = (o_key[ii] >> 4) & 0x0F
-                    else:
-                        next_o_bit = (o_key[i] >> (j-4)) & 0x0F
+        key = _key_int(key)
 
-                    next_node = [None] * 0x10
-                    next_node[next_o_bit] = other
+        if self.root is None:
+            self.root = TrieLeaf(key, value)
+            self.count = 1
+            return None
 
-                    node[bit] = next_node
-                    node = next_node
-                    continue
+        leaf = self._best_leaf(key)
+        diff = key ^ leaf.key
 
-                assert type(next_node) is list, type(next_node)
-                node = next_node
+        if not diff:
+            other = leaf.value
+            if replace:
+                leaf.value = value
+            return other
 
-    def _del(self, key):
-        #FIXME: Make this code prune empty trees more than one deep.
-        prev_node = None
-        prev_node_bit = None
-        node = self.trie
+        mask = _mask(diff.bit_length() - 1)
 
-        for i in range(len(key)):
-            char = key[i]
-            for j in range(4, -1, -4):
-                bit = (char >> j) & 0x0F
-                next_node = node[bit]
+        # Insert the split above the first node that splits on a lower bit.
+        parent = None
+        node = self.root
+        while type(node) is TrieNode and node.mask > mask:
+            parent = node
+            node = node.one if key & node.mask else node.zero
 
-                if not next_node:
-                    return None
+        new_leaf = TrieLeaf(key, value)
+        if key & mask:
+            split = TrieNode(mask, node, new_leaf)
+        else:
+            split = TrieNode(mask, new_leaf, node)
 
-                if type(next_node) is TrieLeaf:
-                    node[bit] = None
+        if parent is None:
+            self.root = split
+        elif parent.one is node:
+            parent.one = split
+        else:
+            parent.zero = split
 
-                    empty = True
-                    for n in node:
-                        if n:
-                            empty = False
-                            break;
+        self.count += 1
 
-                    if empty and prev_node:
-                        prev_node[prev_node_bit] = None
+        return None
 
-                    return next_node.value
+    def _del(self, key):
+        if self.root is None:
+            return None
+
+        key = _key_int(key)
+
+        grandparent = None
+        parent = None
+        node = self.root
+        while type(node) is TrieNode:
+            grandparent = parent
+            parent = node
+            node = node.one if key & node.mask else node.zero
+
+        if node.key != key:
+            return None
+
+        # Replace the parent with the sibling of the removed leaf.
+        if parent is None:
+            self.root = None
+        else:
+            sibling = parent.zero if parent.one is node else parent.one
+
+            if grandparent is None:
+                self.root = sibling
+            elif grandparent.one is parent:
+                grandparent.one = sibling
+            else:
+                grandparent.zero = sibling
 
-                assert type(next_node) is list, type(next_node)
+        self.count -= 1
 
-                prev_node = node
-                prev_node_bit = bit
-                node = next_node
+        return node.value
 
     def _get(self, key):
-        node = self.trie
-
-        for i in range(len(key)):
-            char = key[i]
-            for j in range(4, -1, -4):
-                bit = (char >> j) & 0x0F
-                next_node = node[bit]
+        if self.root is None:
+            return None
 
-                if not next_node:
-                    return None
+        key = _key_int(key)
 
-                if type(next_node) is TrieLeaf:
-                    if next_node.key == key:
-                        return next_node.value
-                    else:
-                        return None
+        leaf = self._best_leaf(key)
+        if leaf.key == key:
+            return leaf.value
 
-                assert type(next_node) is list, type(next_node)
-
-                node = next_node
+        return None
 
     def find(self, key, forward=True):
-        "Generator. First element can be None sometimes when no exact match."
-        branches = []
-        node = self.trie
-
-        key_len = len(key)
-        i = 0
-        while i < key_len:
-            char = key[i]
-            j = 4
-            while j >= 0:
-                bit = (char >> j) & 0x0F
-
-                rng = range(0x0F, bit, -1) if forward else range(0, bit)
-
-                for obit in rng:
-                    other = node[obit]
-                    if other:
-                        branches.append(other)
-
-                next_node = node[bit]
-
-                if not next_node:
-                    yield none_found
-
-                    func = self._iterate_next(branches) if forward\
-                        else self._iterate_prev(branches)
-
-                    for r in func:
-                        yield r
-                    return None
-
-                if type(next_node) is TrieLeaf:
-                    nnk = next_node.key
-                    kl = min(len(nnk), key_len)
-                    while True:
-                        if nnk[i] != key[i]:
-                            greater = nnk[i] > key[i]
-
-                            yield none_found
+        "Generator. Yields the value of key if present, then the values of all"\
+        " greater (forward) or lesser keys, in order. If key is not present"\
+        " then none_found is yielded first instead."
 
-                            if greater ^ (not forward):
-                                yield next_node.value
+        if self.root is None:
+            yield none_found
+            return
 
-                            break
+        key = _key_int(key)
 
-                        i = i + 1
-                        if i == kl:
-                            yield next_node.value
-                            break
+        diff = key ^ self._best_leaf(key).key
+        # The highest bit of diff is the crit bit.
+        mask = _mask(diff.bit_length() - 1) if diff else 0
 
-                    func = self._iterate_next(branches) if forward\
-                        else self._iterate_prev(branches)
-
-                    for r in func:
-                        yield r
-
-                    return None
-
-                assert type(next_node) is list, type(next_node)
-
-                node = next_node
-                j = j - 4
+        # Collect the subtrees hanging off the path of key that are wholly on
+        # the requested side of it, the nearest to key ending up on top.
+        branches = []
+        node = self.root
+        while type(node) is TrieNode and node.mask > mask:
+            if key & node.mask:
+                if not forward:
+                    branches.append(node.zero)
+                node = node.one
+            else:
+                if forward:
+                    branches.append(node.one)
+                node = node.zero
 
-            i = i + 1
+        if not diff:
+            yield node.value
+        else:
+            yield none_found
 
-    def _iterate_next(self, branches):
-        while True:
-            if not branches:
-                return None
+            # Below the crit bit, node's keys are all greater or all lesser.
+            greater = not key & mask
+            if greater == forward:
+                branches.append(node)
 
+        while branches:
             node = branches.pop()
 
             if type(node) is TrieLeaf:
                 yield node.value
                 continue
 
-            assert type(node) is list, type(node)
+            if forward:
+                branches.append(node.one)
+                branches.append(node.zero)
+            else:
+                branches.append(node.zero)
+                branches.append(node.one)
 
-            branches.extend(reversed([x for x in node if x]))
+    def iterate_nearest(self, key):
+        "Generator. Yields all values ordered by the XOR distance of their key"\
+        " to key, the closest first."
 
-    def _iterate_prev(self, branches):
-        while True:
-            if not branches:
-                return None
+        if self.root is None:
+            return
 
-            node = branches.pop()
+        key = _key_int(key)
+
+        # All keys below a node share the bits above its crit bit, so every
+        # key on the side matching key is closer than any on the other side.
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
 
             if type(node) is TrieLeaf:
                 yield node.value
                 continue
 
-            assert type(node) is list, type(node)
+            if key & node.mask:
+                stack.append(node.zero)
+                stack.append(node.one)
+            else:
+                stack.append(node.one)
+                stack.append(node.zero)
 
-            branches.extend([x for x in node if x])
+    def nearest(self, key, k):
+        "Returns a list of the (upto) k values whose keys are the closest to"\
+        " key by XOR distance, the closest first."
 
-class TrieLeaf(object):
-    def __init__(self, key, value):
-        self.key = key
-        self.value = value
+        r = []
+        if k <= 0:
+            return r
+
+        for value in self.iterate_nearest(key):
+            r.append(value)
+            if len(r) == k:
+                break
+
+        return r
 
 class XorKey(object):
     def __init__(self, key1, key2):
@@ -281,6 +329,10 @@ class XorKey(object):
     def __len__(self):
         return len(self.key1)
 
+    def asint(self):
+        return int.from_bytes(self.key1, "big")\
+            ^ int.from_bytes(self.key2, "big")
+
 max_len_value = 0xFFFFFFFF
 
 class __TestLenObj(object):
@@ -338,13 +390,29 @@ def _del_test():
 
     print(bt)
 
-def _speed_test():
+    # Deleting everything must leave nothing behind.
     bt = BitTrie()
+    keys = [os.urandom(8) for i in range(1000)]
+    for k in keys:
+        bt[k] = k
+    for k in keys:
+        bt.pop(k, None)
+    for k in list(bt):
+        del bt[k]
+
+    assert bt.root is None and not len(bt), len(bt)
+
+    print("prune: OK")
+
+def _speed_test(trie_class=None, cnt=500000):
+    bt = trie_class() if trie_class else BitTrie()
 #    bt = {}
 
     rval = os.urandom(512>>3)
 
-    for i in range(500000):
+    start = datetime.today()
+
+    for i in range(cnt):
         val = os.urandom(512>>3)
 
         xval = [rvalc ^ valc for rvalc, valc in zip(rval, val)]
@@ -355,9 +423,11 @@ def _speed_test():
         now = datetime.today()
         #r = bt.put(k, xiv)
         r = bt[k] = xiv
-        if not i % 5000:
+        if not i % 50000:
             print("put took: {}".format(datetime.today() - now))
 
+    print("{} puts took: {}".format(cnt, datetime.today() - start))
+
     n = XorKey(os.urandom(512>>3), os.urandom(512>>3))
     bt[n] = int.from_bytes(n, "big")
 
@@ -377,54 +447,96 @@ def _speed_test():
     now = datetime.today()
 
     for i in bt.find(int(100).to_bytes(512>>3, "big")):
-        print("find: {}".format(i))
-        print("took: {}".format(datetime.today() - now))
         cnt -= 1
         if not cnt:
             break
+
+    print("find of 42 took: {}".format(datetime.today() - now))
+
+    if hasattr(bt, "nearest"):
         now = datetime.today()
+        r = bt.nearest(os.urandom(512>>3), 20)
+        print("nearest of 20 took: {}".format(datetime.today() - now))
 
-def _validity_test():
-    bt = BitTrie()
+    return bt
+
+def _validity_test(trie_class=None, cnt=10):
+    bt = trie_class() if trie_class else BitTrie()
     #bt = {}
 
-    for i in range(10):
+    d = {}
+
+    for i in range(cnt):
         ri = random.randint(0, 100)
         k = ri.to_bytes(1, "big")
 
         now = datetime.today()
         r = bt[k] = ri
+        d[k] = ri
         print("put took: {}".format(datetime.today() - now))
 
-    now = datetime.today()
-    print("get: {}".format(bt.get(int(0).to_bytes(1, "big"))))
-    print("took: {}".format(datetime.today() - now))
-    now = datetime.today()
-    print("get: {}".format(bt.get(int(42).to_bytes(1, "big"))))
-    print("took: {}".format(datetime.today() - now))
-    now = datetime.today()
-    print("get: {}".format(bt.get(int(88).to_bytes(1, "big"))))
-    print("took: {}".format(datetime.today() - now))
+    for k in (0, 42, 88):
+        now = datetime.today()
+        r = bt.get(k.to_bytes(1, "big"))
+        print("get: {}".format(r))
+        print("took: {}".format(datetime.today() - now))
+        # Like the legacy trie, falsy values read as missing.
+        assert r == (d.get(k.to_bytes(1, "big")) or None), r
 
-    cnt = 42
-    now = datetime.today()
-    for i in bt.find(int(42).to_bytes(1, "big")):
+    def check(key, forward):
+        r = list(bt.find(key, forward))
+
+        if key in d:
+            assert r[0] == d[key], (r, key)
+        else:
+            assert r[0] is none_found, (r, key)
+        r = r[1:]
+
+        if forward:
+            expected = [d[x] for x in sorted(d) if x > key]
+        else:
+            expected = [d[x] for x in sorted(d, reverse=True) if x < key]
+
+        assert r == expected, (key, forward, r, expected)
+
+        return r
+
+    for i in check(int(42).to_bytes(1, "big"), True):
         print("find: {}".format(i))
-#        print("took: {}".format(datetime.today() - now))
-        cnt -= 1
-        if not cnt:
-            break
-        now = datetime.today()
 
     print("<>")
 
-    for i in bt.find(int(42).to_bytes(1, "big"), False):
+    for i in check(int(42).to_bytes(1, "big"), False):
         print("find: {}".format(i))
-#        print("took: {}".format(datetime.today() - now))
-        cnt -= 1
-        if not cnt:
-            break
-        now = datetime.today()
+
+    for ri in range(256):
+        check(ri.to_bytes(1, "big"), True)
+        check(ri.to_bytes(1, "big"), False)
+
+    # Wider keys, checked against a dict.
+    d.clear()
+    bt = trie_class() if trie_class else BitTrie()
+
+    for i in range(2000):
+        k = os.urandom(4)
+        bt[k] = d[k] = i + 1
+    for k in random.sample(list(d), 1000):
+        assert bt.pop(k) == d.pop(k)
+
+    for k in random.sample(list(d), 100) + [os.urandom(4) for i in range(100)]:
+        check(k, True)
+        check(k, False)
+
+        if hasattr(bt, "nearest"):
+            ki = int.from_bytes(k, "big")
+            expected = sorted(d, key=lambda x: int.from_bytes(x, "big") ^ ki)
+            r = bt.nearest(k, 20)
+            assert r == [d[x] for x in expected[:20]], (r, expected[:20])
+
+    assert list(bt) == [d[x] for x in sorted(d)]
+    assert len(bt) == len(d)
+
+    print("validity: OK")
 
 def main():
     _del_test()
@@ -0,0 +1,413 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+# Benchmark of bittrie.BitTrie against a copy of the previous nibble trie it
+# replaced. Both are filled with random node ids keyed by their XorKey to our
+# own id, as ChordEngine.peer_trie is, and then timed for gets, finds and pops;
+# their memory use is measured when full and once popped empty again. The k closest to a random target are found with nearest()
+# on a trie keyed by node id, and with the legacy trie the only way it could
+# be done: building a trie keyed by XorKey to the target and iterating it.
+
+import llog
+
+import argparse
+import logging
+import os
+import time
+import tracemalloc
+
+import bittrie
+
+log = logging.getLogger(__name__)
+
+class LegacyBitTrie(object):
+    "The previous nibble trie: a 16 slot list per nibble of every key prefix"\
+    " and a LegacyTrieLeaf object per entry, and _del only prunes one level."
+
+    def __init__(self):
+        self.trie = [None] * 0x10
+
+    def get(self, key, default=None):
+        r = self._get(key)
+        if r:
+            return r
+        return default
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __getitem__(self, key):
+        r = self.get(key)
+        if not r:
+            raise KeyError()
+        return r
+
+    def __str__(self):
+        buf = "["
+        first = True
+
+        for x in self.find(bittrie.ZeroKey()):
+            if not x:
+                continue
+            if not first:
+                buf += ", "
+            else:
+                first = False
+            buf += str(x)
+
+        buf += "]"
+
+        return buf
+
+    def __iter__(self):
+        for item in self.find(bittrie.ZeroKey()):
+            if item is bittrie.none_found:
+                continue
+            yield item
+
+    def __delitem__(self, key):
+        self._del(key)
+
+    default_default = object()
+
+    def pop(self, key, default=default_default):
+        r = self._del(key)
+
+        if r:
+            return r
+
+        if default is not self.default_default:
+            return default
+
+        raise KeyError()
+
+    def setdefault(self, key, default):
+        r = self.put(key, default, False)
+        if not r:
+            return default
+        return r
+
+    def put(self, key, value, replace=True):
+        node = self.trie
+
+        keylen = len(key)
+        for i in range(keylen):
+            char = key[i]
+            for j in range(4, -1, -4):
+                bit = (char >> j) & 0x0F
+                next_node = node[bit]
+
+                if not next_node:
+                    node[bit] = LegacyTrieLeaf(key, value)
+                    return None
+
+                if type(next_node) is LegacyTrieLeaf:
+                    other = next_node
+
+                    o_key = other.key
+                    if j == 0:
+                        ii = i + 1
+                        if ii == keylen:
+                            if replace:
+                                node[bit] = LegacyTrieLeaf(key, value)
+                            return other.value
+
+                        next_o_bit = (o_key[ii] >> 4) & 0x0F
+                    else:
+                        next_o_bit = (o_key[i] >> (j-4)) & 0x0F
+
+                    next_node = [None] * 0x10
+                    next_node[next_o_bit] = other
+
+                    node[bit] = next_node
+                    node = next_node
+                    continue
+
+                assert type(next_node) is list, type(next_node)
+                node = next_node
+
+    def _del(self, key):
+        #FIXME: Make this code prune empty trees more than one deep.
+        prev_node = None
+        prev_node_bit = None
+        node = self.trie
+
+        for i in range(len(key)):
+            char = key[i]
+            for j in range(4, -1, -4):
+                bit = (char >> j) & 0x0F
+                next_node = node[bit]
+
+                if not next_node:
+                    return None
+
+                if type(next_node) is LegacyTrieLeaf:
+                    node[bit] = None
+
+                    empty = True
+                    for n in node:
+                        if n:
+                            empty = False
+                            break;
+
+                    if empty and prev_node:
+                        prev_node[prev_node_bit] = None
+
+                    return next_node.value
+
+                assert type(next_node) is list, type(next_node)
+
+                prev_node = node
+                prev_node_bit = bit
+                node = next_node
+
+    def _get(self, key):
+        node = self.trie
+
+        for i in range(len(key)):
+            char = key[i]
+            for j in range(4, -1, -4):
+                bit = (char >> j) & 0x0F
+                next_node = node[bit]
+
+                if not next_node:
+                    return None
+
+                if type(next_node) is LegacyTrieLeaf:
+                    if next_node.key == key:
+                        return next_node.value
+                    else:
+                        return None
+
+                assert type(next_node) is list, type(next_node)
+
+                node = next_node
+
+    def find(self, key, forward=True):
+        "Generator. First element can be None sometimes when no exact match."
+        branches = []
+        node = self.trie
+
+        key_len = len(key)
+        i = 0
+        while i < key_len:
+            char = key[i]
+            j = 4
+            while j >= 0:
+                bit = (char >> j) & 0x0F
+
+                rng = range(0x0F, bit, -1) if forward else range(0, bit)
+
+                for obit in rng:
+                    other = node[obit]
+                    if other:
+                        branches.append(other)
+
+                next_node = node[bit]
+
+                if not next_node:
+                    yield bittrie.none_found
+
+                    func = self._iterate_next(branches) if forward\
+                        else self._iterate_prev(branches)
+
+                    for r in func:
+                        yield r
+                    return None
+
+                if type(next_node) is LegacyTrieLeaf:
+                    nnk = next_node.key
+                    kl = min(len(nnk), key_len)
+                    while True:
+                        if nnk[i] != key[i]:
+                            greater = nnk[i] > key[i]
+
+                            yield bittrie.none_found
+
+                            if greater ^ (not forward):
+                                yield next_node.value
+
+                            break
+
+                        i = i + 1
+                        if i == kl:
+                            yield next_node.value
+                            break
+
+                    func = self._iterate_next(branches) if forward\
+                        else self._iterate_prev(branches)
+
+                    for r in func:
+                        yield r
+
+                    return None
+
+                assert type(next_node) is list, type(next_node)
+
+                node = next_node
+                j = j - 4
+
+            i = i + 1
+
+    def _iterate_next(self, branches):
+        while True:
+            if not branches:
+                return None
+
+            node = branches.pop()
+
+            if type(node) is LegacyTrieLeaf:
+                yield node.value
+                continue
+
+            assert type(node) is list, type(node)
+
+            branches.extend(reversed([x for x in node if x]))
+
+    def _iterate_prev(self, branches):
+        while True:
+            if not branches:
+                return None
+
+            node = branches.pop()
+
+            if type(node) is LegacyTrieLeaf:
+                yield node.value
+                continue
+
+            assert type(node) is list, type(node)
+
+            branches.extend([x for x in node if x])
+
+class LegacyTrieLeaf(object):
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+def _time(name, f, count=1):
+    start = time.perf_counter()
+    r = f()
+    elapsed = time.perf_counter() - start
+
+    print("{:>24s}: {:10.6f}s, {:10.2f} us/op."\
+        .format(name, elapsed, elapsed / count * 1000000))
+
+    return r
+
+def _fill(trie_class, node_id, ids):
+    def fill():
+        t = trie_class()
+        for i, id_ in enumerate(ids):
+            t[bittrie.XorKey(node_id, id_)] = i + 1
+        return t
+
+    t = _time("put", fill, len(ids))
+    t = None
+
+    # Filled again as tracing slows it down.
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+
+    t = fill()
+
+    size = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+
+    print("{:>24s}: {:10.0f} bytes/entry.".format("memory", size / len(ids)))
+
+    return t
+
+def _run(trie_class, node_id, ids, targets, k):
+    print("{}:".format(trie_class.__name__))
+
+    t = _fill(trie_class, node_id, ids)
+
+    def get():
+        for id_ in ids[:len(targets)]:
+            t.get(bittrie.XorKey(node_id, id_))
+
+    _time("get", get, len(targets))
+
+    def find():
+        for target in targets:
+            cnt = k
+            for r in t.find(bittrie.XorKey(node_id, target)):
+                cnt -= 1
+                if not cnt:
+                    break
+
+    _time("find {}".format(k), find, len(targets))
+
+    if trie_class is bittrie.BitTrie:
+        nt = trie_class()
+        for i, id_ in enumerate(ids):
+            nt[id_] = i + 1
+
+        def nearest():
+            return [nt.nearest(target, k) for target in targets]
+    else:
+        def nearest():
+            r = []
+            for target in targets[:max(1, len(targets) // 100)]:
+                xt = trie_class()
+                for i, id_ in enumerate(ids):
+                    xt[bittrie.XorKey(target, id_)] = i + 1
+                rr = []
+                for v in xt:
+                    rr.append(v)
+                    if len(rr) == k:
+                        break
+                r.append(rr)
+            return r
+
+    r = _time("nearest {}".format(k), nearest, len(targets)\
+        if trie_class is bittrie.BitTrie else max(1, len(targets) // 100))
+
+    def pop():
+        for id_ in ids:
+            t.pop(bittrie.XorKey(node_id, id_), None)
+
+    _time("pop", pop, len(ids))
+
+    _measure_leak(trie_class, node_id, ids)
+
+    return r
+
+def _measure_leak(trie_class, node_id, ids):
+    "Prints the memory still held after filling a trie and popping it empty."
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+
+    t = trie_class()
+    for i, id_ in enumerate(ids):
+        t[bittrie.XorKey(node_id, id_)] = i + 1
+    for id_ in ids:
+        t.pop(bittrie.XorKey(node_id, id_), None)
+
+    size = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+
+    print("{:>24s}: {:10.0f} bytes.".format("left when empty", size))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=100000,\
+        help="Number of node ids in the trie.")
+    parser.add_argument("--queries", type=int, default=1000,\
+        help="Number of gets, finds and nearest queries.")
+    parser.add_argument("--k", type=int, default=20,\
+        help="Number of entries each find and nearest query returns.")
+    args = parser.parse_args()
+
+    node_id = os.urandom(64)
+    ids = [os.urandom(64) for i in range(args.count)]
+    targets = [os.urandom(64) for i in range(args.queries)]
+
+    r1 = _run(LegacyBitTrie, node_id, ids, targets, args.k)
+    r2 = _run(bittrie.BitTrie, node_id, ids, targets, args.k)
+
+    assert r1 == r2[:len(r1)]
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+import llog
+
+from collections import OrderedDict
+import logging
+import time
+
+import xordist
+
+log = logging.getLogger(__name__)
+
+# Default byte budget of the decrypted data held.
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+# Seconds an updateable key's data is served for before it is fetched again,
+# as a newer version may have been stored since.
+UPDATEABLE_MAX_AGE = 300
+
+class CachedBlock(object):
+    def __init__(self, data_rw):
+        self.data = data_rw.data
+        self.pubkey = data_rw.pubkey
+        self.signature = data_rw.signature
+        self.path_hash = data_rw.path_hash
+        self.version = data_rw.version
+        self.targeted = data_rw.targeted
+        self.time = time.monotonic()
+
+class BlockCache(object):
+    "Recently fetched and verified blocks, decrypted, by data_key. The least"\
+    " recently used are evicted once the data exceeds max_bytes."
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.blocks = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def get(self, data_key, targeted=False):
+        "Returns the CachedBlock, or None if missing or if it is of an"\
+        " updateable key and older than UPDATEABLE_MAX_AGE."
+
+        data_key = bytes(data_key)
+
+        block = self.blocks.get(data_key)
+
+        if block is not None:
+            if block.targeted != targeted:
+                block = None
+            elif block.version is not None\
+                    and time.monotonic() - block.time > UPDATEABLE_MAX_AGE:
+                self._remove(data_key)
+                block = None
+
+        if block is None:
+            self.misses += 1
+            return None
+
+        self.blocks.move_to_end(data_key)
+        self.hits += 1
+
+        return block
+
+    def put(self, data_rw):
+        "Caches the data of the DataResponseWrapper, which must be verified."
+
+        size = len(data_rw.data)
+        if size > self.max_bytes:
+            return
+
+        data_key = bytes(data_rw.data_key)
+
+        self._remove(data_key)
+
+        self.blocks[data_key] = CachedBlock(data_rw)
+        self.size += size
+
+        while self.size > self.max_bytes:
+            old_key, old = self.blocks.popitem(False)
+            self.size -= len(old.data)
+
+    def remove(self, data_key):
+        "Forgets the data of data_key, as when we store a new version of it."
+
+        self._remove(bytes(data_key))
+
+    def _remove(self, data_key):
+        old = self.blocks.pop(data_key, None)
+        if old is not None:
+            self.size -= len(old.data)
+
+    def clear(self):
+        self.blocks.clear()
+        self.size = 0
+
+# Default byte budget of the encrypted data held for other nodes, separate from
+# the datastore's.
+DEFAULT_TRANSIT_MAX_BYTES = 64 * 1024 * 1024
+# The hit counts are halved after this many lookups, so that blocks that were
+# once popular don't stay forever.
+TRANSIT_DECAY_PERIOD = 1024
+
+class TransitBlock(object):
+    def __init__(self, distance, drmsg):
+        self.distance = distance
+
+        self.data = drmsg.data
+        self.original_size = drmsg.original_size
+        self.version = drmsg.version
+        self.signature = drmsg.signature
+        self.epubkey = drmsg.epubkey
+        self.pubkeylen = drmsg.pubkeylen
+
+        self.hits = 1
+        self.time = time.monotonic()
+
+class TransitCache(object):
+    "Verified blocks, as encrypted in the DataResponse they came in, by"\
+    " data_id, that we serve to other nodes as if they were in our datastore."\
+    " Once the data exceeds max_bytes, the least requested are evicted, and of"\
+    " those the furthest from our node_id."
+
+    def __init__(self, node_id, max_bytes=DEFAULT_TRANSIT_MAX_BYTES):
+        self.node_id = node_id
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.blocks = {} # {data_id: TransitBlock}
+
+        self._lookups = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __contains__(self, data_id):
+        return self._get(bytes(data_id)) is not None
+
+    def _get(self, data_id):
+        block = self.blocks.get(data_id)
+
+        if block is not None and block.version is not None\
+                and time.monotonic() - block.time > UPDATEABLE_MAX_AGE:
+            self._remove(data_id)
+            return None
+
+        return block
+
+    def get(self, data_id):
+        "Returns the TransitBlock, or None if missing or if it is of an"\
+        " updateable key and older than UPDATEABLE_MAX_AGE."
+
+        block = self._get(bytes(data_id))
+
+        self._lookups += 1
+        if self._lookups >= TRANSIT_DECAY_PERIOD:
+            self._decay()
+
+        if block is None:
+            self.misses += 1
+            return None
+
+        block.hits += 1
+        self.hits += 1
+
+        return block
+
+    def put(self, data_id, drmsg):
+        "Caches the ChordDataResponse, which must have been verified to be"\
+        " the data of data_id."
+
+        size = len(drmsg.data)
+        if size > self.max_bytes:
+            return
+
+        data_id = bytes(data_id)
+
+        old = self.blocks.get(data_id)
+        if old is not None and old.version is not None\
+                and drmsg.version is not None and old.version > drmsg.version:
+            return
+
+        self._remove(data_id)
+
+        block = TransitBlock(xordist.distance(self.node_id, data_id), drmsg)
+        if old is not None:
+            block.hits = old.hits
+
+        while self.size + size > self.max_bytes:
+            self._remove(min(self.blocks,\
+                key=lambda x: (self.blocks[x].hits, -self.blocks[x].distance)))
+
+        self.blocks[data_id] = block
+        self.size += size
+
+    def remove(self, data_id):
+        "Forgets data_id, as when it gets stored in our datastore."
+
+        self._remove(bytes(data_id))
+
+    def _remove(self, data_id):
+        old = self.blocks.pop(data_id, None)
+        if old is not None:
+            self.size -= len(old.data)
+
+    def _decay(self):
+        self._lookups = 0
+
+        for block in self.blocks.values():
+            block.hits >>= 1
+
+    def clear(self):
+        self.blocks.clear()
+        self.size = 0
@@ -0,0 +1,200 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+# A write-ahead journal that keeps the block store in sync with the DataBlock
+# table across crashes. _store_data adds a DataBlockJournal entry in the same
+# transaction as each DataBlock change whose data is yet to be written or
+# removed from the block store. Once that is done the entry is completed, and
+# the completed entries are deleted in one transaction every COMMIT_DELAY
+# seconds, after one sync of the block store; so the store needs no fsync per
+# block. At start recover() finishes or undoes whatever the entries left
+# pending say was in progress.
+
+import llog
+
+import asyncio
+import logging
+
+from db import DataBlock, DataBlockJournal, NodeState
+import mutil
+import node as mnnode
+
+log = logging.getLogger(__name__)
+
+ACTION_CREATE = 1
+ACTION_DELETE = 2
+
+COMMIT_DELAY = 1
+# A commit is started right away once this many entries are completed.
+COMMIT_BATCH = 256
+
+def add_entry(sess, data_block_id, action):
+    "Adds an entry to the session, which the caller commits."
+
+    entry = DataBlockJournal()
+    entry.data_block_id = data_block_id
+    entry.action = action
+    entry.insert_timestamp = mutil.utc_datetime()
+
+    sess.add(entry)
+
+    return entry
+
+def encrypted_size(original_size):
+    "Returns the size in the block store of a block of original_size."
+
+    return (original_size + 15) & ~15
+
+class BlockJournal(object):
+    def __init__(self, node):
+        self.node = node
+        self.loop = node.loop
+
+        self.completed = [] # [DataBlockJournal.id]
+
+        self._commit_handle = None
+        self._committing = False
+
+    def complete(self, entry_ids):
+        "Marks the entries as done, to be deleted with the next commit."
+
+        self.completed.extend(entry_ids)
+
+        if len(self.completed) >= COMMIT_BATCH and not self._committing:
+            if self._commit_handle:
+                self._commit_handle.cancel()
+            self._async_commit()
+        elif not self._commit_handle and not self._committing:
+            self._commit_handle =\
+                self.loop.call_later(COMMIT_DELAY, self._async_commit)
+
+    def _async_commit(self):
+        self._commit_handle = None
+        asyncio.async(self.commit(), loop=self.loop)
+
+    def _take_completed(self):
+        entry_ids = self.completed
+        self.completed = []
+        return entry_ids
+
+    def _commit(self, entry_ids):
+        self.node.block_store.sync()
+
+        with self.node.db.open_session() as sess:
+            sess.query(DataBlockJournal)\
+                .filter(DataBlockJournal.id.in_(entry_ids))\
+                .delete(synchronize_session=False)
+
+            sess.commit()
+
+    @asyncio.coroutine
+    def commit(self):
+        "Syncs the block store and deletes the completed entries."
+
+        entry_ids = self._take_completed()
+        if not entry_ids:
+            return
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Committing [{}] completed DataBlockJournal entries."\
+                .format(len(entry_ids)))
+
+        self._committing = True
+
+        try:
+            yield from\
+                self.loop.run_in_executor(None, self._commit, entry_ids)
+        except Exception:
+            log.exception("BlockJournal._commit(..)")
+
+            # Try again later.
+            self.completed.extend(entry_ids)
+        finally:
+            self._committing = False
+
+        if self.completed:
+            self.complete([])
+
+    def stop(self):
+        "Synchronously commits the completed entries, as the loop is"\
+        " stopping."
+
+        if self._commit_handle:
+            self._commit_handle.cancel()
+            self._commit_handle = None
+
+        entry_ids = self._take_completed()
+        if not entry_ids:
+            return
+
+        self._commit(entry_ids)
+
+    def recover(self):
+        "Reconciles the block store with the DataBlock table for the entries"\
+        " left pending, deleting the DataBlock rows of blocks whose data"\
+        " didn't make it. Blocking; returns the bytes those freed."
+
+        store = self.node.block_store
+        freed = 0
+
+        with self.node.db.open_session() as sess:
+            self.node.db.lock_table(sess, DataBlock)
+
+            entries = sess.query(DataBlockJournal)\
+                .order_by(DataBlockJournal.id).all()
+
+            if not entries:
+                return 0
+
+            if log.isEnabledFor(logging.WARNING):
+                log.warning("Recovering [{}] pending DataBlockJournal"\
+                    " entries.".format(len(entries)))
+
+            for entry in entries:
+                data_block = sess.query(DataBlock)\
+                    .filter(DataBlock.id == entry.data_block_id)\
+                    .first()
+
+                if entry.action == ACTION_DELETE:
+                    if not data_block:
+                        store.remove(entry.data_block_id)
+                    continue
+
+                assert entry.action == ACTION_CREATE
+
+                if not data_block:
+                    # It was pruned since; its DELETE entry, if still
+                    # pending, will remove any data.
+                    continue
+
+                data = store.read(data_block.id)
+                if data is not None and len(data)\
+                        == encrypted_size(data_block.original_size):
+                    continue
+
+                log.warning("Block id=[{}] was not completely written;"\
+                    " removing it.".format(data_block.id))
+
+                store.remove(data_block.id)
+
+                sess.delete(data_block)
+                freed += data_block.original_size
+
+            if freed:
+                # Rule: only update this NodeState row when holding a lock on
+                # the DataBlock table.
+                node_state = sess.query(NodeState)\
+                    .filter(NodeState.key == mnnode.NSK_DATASTORE_SIZE)\
+                    .first()
+
+                if node_state:
+                    node_state.value = str(int(node_state.value) - freed)
+
+            # The reconciled store must be on disk before the entries are gone.
+            store.sync()
+
+            sess.query(DataBlockJournal).delete(synchronize_session=False)
+
+            sess.commit()
+
+        return freed
@@ -0,0 +1,478 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+# The stores of the encrypted data blocks on disk, by DataBlock.id; the meta
+# data is in the DataBlock table. Their methods do blocking I/O and are meant
+# to be called through run_in_executor(..).
+#
+# FileBlockStore is the original layout of one file per block.
+#
+# SegmentBlockStore appends the blocks to segment files instead, each record
+# being a header of (type, DataBlock.id, length) followed by the data. A
+# removal appends a tombstone record. The index of id -> (segment, offset,
+# length) is rebuilt by scanning the record headers at open, later records
+# overriding earlier ones. compact() copies the live data of the sealed
+# segments that fell under COMPACT_THRESHOLD into the active one, and then
+# deletes them.
+#
+# Running this module converts a FileBlockStore into a SegmentBlockStore.
+
+import llog
+
+import argparse
+import hashlib
+import logging
+import os
+import re
+import struct
+import threading
+
+log = logging.getLogger(__name__)
+
+BLOCK_FILE_NAME = "{}.blk"
+BLOCK_FILE_RE = re.compile(r"^(\d+)\.blk$")
+SEGMENT_FILE_NAME = "segment-{:08d}.dat"
+SEGMENT_FILE_RE = re.compile(r"^segment-(\d{8})\.dat$")
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+# Sealed segments with less than this fraction of live data are compacted.
+COMPACT_THRESHOLD = 0.5
+# Seconds between the compactions a Node runs.
+COMPACT_INTERVAL = 600
+
+RECORD_BLOCK = 1
+RECORD_TOMBSTONE = 2
+
+_HEADER = struct.Struct(">BQL")
+
+_O_BINARY = getattr(os, "O_BINARY", 0)
+
+if hasattr(os, "pread"):
+    _pread = os.pread
+else:
+    _pread_lock = threading.Lock()
+
+    def _pread(fd, length, offset):
+        with _pread_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+def _write_fully(fd, data):
+    data = memoryview(data)
+    while data:
+        data = data[os.write(fd, data):]
+
+def checksum(*parts):
+    "Returns the checksum of the concatenation of parts, as kept in"\
+    " DataBlock.checksum. hashlib releases the GIL while hashing, so it runs"\
+    " concurrently with the other threads."
+
+    h = hashlib.sha256()
+    for part in parts:
+        if part:
+            h.update(part)
+
+    return h.digest()
+
+def _sync_dir(path):
+    "Makes the creations and removals of files in path durable, where the"\
+    " platform allows opening directories."
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class FileBlockStore(object):
+    "One file per block, named by its DataBlock.id."
+
+    def __init__(self, path):
+        self.path = path
+
+        self._unsynced = set() # {block_id}
+        self._lock = threading.Lock()
+
+    def open(self):
+        for name in os.listdir(self.path):
+            if SEGMENT_FILE_RE.match(name):
+                errmsg = "Data store [{}] has segment files, but"\
+                    " --segmentstore was not specified."\
+                        .format(self.path)
+                log.warning(errmsg)
+                raise Exception(errmsg)
+
+    def close(self):
+        pass
+
+    def _file_path(self, block_id):
+        return os.path.join(self.path, BLOCK_FILE_NAME.format(block_id))
+
+    def read(self, block_id):
+        "Returns the data of the block, or None if it is missing."
+
+        try:
+            with open(self._file_path(block_id), "rb") as data_file:
+                return data_file.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, block_id, *parts):
+        "Stores the concatenation of parts as the block, replacing any"\
+        " previous data."
+
+        with open(self._file_path(block_id), "wb") as new_file:
+            for part in parts:
+                if part:
+                    new_file.write(part)
+
+        with self._lock:
+            self._unsynced.add(block_id)
+
+    def remove(self, block_id):
+        "Returns False if the block was missing."
+
+        try:
+            os.remove(self._file_path(block_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def sync(self):
+        "Makes the writes and removals so far durable."
+
+        with self._lock:
+            block_ids = self._unsynced
+            self._unsynced = set()
+
+        for block_id in block_ids:
+            try:
+                fd = os.open(self._file_path(block_id), os.O_RDWR | _O_BINARY)
+            except FileNotFoundError:
+                continue
+
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        _sync_dir(self.path)
+
+    def compact(self):
+        return 0
+
+class SegmentBlockStore(object):
+    "Blocks appended to segment files of upto segment_size bytes."
+
+    def __init__(self, path, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+
+        self.index = {} # {block_id: (segment, offset, length)}
+        self.fds = {} # {segment: fd}
+        self.sizes = {} # {segment: bytes}
+        self.live = {} # {segment: bytes of live block data}
+        self.active = None
+
+        self._lock = threading.Lock()
+
+    def open(self):
+        for name in os.listdir(self.path):
+            if BLOCK_FILE_RE.match(name):
+                errmsg = "Data store [{}] has block files; convert it by"\
+                    " running blockstore.py first.".format(self.path)
+                log.warning(errmsg)
+                raise Exception(errmsg)
+
+        self._load()
+
+    def _load(self):
+        segments = []
+        for name in os.listdir(self.path):
+            m = SEGMENT_FILE_RE.match(name)
+            if m:
+                segments.append(int(m.group(1)))
+
+        segments.sort()
+
+        for segment in segments:
+            self._load_segment(segment)
+
+        if segments:
+            self.active = segments[-1]
+        else:
+            self._new_segment(0)
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Loaded [{}] blocks from [{}] segments."\
+                .format(len(self.index), len(self.fds)))
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, SEGMENT_FILE_NAME.format(segment))
+
+    def _open_segment(self, segment):
+        fd = os.open(self._segment_path(segment),\
+            os.O_RDWR | os.O_CREAT | os.O_APPEND | _O_BINARY, 0o644)
+
+        self.fds[segment] = fd
+        self.live[segment] = 0
+
+        return fd
+
+    def _new_segment(self, segment):
+        self._open_segment(segment)
+        self.sizes[segment] = 0
+        self.active = segment
+
+    def _load_segment(self, segment):
+        fd = self._open_segment(segment)
+        size = os.fstat(fd).st_size
+
+        offset = 0
+        for rtype, block_id, length, offset in self._records(fd, size):
+            self._unindex(block_id)
+
+            if rtype == RECORD_BLOCK:
+                self.index[block_id] =\
+                    (segment, offset + _HEADER.size, length)
+                self.live[segment] += length
+
+            offset += _HEADER.size + length
+
+        if offset != size:
+            log.warning("Segment [{}] has [{}] bytes of incomplete or invalid"\
+                " records at its end; truncating."\
+                    .format(segment, size - offset))
+            os.ftruncate(fd, offset)
+
+        self.sizes[segment] = offset
+
+    def _records(self, fd, size):
+        "Yields (type, block_id, length, offset) of the valid records."
+
+        offset = 0
+        while offset + _HEADER.size <= size:
+            rtype, block_id, length =\
+                _HEADER.unpack(_pread(fd, _HEADER.size, offset))
+
+            if rtype not in (RECORD_BLOCK, RECORD_TOMBSTONE)\
+                    or offset + _HEADER.size + length > size:
+                return
+
+            yield rtype, block_id, length, offset
+
+            offset += _HEADER.size + length
+
+    def _unindex(self, block_id):
+        old = self.index.pop(block_id, None)
+        if old is not None:
+            self.live[old[0]] -= old[2]
+
+    def _append(self, block_id, record, length=None):
+        "Appends the record, which is of a block if length is not None, to"\
+        " the active segment. Must be called with _lock held. Returns the"\
+        " segment."
+
+        size = self.sizes[self.active]
+        if size and size + len(record) > self.segment_size:
+            self._new_segment(self.active + 1)
+            size = 0
+
+        segment = self.active
+        fd = self.fds[segment]
+
+        try:
+            _write_fully(fd, record)
+        except Exception:
+            # Don't leave a partial record for the next to follow.
+            os.ftruncate(fd, size)
+            raise
+
+        self.sizes[segment] += len(record)
+
+        self._unindex(block_id)
+
+        if length is not None:
+            self.index[block_id] = (segment, size + _HEADER.size, length)
+            self.live[segment] += length
+
+        return segment
+
+    def close(self):
+        with self._lock:
+            for fd in self.fds.values():
+                os.close(fd)
+
+            self.fds.clear()
+
+    def read(self, block_id):
+        "Returns the data of the block, or None if it is missing."
+
+        with self._lock:
+            loc = self.index.get(block_id)
+            if loc is None:
+                return None
+
+            segment, offset, length = loc
+            data = _pread(self.fds[segment], length, offset)
+
+        if len(data) != length:
+            log.warning("Block id=[{}] was truncated in segment [{}]."\
+                .format(block_id, segment))
+            return None
+
+        return data
+
+    def write(self, block_id, *parts):
+        "Stores the concatenation of parts as the block, replacing any"\
+        " previous data."
+
+        data = b"".join(part for part in parts if part)
+        record = _HEADER.pack(RECORD_BLOCK, block_id, len(data)) + data
+
+        with self._lock:
+            self._append(block_id, record, len(data))
+
+    def remove(self, block_id):
+        "Returns False if the block was missing."
+
+        with self._lock:
+            if block_id not in self.index:
+                return False
+
+            self._append(\
+                block_id, _HEADER.pack(RECORD_TOMBSTONE, block_id, 0))
+
+            return True
+
+    def sync(self):
+        "Makes the writes and removals so far durable."
+
+        with self._lock:
+            for fd in self.fds.values():
+                os.fsync(fd)
+
+        _sync_dir(self.path)
+
+    def compact(self):
+        "Compacts the sealed segments with less than COMPACT_THRESHOLD of"\
+        " live data. Returns the number of bytes freed."
+
+        with self._lock:
+            segments = [segment for segment in sorted(self.sizes)\
+                if segment != self.active\
+                    and self.live[segment]\
+                        < self.sizes[segment] * COMPACT_THRESHOLD]
+
+        freed = 0
+        for segment in segments:
+            freed += self._compact_segment(segment)
+
+        return freed
+
+    def _compact_segment(self, segment):
+        # The segment is sealed, so only its index entries change meanwhile.
+        fd = self.fds[segment]
+        size = self.sizes[segment]
+
+        copied = 0
+        written = set()
+
+        for rtype, block_id, length, offset in self._records(fd, size):
+            with self._lock:
+                if rtype == RECORD_BLOCK:
+                    if self.index.get(block_id)\
+                            != (segment, offset + _HEADER.size, length):
+                        continue
+
+                    record = _pread(fd, _HEADER.size + length, offset)
+                    written.add(self._append(block_id, record, length))
+                elif block_id not in self.index\
+                        and min(self.sizes) < segment:
+                    # It may still hide a block in an older segment.
+                    record = _HEADER.pack(RECORD_TOMBSTONE, block_id, 0)
+                    written.add(self._append(block_id, record))
+                else:
+                    continue
+
+                copied += len(record)
+
+        with self._lock:
+            # The copies must be on disk before the originals are gone.
+            for wsegment in written:
+                os.fsync(self.fds[wsegment])
+
+            os.close(self.fds.pop(segment))
+            del self.sizes[segment]
+            del self.live[segment]
+
+            os.remove(self._segment_path(segment))
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Compacted segment [{}] ([{}] of [{}] bytes copied)."\
+                .format(segment, copied, size))
+
+        return size - copied
+
+def migrate(path, segment_size=DEFAULT_SEGMENT_SIZE):
+    "Converts the FileBlockStore at path into a SegmentBlockStore. It can be"\
+    " rerun if interrupted. Returns the number of blocks converted."
+
+    block_ids = []
+    for name in os.listdir(path):
+        m = BLOCK_FILE_RE.match(name)
+        if m:
+            block_ids.append(int(m.group(1)))
+
+    block_ids.sort()
+
+    files = FileBlockStore(path)
+    store = SegmentBlockStore(path, segment_size)
+    store._load()
+
+    try:
+        for block_id in block_ids:
+            data = files.read(block_id)
+            if data is not None:
+                store.write(block_id, data)
+
+        # The segments must be on disk before the files are gone.
+        store.sync()
+    finally:
+        store.close()
+
+    for block_id in block_ids:
+        files.remove(block_id)
+
+    return len(block_ids)
+
+def main():
+    parser = argparse.ArgumentParser(\
+        description="Convert a node's datastore of one file per block into"\
+            " packed segment files, for running it with --segmentstore.")
+    parser.add_argument("--nn", type=int,\
+        help="Node instance number.")
+    parser.add_argument("--segmentsize", type=int,\
+        help="Segment file size in MBs (default is 64).")
+    args = parser.parse_args()
+
+    # As Node.data_block_path.
+    path = "data/store-{}".format(args.nn if args.nn else 0)
+
+    segment_size = args.segmentsize << 20 if args.segmentsize\
+        else DEFAULT_SEGMENT_SIZE
+
+    print("Converting [{}].".format(path))
+
+    cnt = migrate(path, segment_size)
+
+    print("Converted [{}] blocks.".format(cnt))
+
+if __name__ == "__main__":
+    main()
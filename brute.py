@@ -11,8 +11,8 @@ import time
 import enc
 import mbase32
 import multipart
-import mutil
 import rsakey
+import xordist
 
 log = logging.getLogger(__name__)
 
@@ -110,6 +110,9 @@ def __find_nonce(rp):
     wid, prefix, nbits, data, nonce_offset, nonce_size = rp.recv()
 
     max_dist = HASH_BITS - nbits
+    # Only the bits under the prefix are compared.
+    p = xordist.to_int(prefix)
+    tail_bits = (HASH_BYTES - len(prefix)) << 3
     nbytes = int(nbits / 8)
     nbytes += 4 # Extra bytes to increase probability of enough possibilities.
     nbytes = min(nbytes, nonce_size)
@@ -124,12 +127,11 @@ def __find_nonce(rp):
 
         h = enc.generate_ID(data)
 
-        try:
-            dist, direction = mutil.calc_log_distance(h, prefix)
-            match = dist <= max_dist and direction == -1
-        except IndexError:
-#            log.debug("Exactly matched prefix.")
-            match = True
+        dist, direction =\
+            xordist.log_distance_int(xordist.to_int(h) >> tail_bits, p)
+        # Exactly matching the prefix is a match as well.
+        match = not dist\
+            or (dist + tail_bits <= max_dist and direction == -1)
 
         if match:
 #            if log.isEnabledFor(logging.INFO):
@@ -15,10 +15,11 @@ import struct
 from functools import partial
 from datetime import datetime, timedelta
 
-from sqlalchemy import Integer, String, text, func, desc, or_
+from sqlalchemy import Integer, String, text, desc
 
 import bittrie
 import chord_packet as cp
+import chord_peers
 import chord_tasks as ct
 import packet as mnetpacket
 import rsakey
@@ -28,7 +29,8 @@ import peer as mnpeer
 import shell
 import enc
 from db import Peer
-from mutil import hex_dump, log_base2_8bit, hex_string, calc_log_distance
+from mutil import hex_dump, log_base2_8bit, hex_string
+import xordist
 
 BUCKET_SIZE = 16
 
@@ -54,7 +56,9 @@ class ChordEngine():
         self.pending_connections = {} # {Task, Peer->dbid}
         self.peers = {} # {protocol.address: Peer}.
         self.peer_buckets = [{} for i in range(NODE_ID_BITS)] # [{addr: Peer}]
-        self.peer_trie = bittrie.BitTrie() # {node_id, Peer}
+        self.peer_trie = bittrie.BitTrie() # {XOR(node_id, our node_id), Peer}
+
+        self.peer_directory = chord_peers.PeerDirectory(self, NODE_ID_BITS)
 
         self.protocol_ready = asyncio.Event(loop=self.loop)
 
@@ -92,26 +96,6 @@ class ChordEngine():
         self._bind_address = value
         self._bind_port = int(value.split(':')[1])
 
-    @asyncio.coroutine
-    def __rebuild_peer_trie(self):
-        "Recycle self.peer_trie because I didn't fully implement pruning."
-
-        #FIXME: Fix bittrie.py to prune itself properly, this is a temp hack
-        # to prevent it from leaking memory.
-
-        node_id = self.node_id
-
-        while True:
-
-            new_trie = bittrie.BitTrie()
-
-            for peer in self.peers.values():
-                xorkey = bittrie.XorKey(node_id, peer.node_id)
-                new_trie[xorkey] = peer
-
-            self.peer_trie = new_trie
-            yield from asyncio.sleep(3600) # Only do every hour.
-
     @asyncio.coroutine
     def connect_peer(self, addr):
         "Returns Peer connected to, or dbpeer of already connected Peer,"
@@ -128,17 +112,11 @@ class ChordEngine():
                 log.info("Found [{}] in our database; fetching."\
                     .format(addr))
 
-            def dbcall():
-                with self.node.db.open_session() as sess:
-                    nonlocal addr
-                    dbpeer = sess.query(Peer).filter(Peer.address == addr)\
-                        .first()
-
-                    sess.expunge(dbpeer)
-
-                    return dbpeer
+            dbpeer = self.peer_directory.find_by_address(addr)
 
-            dbpeer = yield from self.loop.run_in_executor(None, dbcall)
+            if not dbpeer:
+                # Deleted in the mean time.
+                return None
 
             if dbpeer.connected:
                 log.info("Not connecting to allready connected Peer ("\
@@ -170,69 +148,9 @@ class ChordEngine():
     def add_peers(self, peers, process_check_connections=True):
         log.info("Adding upto {} peers.".format(len(peers)))
 
-        def dbcall():
-            with self.node.db.open_session() as sess:
-                tlocked = False
-
-                batch = []
-                added = []
-
-                for peer in peers:
-                    assert type(peer) is Peer
-
-                    if not check_address(peer.address):
-                        continue
-
-                    if not tlocked:
-                        self.node.db.lock_table(sess, Peer)
-                        tlocked = True
-
-                    q = sess.query(func.count("*")).select_from(Peer)
-
-                    if peer.pubkey:
-                        assert peer.node_id is None
-                        peer.node_id = enc.generate_ID(peer.pubkey)
-                        peer.distance, peer.direction =\
-                            calc_log_distance(\
-                                self.node_id,\
-                                peer.node_id)
-                        q = q.filter(Peer.node_id == peer.node_id)
-                    elif peer.address:
-                        assert peer.node_id is None
-                        q = q.filter(Peer.address == peer.address)
-
-                    if q.scalar() > 0:
-                        if log.isEnabledFor(logging.DEBUG):
-                            log.debug("Peer [{}] already in list."\
-                                .format(peer.address))
-                        continue
-
-                    peer.connected = False
-
-                    if log.isEnabledFor(logging.INFO):
-                        log.info("Adding Peer [{}].".format(peer.address))
-                    sess.add(peer)
-                    batch.append(peer)
-
-                    if len(batch) == 10:
-                        sess.commit()
-                        for dbpeer in batch:
-                            fetch_id_in_thread = dbpeer.id
-                        added.extend(batch)
-                        batch.clear()
-                        sess.expunge_all()
-                        tlocked = False
-
-                if batch and tlocked:
-                    sess.commit()
-                    for dbpeer in batch:
-                        fetch_id_in_thread = dbpeer.id
-                    added.extend(batch)
-                    sess.expunge_all()
-
-                return added
-
-        added = yield from self.loop.run_in_executor(None, dbcall)
+        peers = [peer for peer in peers if check_address(peer.address)]
+
+        added = yield from self.peer_directory.add_peers(peers, self.node_id)
 
         if process_check_connections and added and self.running:
             yield from self.process_connection_count()
@@ -243,6 +161,8 @@ class ChordEngine():
     def start(self):
         self.running = True
 
+        yield from self.peer_directory.load()
+
         if self.node.offline_mode:
             log.info("Offline mode is enabled; not binding or connecting.")
             return
@@ -267,9 +187,6 @@ class ChordEngine():
         # Let _async_process_connection_count() connect some connections first.
         self.loop.call_later(7, self._async_do_stabilize)
 
-        # Temp hack to fix memory leak due to incomplete BitTrie prune impl.
-        asyncio.async(self.__rebuild_peer_trie(), loop=self.loop)
-
     def _async_do_stabilize(self):
         self._do_stabilize_handle =\
             self.loop.call_later(300, self._async_do_stabilize)
@@ -305,6 +222,8 @@ class ChordEngine():
         if self.server:
             self.server.close()
 
+        self.peer_directory.stop()
+
     def _async_process_connection_count(self):
         self._process_connection_count_handle =\
             self.loop.call_later(150, self._async_process_connection_count)
@@ -341,24 +260,8 @@ class ChordEngine():
     def _process_connection_count(self):
         log.info("Processing connection count.")
 
-        def dbcall():
-            with self.node.db.open_session() as sess:
-                st = sess.query(Peer)\
-                    .statement.with_only_columns(\
-                        [func.count('*')])
-
-                peer_cnt = sess.execute(st).scalar()
-
-                min_dist = sess.query(func.min_(Peer.distance))\
-                    .filter(Peer.distance != None)\
-                    .filter(Peer.distance != 0)\
-                    .filter(Peer.connected == False)\
-                    .scalar()
-
-                return peer_cnt, min_dist
-
-        self.last_db_peer_count, closestdistance =\
-            yield from self.loop.run_in_executor(None, dbcall)
+        self.last_db_peer_count = len(self.peer_directory)
+        closestdistance = self.peer_directory.closest_unconnected_distance()
 
         if log.isEnabledFor(logging.INFO):
             log.info("Database Peer count=[{}], closestdistance=[{}]."\
@@ -372,7 +275,8 @@ class ChordEngine():
         pbuffer = []
         connect_futures = []
 
-        fetched = False
+        grace = mutil.utc_datetime() - timedelta(minutes=5)
+
         distance = closestdistance
         while True:
             if distance >= NODE_ID_BITS + 1:
@@ -385,26 +289,8 @@ class ChordEngine():
                 distance += 1
                 continue
 
-            def dbcall():
-                with self.node.db.open_session() as sess:
-                    grace = mutil.utc_datetime() - timedelta(minutes=5)
-
-                    q = sess.query(Peer)\
-                        .filter(Peer.distance == distance,\
-                            Peer.connected == False,\
-                            or_(Peer.last_connect_attempt == None,\
-                                Peer.last_connect_attempt < grace))\
-                        .order_by(Peer.last_connect_attempt != None)\
-                        .order_by(func.random())\
-                        .limit(bucket_needs)
-
-                    r = q.all()
-
-                    sess.expunge_all()
-
-                    return r
-
-            rs = yield from self.loop.run_in_executor(None, dbcall)
+            rs = self.peer_directory.select_unconnected(\
+                distance, bucket_needs, grace)
 
             distance += 1
 
@@ -474,29 +360,21 @@ class ChordEngine():
             partial(self._create_client_protocol, peer),\
             host, port)
 
-        def dbcall(dbpeer):
-            with self.node.db.open_session() as sess:
-                self.node.db.lock_table(sess, Peer)
-                dbpeer = sess.query(Peer).get(dbpeer.id)
-                if dbpeer.connected:
-                    if log.isEnabledFor(logging.DEBUG):
-                        log.debug(\
-                            "Peer [{}] connected to us in the mean time."\
-                            .format(dbpeer.id))
-                    return False
-
-                dbpeer.connected = True
-                dbpeer.last_connect_attempt = mutil.utc_datetime()
-                sess.commit()
-                return True
+        dbpeer = self.peer_directory.get(dbpeer.id)
 
-        r = yield from self.loop.run_in_executor(None, dbcall, dbpeer)
-
-        if not r:
+        if not dbpeer or dbpeer.connected:
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(\
+                    "Peer [{}] connected to us in the mean time."\
+                    .format(peer.dbid))
             if peer.protocol:
                 peer.protocol.close()
             return None
 
+        dbpeer.connected = True
+        dbpeer.last_connect_attempt = mutil.utc_datetime()
+        self.peer_directory.mark_dirty(dbpeer)
+
         try:
             yield from asyncio.wait_for(client, timeout=30, loop=self.loop)
         except (Exception, asyncio.TimeoutError) as ex:
@@ -504,14 +382,8 @@ class ChordEngine():
                 .format(dbpeer.id, type(ex), ex))
 
             # An exception on connect; update db, Etc.
-            def dbcall(dbpeer):
-                with self.node.db.open_session() as sess:
-                    dbpeer = sess.query(Peer).get(dbpeer.id)
-                    dbpeer.connected = False
-
-                    sess.commit()
-
-            yield from self.loop.run_in_executor(None, dbcall, dbpeer)
+            dbpeer.connected = False
+            self.peer_directory.mark_dirty(dbpeer)
 
             if peer.protocol:
                 peer.protocol.close()
@@ -561,21 +433,20 @@ class ChordEngine():
     def _connection_lost(self, peer, exc):
         self.remove_from_peers(peer)
 
-        if not peer.dbid:
-            return
-
-        def dbcall():
-            with self.node.db.open_session() as sess:
-                dbpeer = sess.query(Peer).get(peer.dbid)
-                if not dbpeer:
-                    # Might have been deleted.
-                    return;
-                dbpeer.connected = False
-                sess.commit()
-
+        # Wait for _peer_authenticated(..) to have set the state, as it may
+        # still be inserting the Peer.
         yield from peer.connection_coop_lock.acquire()
         try:
-            yield from self.loop.run_in_executor(None, dbcall)
+            if not peer.dbid:
+                return
+
+            dbpeer = self.peer_directory.get(peer.dbid)
+            if not dbpeer:
+                # Might have been deleted.
+                return
+
+            dbpeer.connected = False
+            self.peer_directory.mark_dirty(dbpeer)
         finally:
             peer.connection_coop_lock.release()
 
@@ -621,143 +492,102 @@ class ChordEngine():
     @asyncio.coroutine
     def _peer_authenticated(self, peer):
         add_to_peers = True
+        pd = self.peer_directory
 
         if peer.dbid:
             # This would be an outgoing connection; and thus this dbid does
             # for sure exist in the database.
-            def dbcall():
-                with self.node.db.open_session() as sess:
-                    dbpeer = sess.query(Peer).get(peer.dbid)
-
-                    if not dbpeer.node_id:
-                        # Then it was a manually initiated connection (and no
-                        # public key was specified).
-                        self.node.db.lock_table(sess, Peer)
-                        odbpeer = sess.query(Peer)\
-                            .filter(Peer.node_id == peer.node_id).first()
-
-                        if odbpeer:
-                            sess.delete(dbpeer)
-
-                            if odbpeer.connected:
-                                log.info("We were already connected to"\
-                                    " Peer (id={}), dropping manual"\
-                                    " Peer (id={}) connection."\
-                                    .format(odbpeer.id, dbpeer.id))
-                                sess.commit()
-                                sess.expunge(dbpeer)
-                                return False, False
-                            else:
-                                odbpeer.connected = True
-
-                            log.info("We already knew (id={}) about"\
-                                " manual added peer (id={})."\
-                                .format(odbpeer.id, dbpeer.id))
-                            dbpeer = odbpeer
-                            peer.dbid = dbpeer.id
-                        else:
-                            dbpeer.node_id = peer.node_id
-                            dbpeer.pubkey = peer.node_key.asbytes()
-
-                            dbpeer.distance = peer.distance
-                            dbpeer.direction = peer.direction
-
-                        if dbpeer.distance == 0:
-                            log.info("Peer is us! (Has the same ID!)")
-                            sess.delete(dbpeer)
-                            sess.commit()
-                            return False, False
-
-                        sess.commit()
-                        sess.expunge(dbpeer)
-                        return True, True
-                    else:
-                        # Then we were trying to connect to a specific node_id.
-                        if dbpeer.node_id != peer.node_id:
-                            # Then the node we reached is not the node we were
-                            # trying to connect to.
-                            dbpeer.connected = False
-                            sess.commit()
-                            return False, False
-
-                        sess.expunge(dbpeer)
-                        return True, False # We already did when connecting.
-
-            r, r2 = yield from self.loop.run_in_executor(None, dbcall)
-            if not r:
+            dbpeer = pd.get(peer.dbid)
+            if not dbpeer:
+                # Deleted in the mean time.
                 return False, False
 
-            if not r2:
-                add_to_peers = False
-        else:
-            # This would be an incoming connection.
-            def dbcall():
-                with self.node.db.open_session() as sess:
-                    self.node.db.lock_table(sess, Peer)
-                    dbpeer = sess.query(Peer)\
-                        .filter(Peer.node_id == peer.node_id).first()
-
-                    if not dbpeer:
-                        # An incoming connection from an unknown Peer.
-                        dbpeer = Peer()
-                        dbpeer.node_id = peer.node_id
-                        dbpeer.pubkey = peer.node_key.asbytes()
-
-                        dbpeer.distance = peer.distance
-                        dbpeer.direction = peer.direction
-
-                        if dbpeer.distance == 0:
-                            log.info("Peer is us! (Has the same ID!)")
-                            sess.rollback()
-                            return False, None
+            if not dbpeer.node_id:
+                # Then it was a manually initiated connection (and no public
+                # key was specified).
+                odbpeer = pd.find_by_node_id(peer.node_id)
 
-                        dbpeer.address = peer.address
+                if odbpeer:
+                    pd.delete(dbpeer)
 
-                        sess.add(dbpeer)
-                    else:
-                        # Known Peer has connected to us.
-                        if dbpeer.distance == 0:
-                            log.warning("Found ourselves in the Peer table!")
-                            log.info("Peer is us! (Has the same ID!)")
-                            dbpeer.connected = False
-                            sess.delete(dbpeer)
-                            sess.commit()
-                            return False, None
-
-                        if dbpeer.connected:
-                            log.info("Already connected to Peer, disconnecting redundant connection.")
-                            sess.rollback()
-
-                            fetch_id_in_thread = dbpeer.id
-
-                            sess.expunge(dbpeer)
-
-                            return False, dbpeer
+                    if odbpeer.connected:
+                        log.info("We were already connected to Peer (id={}),"\
+                            " dropping manual Peer (id={}) connection."\
+                                .format(odbpeer.id, dbpeer.id))
+                        return False, False
+
+                    odbpeer.connected = True
+                    pd.mark_dirty(odbpeer)
+
+                    log.info("We already knew (id={}) about manual added peer"\
+                        " (id={}).".format(odbpeer.id, dbpeer.id))
+                    dbpeer = odbpeer
+                    peer.dbid = dbpeer.id
+                else:
+                    pd.set_node_id(dbpeer, peer.node_id,\
+                        peer.node_key.asbytes(), peer.distance,\
+                        peer.direction)
+
+                if dbpeer.distance == 0:
+                    log.info("Peer is us! (Has the same ID!)")
+                    pd.delete(dbpeer)
+                    return False, False
+            else:
+                # Then we were trying to connect to a specific node_id.
+                if dbpeer.node_id != peer.node_id:
+                    # Then the node we reached is not the node we were trying
+                    # to connect to.
+                    dbpeer.connected = False
+                    pd.mark_dirty(dbpeer)
+                    return False, False
 
-#                        host, port = dbpeer.address.split(':')
-#                        if host != peer.protocol.address[0]:
-#                            log.info("Remote Peer host has changed, updating our db record.")
-#                            dbpeer.address = "{}:{}".format(\
-#                            peer.protocol.address[0],\
-#                            port)
+                add_to_peers = False # We already did when connecting.
+        else:
+            # This would be an incoming connection.
+            dbpeer = pd.find_by_node_id(peer.node_id)
 
-                    dbpeer.connected = True
+            if not dbpeer:
+                # An incoming connection from an unknown Peer.
+                if peer.distance == 0:
+                    log.info("Peer is us! (Has the same ID!)")
+                    return False, False
 
-                    sess.commit()
+                dbpeer = Peer()
+                dbpeer.node_id = peer.node_id
+                dbpeer.pubkey = peer.node_key.asbytes()
 
-                    fetch_id_in_thread = dbpeer.id
+                dbpeer.distance = peer.distance
+                dbpeer.direction = peer.direction
 
-                    sess.expunge(dbpeer)
+                dbpeer.address = peer.address
+                dbpeer.connected = True
 
-                    return True, dbpeer
+                yield from pd.add_peer(dbpeer)
+            else:
+                # Known Peer has connected to us.
+                if dbpeer.distance == 0:
+                    log.warning("Found ourselves in the Peer table!")
+                    log.info("Peer is us! (Has the same ID!)")
+                    pd.delete(dbpeer)
+                    return False, False
 
-            r, dbpeer = yield from self.loop.run_in_executor(None, dbcall)
+                if dbpeer.connected:
+                    log.info("Already connected to Peer, disconnecting"\
+                        " redundant connection.")
+                    peer.dbid = dbpeer.id
+                    return False, False
+
+#                host, port = dbpeer.address.split(':')
+#                if host != peer.protocol.address[0]:
+#                    log.info("Remote Peer host has changed, updating our db record.")
+#                    dbpeer.address = "{}:{}".format(\
+#                    peer.protocol.address[0],\
+#                    port)
 
-            if dbpeer:
-                peer.dbid = dbpeer.id
+                dbpeer.connected = True
+                pd.mark_dirty(dbpeer)
 
-            if not r:
-                return False, False
+            peer.dbid = dbpeer.id
 
             if peer.address != dbpeer.address:
                 peer.address = dbpeer.address
@@ -777,7 +607,7 @@ class ChordEngine():
             return False
         self.peer_buckets[peer.distance - 1][address] = peer
 
-        xorkey = bittrie.XorKey(self.node_id, peer.node_id)
+        xorkey = xordist.distance(self.node_id, peer.node_id)
         self.peer_trie[xorkey] = peer
 
         return True
@@ -791,8 +621,28 @@ class ChordEngine():
             self.peer_buckets[peer.distance - 1].pop(address, None)
 
         if peer.node_id:
-            xorkey = bittrie.XorKey(self.node_id, peer.node_id)
-            self.peer_trie.pop(xorkey, None)
+            xorkey = xordist.distance(self.node_id, peer.node_id)
+            # Another connection to the same node may have replaced it.
+            if self.peer_trie.get(xorkey) is peer:
+                del self.peer_trie[xorkey]
+
+    def find_closest_peers(self, node_id, exclude=None, ready_only=True):
+        "Generator. Yields the full node PeerS ordered by the XOR distance of"\
+        " their node_id to node_id, the closest first, skipping exclude (a"\
+        " Peer), and unless not ready_only, those not ready."
+
+        # XORing all keys with our node_id keeps the distances between them,
+        # so walking the peer_trie out from the key of node_id yields PeerS in
+        # order of their distance to node_id.
+        key = xordist.distance(self.node_id, node_id)
+
+        for peer in self.peer_trie.iterate_nearest(key):
+            if peer is exclude or not peer.full_node:
+                continue
+            if ready_only and not peer.ready():
+                continue
+
+            yield peer
 
     def is_peer_connection_desirable(self, peer):
         peercnt = len(self.peers)
@@ -813,7 +663,7 @@ class ChordEngine():
             return True
 
         # Otherwise check that the node_id is closer than all others.
-        xorkey = bittrie.XorKey(self.node_id, peer.node_id)
+        xorkey = xordist.distance(self.node_id, peer.node_id)
 
         cnt = 0
         none_started = False
@@ -1074,13 +924,9 @@ class ChordEngine():
         else:
             return
 
-        def dbcall():
-            with self.node.db.open_session() as sess:
-                dbp = sess.query(Peer).get(peer.dbid);
-                dbp.address = peer.address
-                sess.commit()
-
-        yield from self.loop.run_in_executor(None, dbcall)
+        dbp = self.peer_directory.get(peer.dbid)
+        if dbp:
+            self.peer_directory.set_address(dbp, peer.address)
 
 def check_address(address):
     try:
@@ -14,6 +14,7 @@ import sshtype
 
 # Chord Message Types.
 CHORD_MSG_RELAY = 100
+CHORD_MSG_RELAY_PATH = 101
 CHORD_MSG_NODE_INFO = 110
 CHORD_MSG_GET_PEERS = 115
 CHORD_MSG_PEER_LIST = 120
@@ -36,7 +37,7 @@ log = logging.getLogger(__name__)
 class ChordMessage(object):
     @staticmethod
     def parse_type(buf):
-        return struct.unpack("B", buf[0:1])[0]
+        return struct.unpack_from("B", buf)[0]
 
     def __init__(self, packet_type=None, buf=None):
         self.buf = buf
@@ -50,7 +51,7 @@ class ChordMessage(object):
         self.parse()
 
     def parse(self):
-        self.packet_type = struct.unpack("B", self.buf[0:1])[0]
+        self.packet_type = struct.unpack_from("B", self.buf)[0]
 
         if self._packet_type and self.packet_type != self._packet_type:
             raise ChordException("Expecting packet type [{}] but got [{}]."\
@@ -64,6 +65,19 @@ class ChordMessage(object):
 
         return nbuf
 
+    def _join(self, parts):
+        "Sets and returns the message encoded as the concatenation of parts,"\
+        " the list of encoded fields starting with the packet_type. join()"\
+        " sizes the buffer exactly once and copies each (possibly large) value"\
+        " into it once, where growing a bytearray field by field copies the"\
+        " values again through every length + value concatenation."
+
+        nbuf = b"".join(parts)
+
+        self.buf = nbuf
+
+        return nbuf
+
 class ChordRelay(ChordMessage):
     def __init__(self, buf = None):
         self.index = None
@@ -76,29 +90,111 @@ class ChordRelay(ChordMessage):
         raise Exception("No more such property.")
 
     def encode(self):
-        nbuf = super().encode()
-        nbuf += struct.pack(">L", self.index)
+        packets = self.packets
 
-        nbuf += struct.pack(">L", len(self.packets))
-        for packet in self.packets:
-            nbuf += sshtype.encodeBinary(packet)
+        parts = [struct.pack(">BLL", self.packet_type, self.index,\
+            len(packets))]
+        for packet in packets:
+            parts.append(struct.pack(">L", len(packet)))
+            parts.append(packet)
 
-        return nbuf
+        return self._join(parts)
 
     def parse(self):
         super().parse()
         i = 1
-        self.index = struct.unpack(">L", self.buf[i:i+4])[0]
-        i += 4
+        self.index, cnt = struct.unpack_from(">LL", self.buf, i)
+        i += 8
 
-        cnt = struct.unpack(">L", self.buf[i:i+4])[0]
-        i += 4
         self.packets = []
         for n in range(cnt):
-            l, packet = sshtype.parseBinary(self.buf[i:])
-            i += l
+            i, packet = sshtype.parse_binary_from(self.buf, i)
             self.packets.append(packet)
 
+class ChordRelayPath(ChordMessage):
+    "Flat replacement of nested ChordRelay packets. The path is encoded as a"\
+    " run of (packet_type, index) hops followed by the payload, so the packet"\
+    " after the first hop is itself a ChordRelayPath (or the bare payload),"\
+    " and an intermediate node forwards it by slicing its hop off the front"\
+    " without copying or re-encoding anything."
+
+    hop_size = 5
+
+    def __init__(self, buf=None):
+        self.path = None # [index, ...].
+        self.payload = None
+
+        super().__init__(CHORD_MSG_RELAY_PATH, buf)
+
+    @property
+    def index(self):
+        return self.path[0]
+
+    @property
+    def packets(self):
+        "The packet to forward for the first hop, as with ChordRelay."
+
+        rest = memoryview(self.buf)[self.hop_size:]
+        return [rest] if rest else []
+
+    def encode(self):
+        parts = [struct.pack(">BL", CHORD_MSG_RELAY_PATH, index)\
+            for index in self.path]
+
+        if self.payload:
+            parts.append(self.payload)
+
+        return self._join(parts)
+
+    def parse(self):
+        super().parse()
+
+        buf = self.buf
+        l = len(buf)
+        i = 0
+
+        self.path = path = []
+        while i < l and buf[i] == CHORD_MSG_RELAY_PATH:
+            if l - i < self.hop_size:
+                raise ChordException("Truncated ChordRelayPath hop.")
+            path.append(struct.unpack_from(">L", buf, i + 1)[0])
+            i += self.hop_size
+
+        self.payload = memoryview(buf)[i:] if i < l else None
+
+def parse_relay(buf):
+    "Returns the ChordRelay or ChordRelayPath in buf."
+
+    if ChordMessage.parse_type(buf) == CHORD_MSG_RELAY_PATH:
+        return ChordRelayPath(buf)
+    return ChordRelay(buf)
+
+def encode_nested_relay(path, payload=None):
+    "Returns the same packet as wrapping the optional payload in a ChordRelay"\
+    " for each index of the (non empty) path, the last index innermost, but"\
+    " encoded in one pass instead of re-encoding the whole packet for every"\
+    " hop."
+
+    # Each ChordRelay is packet_type, index, packet count, then the length of
+    # the one packet it holds; only the innermost can hold none.
+    remaining = len(payload) if payload else None
+
+    parts = []
+    for index in reversed(path):
+        if remaining is None:
+            parts.append(struct.pack(">BLL", CHORD_MSG_RELAY, index, 0))
+            remaining = 9
+        else:
+            parts.append(\
+                struct.pack(">BLLL", CHORD_MSG_RELAY, index, 1, remaining))
+            remaining += 13
+
+    parts.reverse()
+    if payload:
+        parts.append(payload)
+
+    return b"".join(parts)
+
 class ChordNodeInfo(ChordMessage):
     def __init__(self, buf = None):
         self.sender_address = ""
@@ -107,12 +203,14 @@ class ChordNodeInfo(ChordMessage):
         super().__init__(CHORD_MSG_NODE_INFO, buf)
 
     def encode(self):
-        nbuf = super().encode()
+        sender_address = self.sender_address.encode()
+        version = self.version.encode()
 
-        nbuf += sshtype.encodeString(self.sender_address)
-        nbuf += sshtype.encodeString(self.version)
-
-        return nbuf
+        return self._join([\
+            struct.pack(">BL", self.packet_type, len(sender_address)),\
+            sender_address,\
+            struct.pack(">L", len(version)),\
+            version])
 
     def parse(self):
         super().parse()
@@ -132,17 +230,14 @@ class ChordGetPeers(ChordMessage):
         super().__init__(CHORD_MSG_GET_PEERS, buf)
 
     def encode(self):
-        nbuf = super().encode()
-
-        nbuf += struct.pack(">L", self.sender_port)
-
-        return nbuf
+        return self._join(\
+            [struct.pack(">BL", self.packet_type, self.sender_port)])
 
     def parse(self):
         super().parse()
 
         i = 1
-        self.sender_port = struct.unpack(">L", self.buf[i:i+4])[0]
+        self.sender_port = struct.unpack_from(">L", self.buf, i)[0]
 
 class ChordPeerList(ChordMessage):
     def __init__(self, buf=None, peers=None):
@@ -151,35 +246,37 @@ class ChordPeerList(ChordMessage):
         super().__init__(CHORD_MSG_PEER_LIST, buf)
 
     def encode(self):
-        nbuf = super().encode()
-        nbuf += struct.pack(">L", len(self.peers))
+        parts = [struct.pack(">BL", self.packet_type, len(self.peers))]
         for peer in self.peers:
-            nbuf += sshtype.encodeString(peer.address)
-            nbuf += sshtype.encodeBinary(peer.node_id)
+            address = peer.address.encode()
             if type(peer) is mnpeer.Peer:
-                nbuf += sshtype.encodeBinary(peer.node_key.asbytes())
+                pubkey = peer.node_key.asbytes()
             else:
                 assert type(peer) is Peer
-                nbuf += sshtype.encodeBinary(peer.pubkey)
+                pubkey = peer.pubkey
 
-        return nbuf
+            parts.append(struct.pack(">L", len(address)))
+            parts.append(address)
+            parts.append(struct.pack(">L", len(peer.node_id)))
+            parts.append(peer.node_id)
+            parts.append(struct.pack(">L", len(pubkey)))
+            parts.append(pubkey)
+
+        return self._join(parts)
 
     def parse(self):
         super().parse()
         i = 1
-        pcnt = struct.unpack(">L", self.buf[i:i+4])[0]
+        pcnt = struct.unpack_from(">L", self.buf, i)[0]
         i += 4
         self.peers = []
         for n in range(pcnt):
             if log.isEnabledFor(logging.DEBUG):
                 log.debug("Reading record {}.".format(n))
             peer = Peer() # db.Peer.
-            l, peer.address = sshtype.parseString(self.buf[i:])
-            i += l
-            l, peer.node_id = sshtype.parseBinary(self.buf[i:])
-            i += l
-            l, peer.pubkey = sshtype.parseBinary(self.buf[i:])
-            i += l
+            i, peer.address = sshtype.parse_string_from(self.buf, i)
+            i, peer.node_id = sshtype.parse_binary_from(self.buf, i)
+            i, peer.pubkey = sshtype.parse_binary_from(self.buf, i)
 
             self.peers.append(peer)
 
@@ -194,27 +291,27 @@ class ChordFindNode(ChordMessage):
         super().__init__(CHORD_MSG_FIND_NODE, buf)
 
     def encode(self):
-        nbuf = super().encode()
-        nbuf += sshtype.encodeBinary(self.node_id)
-        nbuf += struct.pack("B", self.data_mode.value)
+        parts = [\
+            struct.pack(">BL", self.packet_type, len(self.node_id)),\
+            self.node_id,\
+            struct.pack("B?", self.data_mode.value, self.version is not None)]
 
-        nbuf += struct.pack("?", self.version is not None)
         if self.version is not None:
-            nbuf += sshtype.encodeMpint(self.version)
+            parts.append(sshtype.encodeMpint(self.version))
 
         if self.significant_bits:
-            nbuf += struct.pack(">H", self.significant_bits)
+            parts.append(struct.pack(">H", self.significant_bits))
             if self.target_key:
-                nbuf += sshtype.encodeBinary(self.target_key)
+                parts.append(struct.pack(">L", len(self.target_key)))
+                parts.append(self.target_key)
 
-        return nbuf
+        return self._join(parts)
 
     def parse(self):
         super().parse()
         i = 1
-        l, self.node_id = sshtype.parseBinary(self.buf[i:])
-        i += l
-        self.data_mode = DataMode(struct.unpack("B", self.buf[i:i+1])[0])
+        i, self.node_id = sshtype.parse_binary_from(self.buf, i)
+        self.data_mode = DataMode(struct.unpack_from("B", self.buf, i)[0])
         i += 1
 
         has_version = struct.unpack_from("?", self.buf, i)[0]
@@ -225,7 +322,7 @@ class ChordFindNode(ChordMessage):
         if i == len(self.buf):
             return
 
-        self.significant_bits = struct.unpack(">H", self.buf[i:i+2])[0]
+        self.significant_bits = struct.unpack_from(">H", self.buf, i)[0]
         i += 2
 
         if i == len(self.buf):
@@ -257,41 +354,38 @@ class ChordDataResponse(ChordMessage):
         super().__init__(CHORD_MSG_DATA_RESPONSE, buf)
 
     def encode(self):
-        nbuf = super().encode()
-        nbuf += sshtype.encodeBinary(self.data)
-        nbuf += struct.pack(">L", self.original_size)
+        parts = [\
+            struct.pack(">BL", self.packet_type, len(self.data)),\
+            self.data,\
+            struct.pack(">L", self.original_size)]
 
         if self.version is not None:
-            nbuf += sshtype.encodeMpint(self.version)
-            nbuf += sshtype.encodeBinary(self.signature)
+            parts.append(sshtype.encodeMpint(self.version))
+            parts.append(sshtype.encodeBinary(self.signature))
             if self.epubkey:
-                nbuf += sshtype.encodeBinary(self.epubkey)
-                nbuf += struct.pack(">L", self.pubkeylen)
+                parts.append(sshtype.encodeBinary(self.epubkey))
+                parts.append(struct.pack(">L", self.pubkeylen))
 
-        return nbuf
+        return self._join(parts)
 
     def parse(self):
         super().parse()
         i = 1
-        l, self.data = sshtype.parseBinary(self.buf[i:])
-        i += l
-        self.original_size = struct.unpack(">L", self.buf[i:i+4])[0]
+        i, self.data = sshtype.parse_binary_from(self.buf, i)
+        self.original_size = struct.unpack_from(">L", self.buf, i)[0]
         i += 4
 
         if i == len(self.buf):
             return
 
-        l, self.version = sshtype.parseMpint(self.buf[i:])
-        i += l
-        l, self.signature = sshtype.parseBinary(self.buf[i:])
-        i += l
+        i, self.version = sshtype.parse_mpint_from(self.buf, i)
+        i, self.signature = sshtype.parse_binary_from(self.buf, i)
 
         if i == len(self.buf):
             return
 
-        l, self.epubkey = sshtype.parseBinary(self.buf[i:])
-        i += l
-        self.pubkeylen = struct.unpack(">L", self.buf[i:i+4])[0]
+        i, self.epubkey = sshtype.parse_binary_from(self.buf, i)
+        self.pubkeylen = struct.unpack_from(">L", self.buf, i)[0]
 
 class ChordDataPresence(ChordMessage):
     def __init__(self, buf = None):
@@ -301,22 +395,22 @@ class ChordDataPresence(ChordMessage):
         super().__init__(CHORD_MSG_DATA_PRESENCE, buf)
 
     def encode(self):
-        nbuf = super().encode()
         if self.first_id is None:
-            nbuf += struct.pack("?", self.data_present)
-        else:
-            nbuf += sshtype.encodeBinary(self.first_id)
+            return self._join(\
+                [struct.pack("B?", self.packet_type, self.data_present)])
 
-        return nbuf
+        return self._join([\
+            struct.pack(">BL", self.packet_type, len(self.first_id)),\
+            self.first_id])
 
     def parse(self):
         super().parse()
         i = 1
 
         if i + 1 == len(self.buf):
-            self.data_present = struct.unpack("?", self.buf[i:i+1])[0]
+            self.data_present = struct.unpack_from("?", self.buf, i)[0]
         else:
-            l, self.first_id = sshtype.parseBinary(self.buf[i:])
+            i, self.first_id = sshtype.parse_binary_from(self.buf, i)
 
 class ChordStoreData(ChordMessage):
     def __init__(self, buf = None):
@@ -335,37 +429,34 @@ class ChordStoreData(ChordMessage):
         raise Exception("No more such property.")
 
     def encode(self):
-        nbuf = super().encode()
-        nbuf += sshtype.encodeBinary(self.data)
-        nbuf += struct.pack("?", self.targeted)
+        parts = [\
+            struct.pack(">BL", self.packet_type, len(self.data)),\
+            self.data,\
+            struct.pack("?", self.targeted)]
 
         if self.pubkey:
             # Updateable keys.
-            nbuf += sshtype.encodeBinary(self.pubkey)
-            nbuf += sshtype.encodeBinary(self.path_hash)
-            nbuf += sshtype.encodeMpint(self.version)
-            nbuf += sshtype.encodeBinary(self.signature)
+            parts.append(sshtype.encodeBinary(self.pubkey))
+            parts.append(sshtype.encodeBinary(self.path_hash))
+            parts.append(sshtype.encodeMpint(self.version))
+            parts.append(sshtype.encodeBinary(self.signature))
 
-        return nbuf
+        return self._join(parts)
 
     def parse(self):
         super().parse()
         i = 1
-        l, self.data = sshtype.parseBinary(self.buf[i:])
-        i += l
+        i, self.data = sshtype.parse_binary_from(self.buf, i)
         self.targeted = struct.unpack_from("?", self.buf, i)[0]
         i += 1
 
         if i == len(self.buf):
             return
 
-        l, self.pubkey = sshtype.parseBinary(self.buf[i:])
-        i += l
-        l, self.path_hash = sshtype.parseBinary(self.buf[i:])
-        i += l
-        l, self.version = sshtype.parseMpint(self.buf[i:])
-        i += l
-        l, self.signature = sshtype.parseBinary(self.buf[i:])
+        i, self.pubkey = sshtype.parse_binary_from(self.buf, i)
+        i, self.path_hash = sshtype.parse_binary_from(self.buf, i)
+        i, self.version = sshtype.parse_mpint_from(self.buf, i)
+        i, self.signature = sshtype.parse_binary_from(self.buf, i)
 
 class ChordStoreKey(ChordMessage):
     def __init__(self, buf = None):
@@ -375,17 +466,15 @@ class ChordStoreKey(ChordMessage):
         super().__init__(CHORD_MSG_STORE_KEY, buf)
 
     def encode(self):
-        nbuf = super().encode()
-        nbuf += sshtype.encodeBinary(self.data)
-        nbuf += struct.pack("?", self.targeted)
-
-        return nbuf
+        return self._join([\
+            struct.pack(">BL", self.packet_type, len(self.data)),\
+            self.data,\
+            struct.pack("?", self.targeted)])
 
     def parse(self):
         super().parse()
         i = 1
-        l, self.data = sshtype.parseBinary(self.buf[i:])
-        i += l
+        i, self.data = sshtype.parse_binary_from(self.buf, i)
         self.targeted = struct.unpack_from("?", self.buf, i)[0]
 
 class ChordDataStored(ChordMessage):
@@ -395,15 +484,12 @@ class ChordDataStored(ChordMessage):
         super().__init__(CHORD_MSG_DATA_STORED, buf)
 
     def encode(self):
-        nbuf = super().encode()
-        nbuf += struct.pack("?", self.stored)
-
-        return nbuf
+        return self._join([struct.pack("B?", self.packet_type, self.stored)])
 
     def parse(self):
         super().parse()
         i = 1
-        self.stored = struct.unpack("?", self.buf[i:i+1])[0]
+        self.stored = struct.unpack_from("?", self.buf, i)[0]
 
 class ChordStorageInterest(ChordMessage):
     def __init__(self, buf = None):
@@ -412,12 +498,10 @@ class ChordStorageInterest(ChordMessage):
         super().__init__(CHORD_MSG_STORAGE_INTEREST, buf)
 
     def encode(self):
-        nbuf = super().encode()
-        nbuf += struct.pack("?", self.will_store)
-
-        return nbuf
+        return self._join(\
+            [struct.pack("B?", self.packet_type, self.will_store)])
 
     def parse(self):
         super().parse()
         i = 1
-        self.will_store = struct.unpack("?", self.buf[i:i+1])[0]
+        self.will_store = struct.unpack_from("?", self.buf, i)[0]
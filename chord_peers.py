@@ -0,0 +1,299 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+# An in-memory copy of the Peer table. It is loaded once at start, after which
+# the connection management code only reads it from memory. Changes to known
+# PeerS are marked dirty and written back in one transaction every
+# FLUSH_DELAY seconds. Only new PeerS are inserted right away, as their id is
+# needed. The engine is the only writer of the Peer table, so the copy stays
+# authoritative.
+
+import llog
+
+import asyncio
+import logging
+import random
+
+from db import Peer
+import enc
+import xordist
+
+log = logging.getLogger(__name__)
+
+FLUSH_DELAY = 5
+
+# The columns written back for a dirty Peer.
+_COLUMNS = ("node_id", "pubkey", "distance", "direction", "address",\
+    "connected", "last_connect_attempt")
+
+class PeerDirectory(object):
+    def __init__(self, engine, node_id_bits):
+        self.engine = engine
+        self.loop = engine.loop
+
+        self.peers = {} # {id: Peer}
+        self.by_address = {} # {address: [Peer]}
+        self.by_node_id = {} # {node_id: Peer}
+        self.buckets = [set() for i in range(node_id_bits)] # [{Peer}]
+
+        self.dirty = set() # {Peer}
+        self.deleted = set() # {id}
+
+        self._flush_handle = None
+
+    def __len__(self):
+        return len(self.peers)
+
+    @asyncio.coroutine
+    def load(self):
+        def dbcall():
+            with self.engine.node.db.open_session(True) as sess:
+                r = sess.query(Peer).all()
+                sess.expunge_all()
+                return r
+
+        dbpeers = yield from self.loop.run_in_executor(None, dbcall)
+
+        for dbpeer in dbpeers:
+            self.peers[dbpeer.id] = dbpeer
+            self._index(dbpeer)
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Loaded [{}] PeerS into memory.".format(len(self.peers)))
+
+    def _index(self, dbpeer):
+        if dbpeer.address:
+            self.by_address.setdefault(dbpeer.address, []).append(dbpeer)
+        if dbpeer.node_id:
+            self.by_node_id.setdefault(dbpeer.node_id, dbpeer)
+        if dbpeer.distance:
+            self.buckets[dbpeer.distance - 1].add(dbpeer)
+
+    def _unindex(self, dbpeer):
+        if dbpeer.address:
+            lst = self.by_address.get(dbpeer.address)
+            if lst:
+                if dbpeer in lst:
+                    lst.remove(dbpeer)
+                if not lst:
+                    del self.by_address[dbpeer.address]
+        if dbpeer.node_id:
+            if self.by_node_id.get(dbpeer.node_id) is dbpeer:
+                del self.by_node_id[dbpeer.node_id]
+        if dbpeer.distance:
+            self.buckets[dbpeer.distance - 1].discard(dbpeer)
+
+    def get(self, dbid):
+        return self.peers.get(dbid)
+
+    def find_by_address(self, address):
+        lst = self.by_address.get(address)
+        return lst[0] if lst else None
+
+    def find_by_node_id(self, node_id):
+        return self.by_node_id.get(node_id)
+
+    def closest_unconnected_distance(self):
+        "Returns the lowest distance of a known but unconnected Peer, or None."
+
+        for i, bucket in enumerate(self.buckets):
+            for dbpeer in bucket:
+                if not dbpeer.connected:
+                    return i + 1
+
+        return None
+
+    def select_unconnected(self, distance, count, grace):
+        "Returns upto count unconnected PeerS at distance whose last connect"\
+        " attempt is older than grace, those never attempted first, otherwise"\
+        " in random order."
+
+        candidates = [dbpeer for dbpeer in self.buckets[distance - 1]\
+            if not dbpeer.connected\
+                and (dbpeer.last_connect_attempt is None\
+                    or dbpeer.last_connect_attempt < grace)]
+
+        random.shuffle(candidates)
+        candidates.sort(key=lambda x: x.last_connect_attempt is not None)
+
+        return candidates[:count]
+
+    @asyncio.coroutine
+    def add_peers(self, peers, node_id):
+        "Inserts the PeerS that are not already known, deduped by node_id, or"\
+        " if they have no pubkey then by address. Returns the list of the"\
+        " inserted ones. node_id: Our node_id, to calculate distances from."
+
+        batch = []
+
+        for peer in peers:
+            assert type(peer) is Peer
+
+            if peer.pubkey:
+                assert peer.node_id is None
+                peer.node_id = enc.generate_ID(peer.pubkey)
+                peer.distance, peer.direction =\
+                    xordist.log_distance(node_id, peer.node_id)
+                known = peer.node_id in self.by_node_id
+            elif peer.address:
+                assert peer.node_id is None
+                known = peer.address in self.by_address
+            else:
+                continue
+
+            if known:
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Peer [{}] already in list."\
+                        .format(peer.address))
+                continue
+
+            peer.connected = False
+
+            if log.isEnabledFor(logging.INFO):
+                log.info("Adding Peer [{}].".format(peer.address))
+
+            # Indexed before the insert so that PeerS arriving meanwhile are
+            # seen as known.
+            self._index(peer)
+            batch.append(peer)
+
+        if not batch:
+            return batch
+
+        yield from self._insert(batch)
+
+        return batch
+
+    @asyncio.coroutine
+    def add_peer(self, dbpeer):
+        "Inserts the Peer, which the caller has checked is not known."
+
+        self._index(dbpeer)
+        yield from self._insert([dbpeer])
+
+    @asyncio.coroutine
+    def _insert(self, batch):
+        def dbcall():
+            with self.engine.node.db.open_session() as sess:
+                sess.add_all(batch)
+                sess.commit()
+                for dbpeer in batch:
+                    fetch_id_in_thread = dbpeer.id
+                sess.expunge_all()
+
+        try:
+            yield from self.loop.run_in_executor(None, dbcall)
+        except Exception:
+            for dbpeer in batch:
+                self._unindex(dbpeer)
+            raise
+
+        for dbpeer in batch:
+            self.peers[dbpeer.id] = dbpeer
+
+    def set_node_id(self, dbpeer, node_id, pubkey, distance, direction):
+        self._unindex(dbpeer)
+
+        dbpeer.node_id = node_id
+        dbpeer.pubkey = pubkey
+        dbpeer.distance = distance
+        dbpeer.direction = direction
+
+        self._index(dbpeer)
+        self.mark_dirty(dbpeer)
+
+    def set_address(self, dbpeer, address):
+        self._unindex(dbpeer)
+        dbpeer.address = address
+        self._index(dbpeer)
+        self.mark_dirty(dbpeer)
+
+    def delete(self, dbpeer):
+        if self.peers.pop(dbpeer.id, None) is None:
+            return
+
+        self._unindex(dbpeer)
+        self.dirty.discard(dbpeer)
+        self.deleted.add(dbpeer.id)
+
+        self._schedule_flush()
+
+    def mark_dirty(self, dbpeer):
+        if dbpeer.id not in self.peers:
+            # Deleted in the mean time.
+            return
+
+        self.dirty.add(dbpeer)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle:
+            return
+
+        self._flush_handle = self.loop.call_later(\
+            FLUSH_DELAY, self._async_flush)
+
+    def _async_flush(self):
+        asyncio.async(self.flush(), loop=self.loop)
+
+    def _take_changes(self):
+        self._flush_handle = None
+
+        rows = [(dbpeer.id, {name: getattr(dbpeer, name) for name in _COLUMNS})\
+            for dbpeer in self.dirty]
+        deleted = list(self.deleted)
+
+        self.dirty.clear()
+        self.deleted.clear()
+
+        return rows, deleted
+
+    def _write(self, rows, deleted):
+        with self.engine.node.db.open_session() as sess:
+            for dbid, values in rows:
+                sess.query(Peer).filter(Peer.id == dbid)\
+                    .update(values, synchronize_session=False)
+
+            if deleted:
+                sess.query(Peer).filter(Peer.id.in_(deleted))\
+                    .delete(synchronize_session=False)
+
+            sess.commit()
+
+    @asyncio.coroutine
+    def flush(self):
+        "Writes all pending changes in one transaction."
+
+        rows, deleted = self._take_changes()
+        if not rows and not deleted:
+            return
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Writing back [{}] changed and [{}] deleted PeerS."\
+                .format(len(rows), len(deleted)))
+
+        try:
+            yield from self.loop.run_in_executor(\
+                None, self._write, rows, deleted)
+        except Exception:
+            log.exception("PeerDirectory._write(..)")
+
+            # Try again later, unless they were changed again meanwhile.
+            for dbid, values in rows:
+                dbpeer = self.peers.get(dbid)
+                if dbpeer:
+                    self.dirty.add(dbpeer)
+            self.deleted.update(deleted)
+            self._schedule_flush()
+
+    def stop(self):
+        "Synchronously writes all pending changes, as the loop is stopping."
+
+        if self._flush_handle:
+            self._flush_handle.cancel()
+
+        rows, deleted = self._take_changes()
+        if not rows and not deleted:
+            return
+
+        self._write(rows, deleted)
@@ -4,32 +4,86 @@
 import llog
 
 import asyncio
-from collections import namedtuple
+from collections import deque, namedtuple
 from concurrent import futures
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 import math
-import os
 import random
+import time
 
 from sqlalchemy import func
 
 import bittrie
+import blockcache
 import chord
 import chord_packet as cp
 from chordexception import ChordException
-from db import Peer, DataBlock, NodeState
+from db import Peer, DataBlock
 import mbase32
 import multipart as mp
 import mutil
 import enc
+from negcache import NegativeCache
 import node as mnnode
 import peer as mnpeer
 import rsakey
+import scrubber
+from singleflight import SingleFlight
 import sshtype
+import storeworker
+import xordist
 
 log = logging.getLogger(__name__)
 
+# PeerS from this version on understand ChordRelayPath.
+RELAY_PATH_MIN_VERSION = (0, 8, 19)
+
+# The waits in send_find_node are derived from the RTTs measured to the PeerS
+# and tunnels queried, bounded by the following. Tunnels are given upto
+# TUNNEL_OPEN_TIMEOUT seconds to open, each depth step upto STEP_TIMEOUT for a
+# first response and then upto STRAGGLER_TIMEOUT * retry_factor for the rest.
+TUNNEL_OPEN_TIMEOUT = 7.0
+STEP_TIMEOUT = 1.0
+STRAGGLER_TIMEOUT = 0.1
+# The waits are never shorter than this fraction of the above.
+MIN_TIMEOUT_FRACTION = 0.1
+# In tormode the above are multiplied by this, as Tor circuits are slow.
+TOR_TIMEOUT_FACTOR = 5
+
+# Data not found is not searched for again for MISSING_DATA_TTL seconds,
+# doubling with each consecutive miss upto MISSING_DATA_MAX_TTL, unless with a
+# higher retry_factor than the misses had. Likewise for PeerS we failed to
+# open a channel to, which are then used only if there are no others.
+MISSING_DATA_TTL = 5
+MISSING_DATA_MAX_TTL = 300
+FAILED_TUNNEL_TTL = 30
+FAILED_TUNNEL_MAX_TTL = 600
+
+# Seconds to wait for the response to a GetData, plus a tenth per retry_factor.
+GET_DATA_TIMEOUT = 1
+
+# A GetData is hedged with a second one to the next holder after the
+# HEDGE_PERCENTILE of the last HEDGE_SAMPLES GetData latencies, or after half
+# its timeout until there are HEDGE_MIN_SAMPLES; but never before
+# HEDGE_MIN_DELAY seconds.
+HEDGE_PERCENTILE = 0.9
+HEDGE_SAMPLES = 64
+HEDGE_MIN_SAMPLES = 8
+HEDGE_MIN_DELAY = 0.05
+
+def _parse_version(version):
+    "Returns the morphis version string a Peer reported as a tuple, or None."
+
+    try:
+        return tuple(int(v) for v in version.split('.'))
+    except (AttributeError, ValueError):
+        return None
+
+def _relay_path_supported(peer):
+    version = _parse_version(peer.version)
+    return version is not None and version >= RELAY_PATH_MIN_VERSION
+
 class Counter(object):
     def __init__(self, value=None):
         self.value = value
@@ -50,6 +104,8 @@ class DataResponseWrapper(object):
         self.data_present_cnt = 0
         self.will_store_cnt = 0
         self.storing_nodes = 0
+        # (TunnelMeta, path) of the DataResponse that the data came from.
+        self.source = None
 
 class TunnelMeta(object):
     def __init__(self, peer=None, jobs=None):
@@ -60,6 +116,8 @@ class TunnelMeta(object):
         self.local_cid = None
         self.jobs = jobs
         self.task_running = False
+        # {path: time.monotonic() the FindNode was relayed to it}.
+        self.sent_times = {}
 
 class VPeer(object):
     def __init__(self, peer=None, path=None, tun_meta=None):
@@ -87,6 +145,45 @@ class ChordTasks(object):
         self.last_peer_add_time = None
         self.add_peer_memory_cache = {} # {Peer.address, Peer}
 
+        # Maximum bucket FindNodeS run at once by perform_stabilize().
+        self.stabilize_concurrency = 4
+        # Buckets that a FindNode went into less than this many seconds ago
+        # are skipped by perform_stabilize().
+        self.bucket_refresh_interval = 300
+        # [time.monotonic() of the last FindNode into each bucket, or None.]
+        self.bucket_refresh_times = [None] * chord.NODE_ID_BITS
+
+        # Stats of the last perform_stabilize() pass.
+        self.stabilize_count = 0
+        self.last_stabilize_duration = None # Seconds.
+        self.last_stabilize_lookups = 0
+        self.last_stabilize_skipped = 0
+
+        # Concurrent identical requests share one in flight call.
+        self.get_data_flights = SingleFlight(self.loop, "send_get_data")
+        self.find_key_flights = SingleFlight(self.loop, "send_find_key")
+        self.check_data_flights = SingleFlight(self.loop, "_check_has_data")
+        self.retrieve_data_flights = SingleFlight(self.loop, "_retrieve_data")
+
+        # Seconds the recent successful GetDataS took.
+        self.get_data_latencies = deque(maxlen=HEDGE_SAMPLES)
+        # Stats of the GetData stage of send_find_node.
+        self.get_data_count = 0
+        self.get_data_hedged = 0
+        self.get_data_hedge_wins = 0
+
+        # Recent failures, so that retries don't flood the same tunnels.
+        self.missing_data = NegativeCache(\
+            MISSING_DATA_TTL, MISSING_DATA_MAX_TTL, "missing data")
+        self.failed_tunnels = NegativeCache(\
+            FAILED_TUNNEL_TTL, FAILED_TUNNEL_MAX_TTL, "tunnel open")
+
+        # Decrypted blocks recently fetched, served before asking the network.
+        self.block_cache = blockcache.BlockCache()
+        # Encrypted blocks recently fetched, served to other nodes as well.
+        self.transit_cache = blockcache.TransitCache(\
+            engine.node_id, engine.node.transit_cache_max_size)
+
     @asyncio.coroutine
     def send_node_info(self, peer):
         log.info("Sending ChordNodeInfo message.")
@@ -124,15 +221,18 @@ class ChordTasks(object):
 
     @asyncio.coroutine
     def perform_stabilize(self):
-        found_new_nodes = False
-
         if not self.engine.peers:
             log.info("No connected nodes, unable to perform stabilize.")
             return
 
+        start = time.monotonic()
+        lookups = 0
+        found_new_nodes = False
+
         # Fetch closest to ourselves.
         closest_nodes, new_nodes = yield from\
             self._perform_stabilize(self.engine.node_id, self.engine.peer_trie)
+        lookups += 1
 
         found_new_nodes |= new_nodes
 
@@ -145,6 +245,7 @@ class ChordTasks(object):
             node_id[i] = (~node_id[i]) & 0xFF
 
         furthest_nodes, new_nodes = yield from self._perform_stabilize(node_id)
+        lookups += 1
 
         found_new_nodes |= new_nodes
 
@@ -158,73 +259,116 @@ class ChordTasks(object):
             if closest_found_distance is chord.NODE_ID_BITS:
                 log.info("Don't know how close a bucket to stop at so not"\
                     " searching inbetween closest and furthest.")
+                self._record_stabilize(start, lookups, 0)
                 return
 
-#        closest_found_distance = 0
-#        log.warning("Stabilize FindNode id=[{:0512b}]."\
-#            .format(int.from_bytes(self.engine.node_id, "big")))
+        # Refresh each bucket from the furthest down to the closest that we
+        # found above, skipping those that FindNodeS went into recently.
+        now = time.monotonic()
+        buckets = []
+        skipped = 0
+
+        for bit in range(chord.NODE_ID_BITS-1, closest_found_distance-2, -1):
+            last = self.bucket_refresh_times[bit]
+            if last is not None and now - last < self.bucket_refresh_interval:
+                skipped += 1
+                continue
+
+            buckets.append(bit)
+
+        # The sparsest buckets first; stable, so furthest first otherwise.
+        peer_buckets = self.engine.peer_buckets
+        buckets.sort(key=lambda bit: len(peer_buckets[bit]))
 
-        # Fetch each bucket starting at furthest, stopping when we get to the
-        # closest that we found above.
-        orig_node_id = self.engine.node_id
+        running = []
+
+        for bit in buckets:
+            if len(running) == self.stabilize_concurrency:
+                done, pending = yield from asyncio.wait(\
+                    running, loop=self.loop,\
+                    return_when=futures.FIRST_COMPLETED)
+
+                running = list(pending)
+                found_new_nodes |= self._stabilize_results(done)
 
-        for bit in range(chord.NODE_ID_BITS-1, -1, -1):
             if log.isEnabledFor(logging.INFO):
                 log.info("Performing FindNode for bucket [{}]."\
                     .format(bit+1))
 
-            node_id = bytearray(orig_node_id)
-
-            # Change the most significant bit so that the resulting id is
-            # inside the bucket for said bit difference.
-            byte_ = chord.NODE_ID_BYTES - 1 - (bit >> 3)
-            bit_pos = bit % 8
-            node_id[byte_] ^= 1 << bit_pos
-
-            # Randomize the remaining less significant bits so that we are
-            # performing a FindNode for a random ID within the bucket.
-            if bit_pos:
-                bit_mask = 1 << (bit_pos - 1)
-                bit_mask ^= bit_mask - 1
-                node_id[byte_] ^= random.randint(0, 255) & bit_mask
-
-            for i in range(byte_ + 1, chord.NODE_ID_BYTES):
-                node_id[i] ^= random.randint(0, 255)
-
-#            log.warning("Stabilize FindNode id=[{:0512b}]."\
-#                .format(int.from_bytes(node_id, "big")))
-
-            assert mutil.calc_log_distance(\
-                node_id, self.engine.node_id)[0] == (bit + 1),\
-                "calc={}, bit={}, diff={}."\
-                    .format(\
-                        mutil.calc_log_distance(\
-                            node_id, self.engine.node_id)[0],\
-                        bit + 1,
-                        mutil.hex_string(\
-                            mutil.calc_raw_distance(\
-                                self.engine.node_id, node_id)))
+            node_id = self._generate_bucket_id(bit)
 
-            nodes, new_nodes = yield from self._perform_stabilize(node_id)
-            found_new_nodes |= new_nodes
+            running.append(asyncio.async(\
+                self._perform_stabilize(node_id), loop=self.loop))
+            lookups += 1
 
-            if not closest_found_distance and not nodes:
-                break
-            elif bit+1 == closest_found_distance:
-                break;
+        if running:
+            done, pending = yield from asyncio.wait(running, loop=self.loop)
+            found_new_nodes |= self._stabilize_results(done)
 
-        if new_nodes:
+        self._record_stabilize(start, lookups, skipped)
+
+        if found_new_nodes:
             log.info("Finished total stabilize, checking connections.")
             yield from self.engine.process_connection_count()
 
+    def _record_stabilize(self, start, lookups, skipped):
+        self.stabilize_count += 1
+        self.last_stabilize_duration = time.monotonic() - start
+        self.last_stabilize_lookups = lookups
+        self.last_stabilize_skipped = skipped
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Stabilize took [{:.2f}] seconds, performing [{}]"\
+                " FindNodeS and skipping [{}] recently refreshed buckets."\
+                    .format(self.last_stabilize_duration, lookups, skipped))
+
+    def _stabilize_results(self, done):
+        "Returns True if any of the done _perform_stabilize(..) tasks found"\
+        " new nodes."
+
+        found_new_nodes = False
+
+        for task in done:
+            try:
+                found_new_nodes |= task.result()[1]
+            except Exception:
+                log.exception("_perform_stabilize(..)")
+
+        return found_new_nodes
+
+    def _generate_bucket_id(self, bit):
+        "Returns a random id inside the bucket of ids that differ from our"\
+        " node_id first at bit."
+
+        # Flip the bit so the id is inside the bucket, and randomize all the
+        # less significant ones.
+        node_id = xordist.to_int(self.engine.node_id) ^ (1 << bit)
+        if bit:
+            node_id ^= random.getrandbits(bit)
+
+        node_id = node_id.to_bytes(chord.NODE_ID_BYTES, "big")
+
+        assert xordist.log_distance(\
+            node_id, self.engine.node_id)[0] == (bit + 1),\
+            "calc={}, bit={}, diff={}."\
+                .format(\
+                    xordist.log_distance(node_id, self.engine.node_id)[0],\
+                    bit + 1,
+                    mutil.hex_string(\
+                        xordist.raw_distance(self.engine.node_id, node_id)))
+
+        return node_id
+
     @asyncio.coroutine
     def _perform_stabilize(self, node_id, input_trie=None):
         "returns: conn_nods, new_nodes"\
         "   conn_nodes: found nodes sorted by closets."\
         "   new_nodes: if any found were new."
 
-        conn_nodes = yield from\
-            self.send_find_node(node_id, input_trie=input_trie)
+        # Its own lookups mustn't stamp the bucket, or the next pass, due
+        # bucket_refresh_interval later, would find it just refreshed.
+        conn_nodes = yield from self.send_find_node(\
+            node_id, input_trie=input_trie, refresh_bucket=False)
 
         if not conn_nodes:
             return None, False
@@ -242,6 +386,23 @@ class ChordTasks(object):
     @asyncio.coroutine
     def send_get_data(self, data_key, path=None, scan_only=False,\
             retry_factor=1):
+        "Concurrent calls for the same data and retry_factor share one"\
+        " lookup, and thus the returned DataResponseWrapper; a higher"\
+        " retry_factor doesn't settle for the result of a lower one."
+
+        if type(path) is str:
+            path_key = path.encode()
+        else:
+            path_key = bytes(path) if path else None
+
+        data_rw = yield from self.get_data_flights.do(\
+            (bytes(data_key), path_key, scan_only, retry_factor),\
+            self._send_get_data, data_key, path, scan_only, retry_factor)
+
+        return data_rw
+
+    @asyncio.coroutine
+    def _send_get_data(self, data_key, path, scan_only, retry_factor):
         assert type(data_key) in (bytes, bytearray)\
             and len(data_key) == chord.NODE_ID_BYTES,\
             "type(data_key)=[{}], len={}."\
@@ -259,12 +420,20 @@ class ChordTasks(object):
 
         data_id = enc.generate_ID(data_key)
 
+        if not scan_only:
+            data_rw = yield from\
+                self._get_data_locally(data_key, data_id, path_hash)
+            if data_rw:
+                return data_rw
+
         data_rw = yield from\
             self.send_find_node(data_id, for_data=True, data_key=data_key,\
                 path_hash=path_hash, scan_only=scan_only,\
                 retry_factor=retry_factor)
 
         if data_rw.data:
+            self.block_cache.put(data_rw)
+
             #FIXME: This is not optimal as we start a whole new FindNode for
             # this. When rewriting this file incorporate this stage into the
             # retrevial process at the end (and have it async just like this).
@@ -317,15 +486,101 @@ class ChordTasks(object):
 
         data_id = enc.generate_ID(data_key)
 
+        data_rw = yield from\
+            self._get_data_locally(data_key, data_id, targeted=True)
+        if data_rw:
+            return data_rw
+
         data_rw = yield from\
             self.send_find_node(data_id, for_data=True, data_key=data_key,\
                 targeted=True, retry_factor=retry_factor)
 
+        if data_rw.data:
+            self.block_cache.put(data_rw)
+
+        return data_rw
+
+    @asyncio.coroutine
+    def _get_data_locally(self, data_key, data_id, path_hash=None,\
+            targeted=False):
+        "Returns a DataResponseWrapper with the data if it is in the"\
+        " block_cache or our own datastore, otherwise None. Updateable keys"\
+        " are only returned if stored within blockcache.UPDATEABLE_MAX_AGE."
+
+        block = self.block_cache.get(data_key, targeted)
+        if block:
+            if log.isEnabledFor(logging.INFO):
+                log.info("Found data_key=[{}] in the block cache."\
+                    .format(mbase32.encode(data_key)))
+
+            data_rw = DataResponseWrapper(data_key)
+            data_rw.data = block.data
+            data_rw.pubkey = block.pubkey
+            data_rw.signature = block.signature
+            data_rw.path_hash = block.path_hash
+            data_rw.version = block.version
+            data_rw.targeted = block.targeted
+            return data_rw
+
+        distance = xordist.raw_distance(self.engine.node_id, data_id)
+        if distance > self.engine.furthest_data_block:
+            return None
+
+        enc_data, data_l, version, signature, epubkey, pubkeylen =\
+            yield from self._retrieve_data(data_id,\
+                timedelta(seconds=blockcache.UPDATEABLE_MAX_AGE))
+
+        if enc_data is None:
+            return None
+
+        drmsg = cp.ChordDataResponse()
+        drmsg.data = enc_data
+        drmsg.original_size = data_l
+        if version is not None:
+            drmsg.version = version
+            drmsg.signature = signature
+            if epubkey:
+                drmsg.epubkey = epubkey
+                drmsg.pubkeylen = pubkeylen
+
+        data_rw = DataResponseWrapper(data_key)
+        if path_hash:
+            data_rw.path_hash = path_hash
+        data_rw.targeted = targeted
+        data_rw.data_done = asyncio.Event(loop=self.loop)
+
+        r = yield from self._process_data_response(drmsg, None, None, data_rw)
+
+        if not r:
+            log.warning("Data from ourselves was invalid!")
+            return None
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Found data_key=[{}] in our own datastore."\
+                .format(mbase32.encode(data_key)))
+
+        self.block_cache.put(data_rw)
+
         return data_rw
 
     @asyncio.coroutine
     def send_find_key(self, data_key_prefix, significant_bits=None,\
             target_key=None, retry_factor=2):
+        "Concurrent calls for the same key and retry_factor share one lookup,"\
+        " and thus the returned DataResponseWrapper; a higher retry_factor"\
+        " doesn't settle for the result of a lower one."
+
+        data_rw = yield from self.find_key_flights.do(\
+            (bytes(data_key_prefix), significant_bits,\
+                bytes(target_key) if target_key else None, retry_factor),\
+            self._send_find_key, data_key_prefix, significant_bits,\
+            target_key, retry_factor)
+
+        return data_rw
+
+    @asyncio.coroutine
+    def _send_find_key(self, data_key_prefix, significant_bits, target_key,\
+            retry_factor):
         assert type(data_key_prefix) in (bytes, bytearray),\
             "type(data_key_prefix)=[{}].".format(type(data_key_prefix))
 
@@ -401,6 +656,9 @@ class ChordTasks(object):
         sdmsg = cp.ChordStoreData()
         sdmsg.data = data
 
+        # Fetch it again from the holders rather than the block_cache.
+        self.block_cache.remove(data_key)
+
         storing_nodes =\
             yield from self.send_find_node(\
                 data_id, for_data=True, data_msg=sdmsg)
@@ -428,6 +686,8 @@ class ChordTasks(object):
         sdmsg.data = data
         sdmsg.targeted = True
 
+        self.block_cache.remove(data_key)
+
         storing_nodes =\
             yield from self.send_find_node(\
                 data_id, for_data=True, data_msg=sdmsg,\
@@ -455,10 +715,12 @@ class ChordTasks(object):
 
         if path:
             path_hash = enc.generate_ID(path)
-            data_id = enc.generate_ID(enc.generate_ID(data_key + path_hash))
+            path_data_key = enc.generate_ID(data_key + path_hash)
         else:
             path_hash = b""
-            data_id = enc.generate_ID(data_key)
+            path_data_key = data_key
+
+        data_id = enc.generate_ID(path_data_key)
 
         if log.isEnabledFor(logging.DEBUG):
             log.debug("data_key=[{}], data_id=[{}]."\
@@ -478,6 +740,10 @@ class ChordTasks(object):
         sdmsg.version = version
         sdmsg.signature = signature
 
+        # Don't keep serving ourselves the old version from the block_cache,
+        # under the data_key send_get_data(..) derives with the path.
+        self.block_cache.remove(path_data_key)
+
         storing_nodes =\
             yield from self.send_find_node(\
                 data_id, for_data=True, data_msg=sdmsg)
@@ -491,12 +757,14 @@ class ChordTasks(object):
     @asyncio.coroutine
     def send_find_node(self, node_id, significant_bits=None, input_trie=None,\
             for_data=False, data_msg=None, data_key=None, path_hash=None,\
-            targeted=False, target_key=None, scan_only=False, retry_factor=1):
+            targeted=False, target_key=None, scan_only=False, retry_factor=1,\
+            refresh_bucket=True):
         "Returns found nodes sorted by closets. If for_data is True then"\
         " this is really {get/store}_data instead of find_node. If data_msg"\
         " is None than it is get_data and the data is returned. Store data"\
         " currently returns the count of nodes that claim to have stored the"\
-        " data."
+        " data. If refresh_bucket is False the lookup doesn't count as a"\
+        " refresh of its bucket for perform_stabilize()."
 
         assert len(node_id) == chord.NODE_ID_BYTES
         # data_key needs to be bytes for PyCrypto usage later on.
@@ -512,14 +780,33 @@ class ChordTasks(object):
             log.info("No connected nodes, unable to send FindNode.")
             return self._generate_fail_response(data_mode, data_key)
 
+        if data_mode is cp.DataMode.get and not scan_only:
+            missing_key = (bytes(node_id), significant_bits,\
+                bytes(target_key) if target_key else None)
+
+            entry = self.missing_data.check(missing_key, retry_factor)
+            if entry:
+                if log.isEnabledFor(logging.INFO):
+                    log.info("Data was not found [{}] times, last with [{}]"\
+                        " probes [{:.1f}] seconds ago (retry_factor=[{}]); not"\
+                        " searching again yet."\
+                            .format(entry.failures, entry.probes,\
+                                time.monotonic() - entry.time,\
+                                entry.retry_factor))
+                return self._generate_fail_response(data_mode, data_key)
+        elif data_mode is cp.DataMode.store:
+            # It won't be missing anymore.
+            self.missing_data.remove((bytes(node_id), None, None))
+
+        # Let perform_stabilize() skip the bucket this lookup refreshes.
+        if refresh_bucket:
+            bucket = xordist.log_distance(self.engine.node_id, node_id)[0]
+            if bucket:
+                self.bucket_refresh_times[bucket - 1] = time.monotonic()
+
         if not input_trie:
-            input_trie = bittrie.BitTrie()
-#            for peer in self.engine.peer_trie:
-            for peer in self.engine.peers.values():
-                if not peer.full_node:
-                    continue
-                key = bittrie.XorKey(node_id, peer.node_id)
-                input_trie[key] = peer
+            input_trie =\
+                self.engine.find_closest_peers(node_id, ready_only=False)
 
         max_initial_queries = 3
         slowpoke_factor = 2
@@ -535,7 +822,7 @@ class ChordTasks(object):
         result_trie = bittrie.BitTrie()
 
         # Store ourselves to ignore when peers respond with us in their list.
-        result_trie[bittrie.XorKey(node_id, self.engine.node_id)] = False
+        result_trie[xordist.distance(node_id, self.engine.node_id)] = False
 
         tasks = []
         used_tunnels = {}
@@ -570,9 +857,13 @@ class ChordTasks(object):
             if targeted:
                 data_rw.targeted = True
 
-        # Open the tunnels with upto max_initial_queries immediate PeerS.
+        # Open the tunnels with upto max_initial_queries immediate PeerS,
+        # those that recently failed to open one only if needed.
+        probes = 0
+        open_rtos = []
+        failed_vpeers = []
         for peer in input_trie:
-            key = bittrie.XorKey(node_id, peer.node_id)
+            key = xordist.distance(node_id, peer.node_id)
             vpeer = VPeer(peer)
             # Store immediate PeerS in the result_trie.
             result_trie[key] = vpeer
@@ -583,6 +874,9 @@ class ChordTasks(object):
                 continue
             if not peer.ready():
                 continue
+            if self.failed_tunnels.check(peer.node_id):
+                failed_vpeers.append(vpeer)
+                continue
 
             tun_meta = TunnelMeta(peer)
             used_tunnels[vpeer] = tun_meta
@@ -590,9 +884,23 @@ class ChordTasks(object):
             tasks.append(self._send_find_node(\
                 vpeer, fnmsg, result_trie, tun_meta, data_mode,\
                 far_peers_by_path, data_rw))
+            open_rtos.append(peer.rtt.rto())
+
+            vpeer.used = True
+
+        for vpeer in failed_vpeers[:max_initial_queries - len(tasks)]:
+            tun_meta = TunnelMeta(vpeer.peer)
+            used_tunnels[vpeer] = tun_meta
+
+            tasks.append(self._send_find_node(\
+                vpeer, fnmsg, result_trie, tun_meta, data_mode,\
+                far_peers_by_path, data_rw))
+            open_rtos.append(vpeer.peer.rtt.rto())
 
             vpeer.used = True
 
+        probes += len(tasks)
+
         if not tasks:
             log.info("Cannot perform FindNode, as we know no closer nodes.")
             return self._generate_fail_response(data_mode, data_key)
@@ -602,7 +910,9 @@ class ChordTasks(object):
                 .format(len(tasks)))
 
         done_cnt = 0
-        max_time = 7.0 #TODO: This is probably excessive!
+        # Opening a channel and the FindNode are two round trips.
+        max_time = self._find_node_timeout(\
+            self._rtos_max(open_rtos, 2), TUNNEL_OPEN_TIMEOUT)
         diff = 0
         start = datetime.today()
         while diff < max_time and done_cnt < max_initial_queries:
@@ -654,6 +964,7 @@ class ChordTasks(object):
 
             direct_peers_lower = 0
             current_depth_step_query_cnt = 0
+            step_rtos = []
             for row in result_trie:
                 if row is False:
                     # Row is ourself. Prevent infinite loops.
@@ -673,6 +984,8 @@ class ChordTasks(object):
 
                     if not peer.ready():
                         continue
+                    if self.failed_tunnels.check(peer.node_id):
+                        continue
 
                     tun_meta = TunnelMeta(peer)
                     used_tunnels[row] = tun_meta
@@ -691,6 +1004,9 @@ class ChordTasks(object):
                     row.used = True
 
                     current_depth_step_query_cnt += 1
+                    # Opening the channel is another round trip.
+                    rto = peer.rtt.rto()
+                    step_rtos.append(rto * 2 if rto is not None else None)
                     continue
 
                 tun_meta = row.tun_meta
@@ -702,14 +1018,17 @@ class ChordTasks(object):
                     log.debug("Sending FindNode to path [{}]."\
                         .format(row.path))
 
-                pkt = self._generate_relay_packets(row.path)
+                pkt = self._generate_relay_packets(\
+                    row.path, peer=tun_meta.peer)
 
                 tun_meta.peer.protocol.write_channel_data(\
                     tun_meta.local_cid, pkt)
+                tun_meta.sent_times[tuple(row.path)] = time.monotonic()
 
                 row.used = True
                 query_cntr.value += 1
                 current_depth_step_query_cnt += 1
+                step_rtos.append(tun_meta.peer.relay_rtt.rto())
 
                 if tun_meta.jobs is None:
                     # If this is the first relay for this tunnel, then start a
@@ -735,25 +1054,36 @@ class ChordTasks(object):
                 log.info("FindNode search has ended at closest nodes.")
                 break
 
+            probes += current_depth_step_query_cnt
+
 #            yield from done_all.wait()
 #            done_all.clear()
-            # Wait upto a second for at least one response.
+            # Wait for at least one response, about as long as the quickest
+            # of the queried PeerS and tunnels takes.
+            step_start = time.monotonic()
             try:
                 try:
                     yield from asyncio.wait_for(\
                         done_one.wait(),\
-                        timeout=1,\
+                        timeout=self._find_node_timeout(\
+                            self._rtos_min(step_rtos), STEP_TIMEOUT),\
                         loop=self.loop)
                 except asyncio.TimeoutError:
                     pass
 
                 done_one.clear()
 
-                # Wait a bit more for the rest of the tasks.
+                # Wait a bit more for the rest of the tasks, until the
+                # slowest is due.
+                rest = self._rtos_max(step_rtos)
+                if rest is not None:
+                    rest -= time.monotonic() - step_start
+
                 try:
                     yield from asyncio.wait_for(\
                         done_all.wait(),\
-                        timeout=0.1 * retry_factor,\
+                        timeout=self._find_node_timeout(\
+                            rest, STRAGGLER_TIMEOUT * retry_factor),\
                         loop=self.loop)
                 except asyncio.TimeoutError:
                     pass
@@ -856,6 +1186,15 @@ class ChordTasks(object):
 
             done_one.clear()
 
+            if data_mode is cp.DataMode.get:
+                get_data_timeout = self._get_data_timeout(retry_factor)
+                # A second GetData is sent to the next holder if the first
+                # hasn't answered within the hedge delay.
+                hedge_delay = self.get_data_hedge_delay(retry_factor)
+                get_data_sent = {} # {(TunnelMeta, path): time.monotonic()}
+                first_source = None
+                hedged = False
+
             for row in result_trie:
                 if row is False:
                     # Row is ourself.
@@ -960,8 +1299,10 @@ class ChordTasks(object):
 
                 if tun_meta:
                     # Then this is a Peer reached through a tunnel.
-                    pkt = self._generate_relay_packets(row.path, pkt)
+                    pkt = self._generate_relay_packets(\
+                        row.path, pkt, tun_meta.peer)
                     tun_meta.jobs += 1
+                    source = (tun_meta, tuple(row.path))
                 else:
                     # Then this is an immediate Peer.
                     tun_meta = used_tunnels.get(row)
@@ -989,6 +1330,8 @@ class ChordTasks(object):
                         # don't use it.
                         continue
 
+                    source = (tun_meta, None)
+
                 tun_meta.peer.protocol.write_channel_data(\
                     tun_meta.local_cid, pkt)
 
@@ -996,17 +1339,32 @@ class ChordTasks(object):
                 done_all.clear()
 
                 if data_mode is cp.DataMode.get:
-                    # We only send one at a time, stopping at success.
+                    # We send one at a time, stopping at success, except for
+                    # the one hedge.
 #                    yield from done_all.wait()
 #                    done_all.clear()
+                    get_data_sent[source] = time.monotonic()
+
+                    hedge = first_source is None\
+                        and hedge_delay < get_data_timeout
+                    if first_source is None:
+                        first_source = source
+
                     try:
                         yield from\
                             asyncio.wait_for(\
                                 data_rw.data_done.wait(),\
-                                1 + (retry_factor/10))
+                                hedge_delay if hedge else get_data_timeout)
                         data_rw.data_done.clear()
                     except asyncio.TimeoutError:
-                        log.info("Timeout waiting for data block.")
+                        if hedge:
+                            if log.isEnabledFor(logging.INFO):
+                                log.info("No data block after [{:.3f}]"\
+                                    " seconds; hedging with the next Peer."\
+                                        .format(hedge_delay))
+                            hedged = True
+                        else:
+                            log.info("Timeout waiting for data block.")
                         pass
 
                     if data_rw.data is not None: # Handle the 'blank data' blk.
@@ -1024,11 +1382,31 @@ class ChordTasks(object):
                     if stores_sent == max_initial_queries:
                         break
 
+            if data_mode is cp.DataMode.get and get_data_sent:
+                # The GetDataS still out, as when a hedge went to the last
+                # holder, are given the rest of their time.
+                while data_rw.data is None:
+                    remaining = max(get_data_sent.values())\
+                        + get_data_timeout - time.monotonic()
+                    if remaining <= 0:
+                        break
+
+                    try:
+                        yield from asyncio.wait_for(\
+                            data_rw.data_done.wait(), remaining)
+                        data_rw.data_done.clear()
+                    except asyncio.TimeoutError:
+                        log.info("Timeout waiting for data block.")
+                        break
+
+                self._record_get_data(\
+                    data_rw, get_data_sent, first_source, hedged)
+
             if data_mode is cp.DataMode.store:
                 try:
                     yield from asyncio.wait_for(\
                         done_one.wait(),\
-                        timeout=1,\
+                        timeout=self._find_node_timeout(None, STEP_TIMEOUT),\
                         loop=self.loop)
                 except asyncio.TimeoutError:
                     pass
@@ -1039,7 +1417,8 @@ class ChordTasks(object):
                 try:
                     yield from asyncio.wait_for(\
                         done_all.wait(),\
-                        timeout=0.1 * retry_factor,\
+                        timeout=self._find_node_timeout(\
+                            None, STRAGGLER_TIMEOUT * retry_factor),\
                         loop=self.loop)
                 except asyncio.TimeoutError:
                     pass
@@ -1063,7 +1442,8 @@ class ChordTasks(object):
             try:
                 yield from asyncio.wait_for(\
                     done_all.wait(),\
-                    timeout=0.1 * retry_factor,\
+                    timeout=self._find_node_timeout(\
+                        None, STRAGGLER_TIMEOUT * retry_factor),\
                     loop=self.loop)
             except asyncio.TimeoutError:
                 pass
@@ -1088,7 +1468,14 @@ class ChordTasks(object):
                 if data_rw.data is None\
                         and (not significant_bits or not data_rw.data_key):
                     log.info("Failed to find the data!")
+
+                    if not scan_only:
+                        self.missing_data.add(\
+                            missing_key, probes, retry_factor)
                 else:
+                    if not scan_only:
+                        self.missing_data.remove(missing_key)
+
                     if data_rw.version is not None:
                         if log.isEnabledFor(logging.INFO):
                             log.info("Found updateable key data;"\
@@ -1110,6 +1497,44 @@ class ChordTasks(object):
 
         return rnodes
 
+    def _get_data_timeout(self, retry_factor):
+        return GET_DATA_TIMEOUT + (retry_factor/10)
+
+    def get_data_hedge_delay(self, retry_factor=1):
+        "Returns the seconds to wait for a GetData before hedging it."
+
+        samples = self.get_data_latencies
+
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            delay = self._get_data_timeout(retry_factor) / 2
+        else:
+            samples = sorted(samples)
+            delay = samples[\
+                min(int(len(samples) * HEDGE_PERCENTILE), len(samples) - 1)]
+
+        return max(delay, HEDGE_MIN_DELAY)
+
+    def _record_get_data(self, data_rw, get_data_sent, first_source, hedged):
+        "Updates the GetData latencies and stats once the GetData stage of a"\
+        " send_find_node is over."
+
+        self.get_data_count += 1
+        if hedged:
+            self.get_data_hedged += 1
+
+        if data_rw.data is None:
+            return
+
+        sent = get_data_sent.get(data_rw.source)
+        if sent is None:
+            # The data was our own.
+            return
+
+        self.get_data_latencies.append(time.monotonic() - sent)
+
+        if hedged and data_rw.source != first_source:
+            self.get_data_hedge_wins += 1
+
     @asyncio.coroutine
     def _possibly_add_peers(self, result_trie):
         only_memory = False
@@ -1165,40 +1590,52 @@ class ChordTasks(object):
         else:
             return 0
 
-    def _generate_relay_packets(self, path, payload=None):
+    def _generate_relay_packets(self, path, payload=None, peer=None):
         "path: list of indexes."\
-        "payload_msg: optional packet data to wrap."
-
-        #TODO: MAYBE: replace embedded ChordRelay packets with
-        # just one that has a 'path' field. Just more simple,
-        # efficient and should be easy change. It means less work
-        # for intermediate nodes that may want to examine the deepest
-        # packet, in the case of data, in order to opportunistically
-        # store the data. This might be a less good solution for
-        # anonyminty, but it could be as easilty switched back if that
-        # is true and a priority.
-
-        #TODO: ChordRelay should be modified to allow a message payload instead
-        # of the byte 'packet' payload. This way it can recursively call
-        # encode() on the payloads that way appending data each iteration
-        # instead of the inefficient way it does it now with inserting the
-        # wrapping packet each iteration. This is an especially important
-        # improvement now that a huge data packet is tacked on the end.
-
-        pkt = None
-        for idx in reversed(path):
-            msg = cp.ChordRelay()
-            msg.index = idx
-            if pkt:
-                msg.packets = [pkt]
-            else:
-                if payload:
-                    msg.packets = [payload]
-                else:
-                    msg.packets = []
-            pkt = msg.encode()
+        "payload_msg: optional packet data to wrap."\
+        "peer: the immediate Peer it is sent to; a flat ChordRelayPath is"\
+        " generated if it supports it, nested ChordRelay packets otherwise."
+
+        if peer is not None and _relay_path_supported(peer):
+            msg = cp.ChordRelayPath()
+            msg.path = path
+            msg.payload = payload
+            return msg.encode()
+
+        if not path:
+            return None
+
+        return cp.encode_nested_relay(path, payload)
+
+    def _find_node_timeout(self, rto, bound):
+        "Returns how long to wait for responses due in rto seconds, or for"\
+        " which there is no estimate if rto is None, bounded by bound."
+
+        upper = bound
+        if self.engine.node.tormode:
+            upper *= TOR_TIMEOUT_FACTOR
+
+        if rto is None:
+            return upper
+
+        return min(max(rto, bound * MIN_TIMEOUT_FRACTION), upper)
+
+    def _rtos_min(self, rtos):
+        "Returns the lowest of the RTOs, ignoring those not known (None)."
+
+        known = [rto for rto in rtos if rto is not None]
+        if not known:
+            return None
+
+        return min(known)
+
+    def _rtos_max(self, rtos, factor=1):
+        "Returns the highest of the RTOs, or None if any is not known."
+
+        if not rtos or None in rtos:
+            return None
 
-        return pkt
+        return max(rtos) * factor
 
     @asyncio.coroutine
     def _send_find_node(self, vpeer, fnmsg, result_trie, tun_meta,\
@@ -1225,6 +1662,8 @@ class ChordTasks(object):
             queue = None
 
         if not queue:
+            self.failed_tunnels.add(peer.node_id)
+
             if self.engine.node.tormode:
                 if not peer.protocol.closed():
                     if log.isEnabledFor(logging.INFO):
@@ -1237,22 +1676,27 @@ class ChordTasks(object):
                 query_cntr.value -= 1
                 done_one.set()
                 if query_cntr.value == 0:
-                    done_all.set
+                    done_all.set()
             return
 
         if log.isEnabledFor(logging.DEBUG):
             log.debug("Sending root level FindNode msg to Peer (dbid=[{}])."\
                 .format(peer.dbid))
 
+        self.failed_tunnels.remove(peer.node_id)
+
+        sent = time.monotonic()
         peer.protocol.write_channel_data(local_cid, fnmsg.encode())
 
         pkt = yield from queue.get()
-        if not pkt:
+        if pkt:
+            peer.rtt.sample(time.monotonic() - sent)
+        else:
             if query_cntr:
                 query_cntr.value -= 1
                 done_one.set()
                 if query_cntr.value == 0:
-                    done_all.set
+                    done_all.set()
             return
 
         tun_meta.queue = queue
@@ -1297,7 +1741,7 @@ class ChordTasks(object):
                     query_cntr.value -= 1
                     done_one.set()
                     if query_cntr.value == 0:
-                        done_all.set
+                        done_all.set()
                 return
 
         msg = cp.ChordPeerList(pkt)
@@ -1316,7 +1760,7 @@ class ChordTasks(object):
 
             tvpeer = VPeer(rpeer, [idx], tun_meta)
 
-            key = bittrie.XorKey(node_id, rpeer.node_id)
+            key = xordist.distance(node_id, rpeer.node_id)
             result_trie.setdefault(key, tvpeer)
             if data_mode.value:
                 far_peers_by_path.setdefault((peer.dbid, idx), tvpeer)
@@ -1327,7 +1771,7 @@ class ChordTasks(object):
             query_cntr.value -= 1
             done_one.set()
             if query_cntr.value == 0:
-                done_all.set
+                done_all.set()
 
     @asyncio.coroutine
     def _process_find_node_relay(\
@@ -1397,6 +1841,10 @@ class ChordTasks(object):
                 pkts, path = self.unwrap_relay_packets(pkt, data_mode)
                 path = tuple(path)
 
+                sent = tun_meta.sent_times.pop(path, None)
+                if sent is not None:
+                    tun_meta.peer.relay_rtt.sample(time.monotonic() - sent)
+
             pkt_type = cp.ChordMessage.parse_type(pkts[0])
 
             if data_mode.value and pkt_type != cp.CHORD_MSG_PEER_LIST:
@@ -1423,10 +1871,9 @@ class ChordTasks(object):
                                 " key.")
 
                             query_cntr.value -= 1
-                            # There should only be one GetData at a time.
-                            assert not query_cntr.value
                             done_one.set()
-                            done_all.set()
+                            if not query_cntr.value:
+                                done_all.set()
                             continue
                     else:
                         assert data_mode is cp.DataMode.store
@@ -1547,7 +1994,7 @@ class ChordTasks(object):
 
                 vpeer = VPeer(rpeer, end_path, tun_meta)
 
-                key = bittrie.XorKey(node_id, rpeer.node_id)
+                key = xordist.distance(node_id, rpeer.node_id)
                 result_trie.setdefault(key, vpeer)
 
                 if data_mode.value:
@@ -1686,8 +2133,8 @@ class ChordTasks(object):
                         " key.")
                     tun_meta.jobs -= 1
                     query_cntr.value -= 1
-                    assert not query_cntr.value
-                    done_all.set()
+                    if not query_cntr.value:
+                        done_all.set()
                     continue
             else:
                 assert data_mode is cp.DataMode.store
@@ -1712,36 +2159,17 @@ class ChordTasks(object):
         "Process an incoming FindNode request."\
         " The channel will be closed before this method returns."
 
-        pt = bittrie.BitTrie()
-
-        for cpeer in self.engine.peers.values():
-            if cpeer == peer:
-                # Don't include asking peer.
-                continue
-            if not cpeer.full_node:
-                continue
-            if not cpeer.ready:
-                continue
-
-            pt[bittrie.XorKey(fnmsg.node_id, cpeer.node_id)] = cpeer
-
-#        # We don't want to deal with further nodes than ourselves.
-#        pt[bittrie.XorKey(fnmsg.node_id, self.engine.node_id)] = True
-
         cnt = 20
         rlist = []
 
-        for r in pt:
-#            if r is True:
-#                log.info("No more nodes closer than ourselves.")
-#                break
-
+        # Don't include asking peer.
+        for r in self.engine.find_closest_peers(fnmsg.node_id, peer):
             if log.isEnabledFor(logging.DEBUG):
                 log.debug("nn: {} FOUND: {:7} {:22} node_id=[{}] diff=[{}]"\
                     .format(self.engine.node.instance, r.dbid, r.address,\
                         mbase32.encode(r.node_id),\
                         mutil.hex_string(\
-                            mutil.calc_raw_distance(\
+                            xordist.raw_distance(\
                                 r.node_id, fnmsg.node_id))))
 
             rlist.append(r)
@@ -1750,10 +2178,6 @@ class ChordTasks(object):
             if not cnt:
                 break
 
-        # Free memory? We no longer need this, and we may be tunneling for
-        # some time.
-        pt = None
-
         will_store = False
         need_pruning = False
         data_present = False
@@ -1854,7 +2278,7 @@ class ChordTasks(object):
                     peer.protocol.write_channel_data(local_cid, dsmsg.encode())
                     continue
                 else:
-                    rmsg = cp.ChordRelay(pkt)
+                    rmsg = cp.parse_relay(pkt)
             elif data_present and packet_type == cp.CHORD_MSG_GET_DATA:
                 if log.isEnabledFor(logging.INFO):
                     log.info("Received ChordGetData packet, fetching.")
@@ -1865,9 +2289,19 @@ class ChordTasks(object):
                 else:
                     data_id = fnmsg.node_id
 
+                # Our datastore first, as it may have a newer version than
+                # the transit_cache.
                 data, data_l, version, signature, epubkey, pubkeylen =\
                     yield from self._retrieve_data(data_id)
 
+                if data is None:
+                    tblock = self.transit_cache.get(data_id)
+                    if tblock:
+                        data, data_l, version, signature, epubkey,\
+                            pubkeylen = tblock.data, tblock.original_size,\
+                                tblock.version, tblock.signature,\
+                                tblock.epubkey, tblock.pubkeylen
+
 #                assert data is not None
 
                 drmsg = cp.ChordDataResponse()
@@ -1894,7 +2328,7 @@ class ChordTasks(object):
                 yield from peer.protocol.close_channel(local_cid)
                 return
             else:
-                rmsg = cp.ChordRelay(pkt)
+                rmsg = cp.parse_relay(pkt)
 
             if log.isEnabledFor(logging.DEBUG):
                 log.debug("Processing request from Peer (id=[{}]) for index"\
@@ -1933,7 +2367,9 @@ class ChordTasks(object):
 
                 e_pkt = rmsg.packets[0]
 
-                if cp.ChordMessage.parse_type(e_pkt) != cp.CHORD_MSG_RELAY:
+                e_pkt_type = cp.ChordMessage.parse_type(e_pkt)
+                if e_pkt_type != cp.CHORD_MSG_RELAY\
+                        and e_pkt_type != cp.CHORD_MSG_RELAY_PATH:
                     if not fnmsg.data_mode.value:
                         log.warning("Peer [{}] sent a non-empty relay packet"\
                             " with other than a relay packet embedded for"\
@@ -2002,6 +2438,13 @@ class ChordTasks(object):
                     " to Peer (id=[{}])."\
                     .format(index, rpeer.dbid, tun_meta.peer.dbid))
 
+            if cp.ChordMessage.parse_type(pkt) == cp.CHORD_MSG_RELAY_PATH\
+                    and not _relay_path_supported(tun_meta.peer):
+                # The rest of the path is forwarded as is, unless the next
+                # Peer is too old to understand it.
+                msg = cp.ChordRelayPath(pkt)
+                pkt = self._generate_relay_packets(msg.path, msg.payload)
+
             tun_meta.peer.protocol.write_channel_data(tun_meta.local_cid, pkt)
 
             req_cntr.value += 1
@@ -2110,6 +2553,18 @@ class ChordTasks(object):
 
     @asyncio.coroutine
     def _check_has_data(self, data_id, significant_bits, target_key):
+        "Concurrent checks for the same data, as when it is popular, share"\
+        " one."
+
+        r = yield from self.check_data_flights.do(\
+            (bytes(data_id), significant_bits,\
+                bytes(target_key) if target_key else None),\
+            self.__check_has_data, data_id, significant_bits, target_key)
+
+        return r
+
+    @asyncio.coroutine
+    def __check_has_data(self, data_id, significant_bits, target_key):
         if log.isEnabledFor(logging.DEBUG):
             target_key_enc =\
                 mbase32.encode(target_key) if target_key is not None else None
@@ -2118,21 +2573,21 @@ class ChordTasks(object):
                     .format(mbase32.encode(data_id), significant_bits,\
                         target_key_enc))
 
-        distance = mutil.calc_raw_distance(self.engine.node_id, data_id)
+        distance = xordist.raw_distance(self.engine.node_id, data_id)
 
         min_sig_bits = 20 if target_key is not None else 32
 
-        if significant_bits and significant_bits >= min_sig_bits:
-            mask = ((1 << (chord.NODE_ID_BITS - significant_bits)) - 1)\
-                .to_bytes(chord.NODE_ID_BYTES, "big")
+        if not (significant_bits and significant_bits >= min_sig_bits)\
+                and data_id in self.transit_cache:
+            return True
 
-            end_id = bytearray()
+        if significant_bits and significant_bits >= min_sig_bits:
+            mask = (1 << (chord.NODE_ID_BITS - significant_bits)) - 1
 
-            for c1, c2 in zip(data_id, mask):
-                end_id.append(c1 | c2)
+            end_id = xordist.to_int(data_id) | mask
 
             if distance > self.engine.furthest_data_block:
-                d2 = mutil.calc_raw_distance(self.engine.node_id, end_id)
+                d2 = xordist.raw_distance(self.engine.node_id, end_id)
                 if d2 > self.engine.furthest_data_block:
                     return False
         else:
@@ -2184,7 +2639,7 @@ class ChordTasks(object):
 #            # We only store stuff closer than 2^2 less then the maximum
 #            # distance.
 #            log_dist, direction =\
-#                mutil.calc_log_distance(self.engine.node_id, data_id)
+#                xordist.log_distance(self.engine.node_id, data_id)
 #            if log_dist > chord.NODE_ID_BITS - 2:
 #                # Too far.
 #                if log.isEnabledFor(logging.DEBUG):
@@ -2226,7 +2681,7 @@ class ChordTasks(object):
             log.debug("Datastore is full, checking if proposed block is"\
                 " closer than enough stored blocks to fit with a purge.")
 
-        distance = mutil.calc_raw_distance(self.engine.node_id, data_id)
+        distance = xordist.raw_distance(self.engine.node_id, data_id)
 
         if distance > self.engine.furthest_data_block:
             return False, False
@@ -2307,14 +2762,14 @@ class ChordTasks(object):
             else:
                 data_hash = enc.generate_ID(data)
 
+            pubkey = None
+
             if drmsg.version is not None:
                 # Updateable key mode.
                 if data_rw.targeted:
                     log.warning("Received versioned DataResponse when we"\
                         " requested a TargetedBlock, that is invalid.")
-                    return False
-
-                data_rw.version = drmsg.version
+                    return None
 
                 if data_rw.pubkey:
                     pubkey = data_rw.pubkey
@@ -2324,9 +2779,6 @@ class ChordTasks(object):
                     # Truncate the key data to exclude the cipher padding.
                     pubkey = pubkey[:drmsg.pubkeylen]
 
-                    # Return the pubkey to the original caller.
-                    data_rw.pubkey = pubkey
-
                     data_key = enc.generate_ID(pubkey)
                     if data_rw.path_hash:
                         data_key = enc.generate_ID(data_key + data_rw.path_hash)
@@ -2334,10 +2786,7 @@ class ChordTasks(object):
                     if data_key != data_rw.data_key:
                         if log.isEnabledFor(logging.DEBUG):
                             log.debug("DataResponse is invalid!")
-                        return False
-
-                # Return the signature to the original caller.
-                data_rw.signature = drmsg.signature
+                        return None
 
                 hm = bytearray()
                 hm += sshtype.encodeBinary(data_rw.path_hash)
@@ -2352,29 +2801,63 @@ class ChordTasks(object):
                 valid = data_hash == data_rw.data_key
 
             if valid:
-                data_rw.data = data
                 if log.isEnabledFor(logging.DEBUG):
                     log.debug("DataResponse is valid.")
-                return True
+                return data, pubkey
             else:
                 if log.isEnabledFor(logging.DEBUG):
                     log.debug("DataResponse is invalid!")
-                return False
+                return None
 
         r = yield from self.loop.run_in_executor(None, threadcall)
 
+        if r is None:
+            data_rw.data_done.set()
+            return False
+
+        # With hedged GetDataS, the first verified response wins. The data is
+        # only stored into data_rw here so that concurrent responses can't mix.
+        if data_rw.data is None:
+            data_rw.data, pubkey = r
+            data_rw.source = (tun_meta, tuple(path) if path else None)
+
+            if drmsg.version is not None:
+                # Return the version, pubkey and signature to the original
+                # caller.
+                data_rw.version = drmsg.version
+                data_rw.pubkey = pubkey
+                data_rw.signature = drmsg.signature
+
+            if tun_meta and (drmsg.version is None or drmsg.epubkey):
+                # Keep it for others that want it, as it passed through us and
+                # is now verified.
+                self.transit_cache.put(\
+                    enc.generate_ID(data_rw.data_key), drmsg)
+
         data_rw.data_done.set()
 
+        return True
+
+    @asyncio.coroutine
+    def _retrieve_data(self, data_id, max_age=None):
+        "Concurrent retrievals of the same data, as when it is popular, share"\
+        " one."
+
+        r = yield from self.retrieve_data_flights.do(\
+            (bytes(data_id), max_age), self.__retrieve_data, data_id, max_age)
+
         return r
 
     @asyncio.coroutine
-    def _retrieve_data(self, data_id):
+    def __retrieve_data(self, data_id, max_age):
         "Retrieve data for data_id from the file system (and meta data from"\
         " the database."\
         "returns: data, original_size,\
                 <version, signature, epubkey, pubkeylen>"\
         "   original_size is the size of the data before it was encrypted."\
-        "   version, Etc. are for updateable keys."
+        "   version, Etc. are for updateable keys."\
+        "   max_age: if not None, an updateable key stored longer ago than"\
+        " this timedelta is treated as missing."
 
         def dbcall():
             with self.engine.node.db.open_session() as sess:
@@ -2393,33 +2876,23 @@ class ChordTasks(object):
         if not data_block:
             return None, None, None, None, None, None
 
-        def iocall():
-            filename = self.engine.node.data_block_file_path.format(\
-                self.engine.node.instance, data_block.id)
-
-            try:
-                with open(filename, "rb") as data_file:
-                    data = data_file.read()
-                    return data
-            except FileNotFoundError:
-                return None
-
-        enc_data = yield from self.loop.run_in_executor(None, iocall)
-
-        if enc_data is None:
-            log.warning("Block id=[{}] was missing; Removing DB entry."\
-                .format(data_block.id))
+        if max_age is not None and data_block.version is not None\
+                and mutil.utc_datetime() - data_block.insert_timestamp\
+                    > max_age:
+            return None, None, None, None, None, None
 
-            def dbcall_prune():
-                with self.engine.node.db.open_session() as sess:
-                    sess.query(DataBlock)\
-                        .filter(DataBlock.id == data_block.id)\
-                        .delete(synchronize_session=False)
-                    sess.commit()
+        enc_data, intact = yield from self.loop.run_in_executor(\
+            None, scrubber.read_block, self.engine.node.block_store,\
+            data_block)
 
-            yield from self.loop.run_in_executor(None, dbcall_prune)
+        if enc_data is None or not intact:
+            # Better to have the requester look elsewhere than to serve it.
+            # The block isn't dropped if it is still being written.
+            enc_data = yield from\
+                self.engine.node.block_scrubber.repair(data_block)
 
-            return None, None, None, None, None, None
+            if enc_data is None:
+                return None, None, None, None, None, None
 
         version =\
             int(data_block.version) if data_block.version is not None else None
@@ -2440,7 +2913,7 @@ class ChordTasks(object):
             log.warning(errmsg)
             raise ChordException(errmsg)
 
-        distance = mutil.calc_raw_distance(self.engine.node_id, data_id)
+        distance = xordist.raw_distance(self.engine.node_id, data_id)
 
         def dbcall():
             with self.engine.node.db.open_session() as sess:
@@ -2492,27 +2965,56 @@ class ChordTasks(object):
         "Store the data block on disk and meta in the database. Returns True"
         " if the data was stored, False otherwise."
 
-        #TODO: I now realize that this whole method should probably run in a
-        # separate thread that is passed to run_in_executor(..), instead of
-        # breaking it up into many such calls. Just for efficiency and since
-        # there is probably no reason not to.
-        #FIXME: This code needs to be fixed to use an additional table,
-        # something like DataBlockJournal, which tracks pending deletes or
-        # creations, thus ensuring the filesystem is kept in sync, even if
-        # crashes, Etc.
+        # The verification, encryption, write and DataBlock transaction all
+        # run in the node's store_worker, which batches the transactions of
+        # concurrent stores. The writes and removals of block data are
+        # journaled in DataBlockJournal, so that a crash can't leave the block
+        # store out of sync.
 
         peer_dbid = peer.dbid if peer else "<self>"
 
+        if dmsg.pubkey and dmsg.targeted:
+            errmsg = "Targeted updateable key is not implemented."
+            log.warning(errmsg)
+            raise ChordException(errmsg)
+
+        distance = xordist.raw_distance(self.engine.node_id, data_id)
+
+        def verify():
+            return self._verify_store_data(peer_dbid, data_id, dmsg)
+
+        job = storeworker.StoreJob(\
+            data_id, dmsg, distance, need_pruning, verify)
+
+        yield from self.engine.node.store_worker.store(job)
+
+        if not job.stored:
+            if log.isEnabledFor(logging.INFO):
+                if job.stored is False:
+                    log.info("Not storing block we said we would as we"\
+                        " can won't free up enough space for it. (Some"\
+                        " other block upload must have beaten this one to"\
+                        " us.")
+                else:
+                    log.info("Not storing data that we already have"\
+                        " (data_id=[{}])."\
+                        .format(mbase32.encode(data_id)))
+            return False
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Stored data for data_id=[{}] as block id=[{}]."\
+                .format(mbase32.encode(data_id), job.data_block_id))
+
+        return True
+
+    def _verify_store_data(self, peer_dbid, data_id, dmsg):
+        "Checks the data of a StoreData matches the data_id. Blocking; returns"\
+        " the data_key and the TargetedBlock or None."
+
         data = dmsg.data
-        targeted = dmsg.targeted
+        tb = None
 
-        pubkey = None
         if dmsg.pubkey:
-            if targeted:
-                errmsg = "Targeted updateable key is not implemented."
-                log.warning(errmsg)
-                raise ChordException(errmsg)
-
             pubkey = rsakey.RsaKey(dmsg.pubkey)
 
             data_key = enc.generate_ID(dmsg.pubkey)
@@ -2544,7 +3046,7 @@ class ChordTasks(object):
                 log.warning(errmsg)
                 raise ChordException(errmsg)
         else:
-            if targeted:
+            if dmsg.targeted:
                 tb, data_key = self._check_store_targeted_block(data)
             else:
                 data_key = enc.generate_ID(data)
@@ -2555,222 +3057,7 @@ class ChordTasks(object):
                 log.warning(errmsg)
                 raise ChordException(errmsg)
 
-        distance = mutil.calc_raw_distance(self.engine.node_id, data_id)
-        original_size = len(data)
-
-        def dbcall():
-            with self.engine.node.db.open_session() as sess:
-                self.engine.node.db.lock_table(sess, DataBlock)
-
-                old_entry = None
-                if pubkey:
-                    old_entry = sess.query(DataBlock)\
-                        .filter(DataBlock.data_id == data_id)\
-                        .first()
-                    if old_entry:
-                        vint = int(old_entry.version)
-                        if vint >= dmsg.version:
-                            # We only want to store newer versions.
-                            return None, None
-                else:
-                    q = sess.query(func.count("*")).select_from(DataBlock)
-                    q = q.filter(DataBlock.data_id == data_id)
-
-                    if q.scalar() > 0:
-                        # We already have this block.
-                        return None, None
-
-                if need_pruning:
-                    freeable_space = 0
-                    blocks_to_prune = []
-
-                    q = sess.query(DataBlock.id, DataBlock.original_size)\
-                        .filter(DataBlock.distance > distance)\
-                        .filter(DataBlock.original_size != 0)\
-                        .order_by(DataBlock.distance.desc())
-
-                    for block in mutil.page_query(q):
-                        freeable_space += block.original_size
-                        blocks_to_prune.append(block.id)
-
-                        if freeable_space >= original_size:
-                            break
-
-                    if freeable_space < original_size:
-                        return False, None
-
-                    if log.isEnabledFor(logging.INFO):
-                        log.info("Pruning {} blocks to make room."\
-                            .format(len(blocks_to_prune)))
-
-                    for anid in blocks_to_prune:
-                        sess.query(DataBlock)\
-                            .filter(DataBlock.id == anid)\
-                            .delete(synchronize_session=False)
-
-                updateable_size_diff = None
-                if old_entry:
-                    data_block = old_entry
-                    assert data_block.data_id == data_id
-                    updateable_size_diff =\
-                        original_size - data_block.original_size
-                else:
-                    data_block = DataBlock()
-                    data_block.data_id = data_id
-                    data_block.distance = distance
-
-                if pubkey:
-                    data_block.version = str(dmsg.version)
-                    data_block.signature = dmsg.signature
-
-                    a, b = enc.encrypt_data_block(dmsg.pubkey, data_key)
-                    data_block.epubkey = a + b
-                    data_block.pubkeylen = len(dmsg.pubkey)
-
-                if targeted:
-                    if log.isEnabledFor(logging.DEBUG):
-                        log.debug("Storing TargetedBlock (target_key=[{}])."\
-                            .format(mbase32.encode(tb.target_key)))
-                    # We don't need the following for anything coded yet, but
-                    # doing it for now because then we can tell which are
-                    # targeted blocks as we may want to have code purge them
-                    # with more pressure than normal blocks.
-                    data_block.target_key = tb.target_key
-
-                data_block.original_size = original_size
-                data_block.insert_timestamp = mutil.utc_datetime()
-
-                if not old_entry:
-                    sess.add(data_block)
-
-                if updateable_size_diff is not None:
-                    size_diff = updateable_size_diff
-                else:
-                    size_diff = original_size
-
-                if need_pruning:
-                    size_diff -= freeable_space
-
-                self._update_nodestate(sess, size_diff)
-
-                sess.commit()
-
-                if need_pruning:
-                    for anid in blocks_to_prune:
-                        try:
-                            os.remove(self.engine.node.data_block_file_path\
-                                .format(self.engine.node.instance, anid))
-                        except FileNotFoundError:
-                            if log.isEnabledFor(logging.WARNING):
-                                log.warning("FileNotFoundError pruning block"\
-                                    " id=[{}]; considered pruned anyways."\
-                                        .format(anid))
-
-                return data_block.id, size_diff
-
-        data_block_id, size_diff =\
-            yield from self.loop.run_in_executor(None, dbcall)
-
-        if not data_block_id:
-            if log.isEnabledFor(logging.INFO):
-                if data_block_id is False:
-                    log.info("Not storing block we said we would as we"\
-                        " can won't free up enough space for it. (Some"\
-                        " other block upload must have beaten this one to"\
-                        " us.")
-                else:
-                    log.info("Not storing data that we already have"\
-                        " (data_id=[{}])."\
-                        .format(mbase32.encode(data_id)))
-            return False
-
-        self.engine.node.datastore_size += size_diff
-
-        try:
-            if log.isEnabledFor(logging.INFO):
-                log.info("Encrypting [{}] bytes of data.".format(len(data)))
-
-            #TODO: If not too much a performance cost: Hash encrypted data
-            # block and store hash in the db so we can verify it didn't become
-            # corrupted on the filesystem. This is because we will be penalized
-            # by the network if we give invalid data when asked for.
-            #NOTE: Actually, it should be fine as we can do it in another
-            # thread and thus not impact our eventloop thread. We can do it
-            # concurrently with encryption!
-
-            # PyCrypto works in blocks, so extra than round block size goes
-            # into enc_data_remainder.
-            def threadcall():
-                return enc.encrypt_data_block(data, data_key)
-
-            enc_data, enc_data_remainder\
-                = yield from self.loop.run_in_executor(None, threadcall)
-
-            if log.isEnabledFor(logging.INFO):
-                tlen = len(enc_data)
-                if enc_data_remainder:
-                    tlen += len(enc_data_remainder)
-                log.info("Storing [{}] bytes of data.".format(tlen))
-
-            def iocall():
-                filename = self.engine.node.data_block_file_path.format(\
-                    self.engine.node.instance, data_block_id)
-
-                with open(filename, "wb") as new_file:
-                    new_file.write(enc_data)
-                    if enc_data_remainder:
-                        new_file.write(enc_data_remainder)
-
-            yield from self.loop.run_in_executor(None, iocall)
-
-            if distance > self.engine.furthest_data_block:
-                self.engine.furthest_data_block = distance
-
-            if log.isEnabledFor(logging.INFO):
-                log.info("Stored data for data_id=[{}] as [{}.blk]."\
-                    .format(mbase32.encode(data_id), data_block_id))
-
-            return True
-        except Exception as e:
-            log.exception("encrypt/write_to_disk")
-
-            log.warning("There was an exception attempting to store the data"\
-                " on disk.")
-
-            def dbcall():
-                with self.engine.node.db.open_session() as sess:
-                    self.engine.node.db.lock_table(sess, DataBlock)
-
-                    sess.query(DataBlock)\
-                        .filter(DataBlock.id == data_block_id)\
-                        .delete(synchronize_session=False)
-
-                    # Rule: only update this NodeState row when holding a lock
-                    # on the DataBlock table.
-                    node_state = sess.query(NodeState)\
-                        .filter(NodeState.key == mnnode.NSK_DATASTORE_SIZE)\
-                        .first()
-
-                    node_state.value =\
-                        str(int(node_state.value) - original_size)
-
-                    sess.commit()
-
-            yield from self.loop.run_in_executor(None, dbcall)
-
-            self.engine.node.datastore_size -= original_size
-
-            def iocall():
-                os.remove(self.engine.node.data_block_file_path\
-                    .format(self.engine.node.instance, data_block_id))
-
-            try:
-                yield from self.loop.run_in_executor(None, iocall)
-            except Exception:
-                log.exception("os.remove(..)")
-                pass
-
-            return False
+        return data_key, tb
 
     def _check_store_targeted_block(self, data):
         tb = mp.TargetedBlock(data)
@@ -2786,18 +3073,3 @@ class ChordTasks(object):
         data_key = enc.generate_ID(tb_header)
 
         return tb, data_key
-
-    def _update_nodestate(self, sess, size_diff):
-        # Rule: only update this NodeState row when holding a lock on
-        # the DataBlock table.
-        node_state = sess.query(NodeState)\
-            .filter(NodeState.key == mnnode.NSK_DATASTORE_SIZE)\
-            .first()
-
-        if not node_state:
-            node_state = NodeState()
-            node_state.key = mnnode.NSK_DATASTORE_SIZE
-            node_state.value = 0
-            sess.add(node_state)
-
-        node_state.value = str(int(node_state.value) + size_diff)
@@ -22,12 +22,13 @@ import mutil
 
 log = logging.getLogger(__name__)
 
-LATEST_SCHEMA_VERSION = 4
+LATEST_SCHEMA_VERSION = 6
 
 Base = declarative_base()
 
 Peer = None
 DataBlock = None
+DataBlockJournal = None
 NodeState = None
 DmailAddress = None
 DmailKey = None
@@ -90,12 +91,23 @@ def _init_daos(Base, d):
         epubkey = Column(LargeBinary, nullable=True)
         pubkeylen = Column(Integer, nullable=True)
         target_key = Column(LargeBinary, nullable=True)
+        checksum = Column(LargeBinary, nullable=True) # Of the encrypted data.
 
     Index("data_id", DataBlock.data_id)
     Index("datablock__distance", DataBlock.distance.desc())
 
     d.DataBlock = DataBlock
 
+    class DataBlockJournal(Base):
+        __tablename__ = "datablockjournal"
+
+        id = Column(Integer, primary_key=True)
+        data_block_id = Column(Integer, nullable=False)
+        action = Column(Integer, nullable=False)
+        insert_timestamp = Column(UtcDateTime, nullable=False)
+
+    d.DataBlockJournal = DataBlockJournal
+
     class NodeState(Base):
         __tablename__ = "nodestate"
 
@@ -332,6 +344,14 @@ class Db():
 
         if version == 3:
             _upgrade_3_to_4(self)
+            version = 4
+
+        if version == 4:
+            _upgrade_4_to_5(self)
+            version = 5
+
+        if version == 5:
+            _upgrade_5_to_6(self)
             version = LATEST_SCHEMA_VERSION
 
     def _create_schema(self):
@@ -363,6 +383,7 @@ if Peer is None:
 
     Peer = d.Peer
     DataBlock = d.DataBlock
+    DataBlockJournal = d.DataBlockJournal
     NodeState = d.NodeState
 
     # Maalstroom Dmail Client.
@@ -469,3 +490,43 @@ def _upgrade_3_to_4(db):
         sess.commit()
 
     log.warning("NOTE: Database schema upgraded.")
+
+def _upgrade_4_to_5(db):
+    log.warning("NOTE: Upgrading database schema from version 4 to 5.")
+
+    if db.is_sqlite:
+        t_id = "INTEGER"
+        t_datetime = "DATETIME"
+    else:
+        t_id = "SERIAL"
+        t_datetime = "TIMESTAMP WITHOUT TIME ZONE"
+
+    with db.open_session() as sess:
+        st = "CREATE TABLE datablockjournal (id " + t_id + " NOT NULL,"\
+            " data_block_id INTEGER NOT NULL, action INTEGER NOT NULL,"\
+            " insert_timestamp " + t_datetime + " NOT NULL,"\
+            " PRIMARY KEY (id))"
+
+        sess.execute(st)
+
+        _update_node_state(sess, 5)
+
+        sess.commit()
+
+    log.warning("NOTE: Database schema upgraded.")
+
+def _upgrade_5_to_6(db):
+    log.warning("NOTE: Upgrading database schema from version 5 to 6.")
+
+    t_bytea = "BLOB" if db.is_sqlite else "bytea"
+
+    with db.open_session() as sess:
+        st = "ALTER TABLE datablock ADD COLUMN checksum " + t_bytea
+
+        sess.execute(st)
+
+        _update_node_state(sess, 6)
+
+        sess.commit()
+
+    log.warning("NOTE: Database schema upgraded.")
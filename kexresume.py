@@ -0,0 +1,274 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: LGPL
+
+# Session resumption. Once a connection is authenticated both ends derive a
+# ticket (an id and a secret) from the session's K and H. A client reconnecting
+# to the same address offers the resume-sha256@mnet kex method, and if the
+# server still holds the ticket the new session keys are derived from the
+# ticket secret and a fresh nonce from each end instead of a Diffie-Hellman
+# exchange, and userauth is skipped. Tickets are single use and only kept in
+# memory.
+
+import llog
+
+import asyncio
+from collections import OrderedDict
+import hmac
+import logging
+import os
+import time
+from hashlib import sha256
+
+from sshexception import SshException
+import sshtype
+import packet as mnp
+
+log = logging.getLogger(__name__)
+
+NAME = "resume-sha256@mnet"
+
+# Seconds a ticket can be used for after the session it came from was keyed.
+TICKET_LIFETIME = 3600
+MAX_TICKETS = 4096
+
+NONCE_SIZE = 32
+
+class ResumptionTicket(object):
+    def __init__(self, ticket_id, secret, local_key, peer_key):
+        self.ticket_id = ticket_id
+        self.secret = secret
+        self.local_key = local_key # Our key as bytes.
+        self.peer_key = peer_key # rsakey.RsaKey.
+        self.expires = time.monotonic() + TICKET_LIFETIME
+
+class TicketCache(object):
+    "Tickets by key, the oldest are evicted once it is full."
+
+    def __init__(self, max_size=MAX_TICKETS):
+        self.max_size = max_size
+        self.tickets = OrderedDict()
+
+    def put(self, key, ticket):
+        self.tickets.pop(key, None)
+        self.tickets[key] = ticket
+
+        while len(self.tickets) > self.max_size:
+            self.tickets.popitem(False)
+
+    def pop(self, key):
+        "Removes and returns the ticket, or None if none or if it expired."
+
+        ticket = self.tickets.pop(key, None)
+        if ticket is None or ticket.expires < time.monotonic():
+            return None
+
+        return ticket
+
+    def clear(self):
+        self.tickets.clear()
+
+# Server side by ticket_id, client side by (our key, server address).
+server_tickets = TicketCache()
+client_tickets = TicketCache()
+
+def _derive(protocol, letter):
+    buf = bytearray()
+    buf += sshtype.encodeMpint(protocol.k)
+    buf += protocol.h
+    buf += letter
+    buf += protocol.session_id
+
+    return sha256(buf).digest()
+
+def _client_ticket_key(protocol):
+    return bytes(protocol.client_key.asbytes()), protocol.address
+
+def issue_ticket(protocol):
+    "Derives a ticket from the current keys of the authenticated protocol."
+
+    ticket_id = _derive(protocol, b'I')
+    secret = _derive(protocol, b'S')
+
+    if protocol.server_mode:
+        ticket = ResumptionTicket(ticket_id, secret,\
+            protocol.server_key.asbytes(), protocol.client_key)
+        server_tickets.put(ticket_id, ticket)
+    else:
+        ticket = ResumptionTicket(ticket_id, secret,\
+            protocol.client_key.asbytes(), protocol.server_key)
+        client_tickets.put(_client_ticket_key(protocol), ticket)
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Issued resumption ticket (address=[{}])."\
+            .format(protocol.address))
+
+def take_client_ticket(protocol):
+    "Returns the ticket to resume with to the address the client protocol is"\
+    " connected to, or None."
+
+    ticket = client_tickets.pop(_client_ticket_key(protocol))
+    if ticket is None:
+        return None
+
+    if protocol.server_key\
+            and protocol.server_key.asbytes() != ticket.peer_key.asbytes():
+        # A different node is now at that address.
+        return None
+
+    return ticket
+
+def _proof(secret, letter, h):
+    return hmac.new(secret, letter + h, sha256).digest()
+
+class KexResumeSha256(object):
+    name = NAME
+
+    def __init__(self, protocol, ticket=None):
+        self.protocol = protocol
+        self.ticket = ticket # Client side only.
+
+    @asyncio.coroutine
+    def run(self):
+        "Returns True on success, False on failure, or None if the server"\
+        " rejected the ticket; in which case both ends start over with a full"\
+        " key exchange."
+
+        if self.protocol.server_mode:
+            r = yield from self._run_server()
+        else:
+            r = yield from self._run_client()
+
+        if not r:
+            return r
+
+        m = mnp.SshNewKeysMessage()
+        m.encode()
+        self.protocol.write_packet(m)
+
+        return True
+
+    @asyncio.coroutine
+    def _run_client(self):
+        p = self.protocol
+        ticket = self.ticket
+
+        client_nonce = os.urandom(NONCE_SIZE)
+
+        # The proof covers both KexInit cookies, so it can't be replayed.
+        m = mnp.SshKexResumeInitMessage()
+        m.ticket_id = ticket.ticket_id
+        m.nonce = client_nonce
+        m.proof = _proof(ticket.secret, b'C',\
+            self._calc_h(ticket.ticket_id, client_nonce))
+        m.encode()
+        p.write_packet(m)
+
+        pkt = yield from p.read_packet()
+        if not pkt:
+            return False
+
+        m = mnp.SshKexResumeReplyMessage(pkt)
+
+        if not m.accepted:
+            log.info("Server rejected resumption ticket (address=[{}])."\
+                .format(p.address))
+            return None
+
+        H = self._calc_h(ticket.ticket_id, client_nonce, m.nonce)
+
+        if not hmac.compare_digest(_proof(ticket.secret, b'S', H), m.proof):
+            raise SshException("Server failed to prove it holds the"\
+                " resumption ticket (address=[{}]).".format(p.address))
+
+        p.set_K_H(self._calc_k(ticket.secret, client_nonce, m.nonce), H)
+
+        p.server_key = ticket.peer_key
+
+        r = yield from p.connection_handler.peer_authenticated(p)
+        return r
+
+    @asyncio.coroutine
+    def _run_server(self):
+        p = self.protocol
+
+        pkt = yield from p.read_packet()
+        if not pkt:
+            return False
+
+        m = mnp.SshKexResumeInitMessage(pkt)
+
+        ticket = server_tickets.pop(m.ticket_id)
+
+        if not self._check_ticket(ticket, m):
+            log.info("Rejecting resumption ticket (address=[{}])."\
+                .format(p.address))
+
+            mr = mnp.SshKexResumeReplyMessage()
+            mr.encode()
+            p.write_packet(mr)
+
+            return None
+
+        server_nonce = os.urandom(NONCE_SIZE)
+
+        H = self._calc_h(ticket.ticket_id, m.nonce, server_nonce)
+        p.set_K_H(self._calc_k(ticket.secret, m.nonce, server_nonce), H)
+
+        p.client_key = ticket.peer_key
+
+        r = yield from p.connection_handler.peer_authenticated(p)
+        if not r:
+            return False
+
+        mr = mnp.SshKexResumeReplyMessage()
+        mr.accepted = True
+        mr.nonce = server_nonce
+        mr.proof = _proof(ticket.secret, b'S', H)
+        mr.encode()
+        p.write_packet(mr)
+
+        return True
+
+    def _check_ticket(self, ticket, m):
+        p = self.protocol
+
+        if ticket is None:
+            return False
+
+        if ticket.local_key != p.server_key.asbytes():
+            return False
+
+        if p.client_key\
+                and p.client_key.asbytes() != ticket.peer_key.asbytes():
+            return False
+
+        proof = _proof(ticket.secret, b'C', self._calc_h(m.ticket_id, m.nonce))
+
+        return hmac.compare_digest(proof, m.proof)
+
+    def _calc_h(self, ticket_id, client_nonce, server_nonce=None):
+        p = self.protocol
+
+        if p.server_mode:
+            v_c, v_s = p.remote_banner, p.local_banner
+            i_c, i_s = p.remote_kex_init_message, p.local_kex_init_message
+        else:
+            v_c, v_s = p.local_banner, p.remote_banner
+            i_c, i_s = p.local_kex_init_message, p.remote_kex_init_message
+
+        # H = (V_C || V_S || I_C || I_S || ticket_id || N_C [|| N_S]).
+        hm = bytearray()
+        hm += sshtype.encodeString(v_c)
+        hm += sshtype.encodeString(v_s)
+        hm += sshtype.encodeBinary(i_c)
+        hm += sshtype.encodeBinary(i_s)
+        hm += sshtype.encodeBinary(ticket_id)
+        hm += sshtype.encodeBinary(client_nonce)
+        if server_nonce is not None:
+            hm += sshtype.encodeBinary(server_nonce)
+
+        return sha256(hm).digest()
+
+    def _calc_k(self, secret, client_nonce, server_nonce):
+        k = hmac.new(secret, client_nonce + server_nonce, sha256).digest()
+        return int.from_bytes(k, "big")
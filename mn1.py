@@ -4,42 +4,145 @@
 import llog
 
 import asyncio
+from collections import deque
 from enum import Enum
 import struct
 import logging
 import os
 
-from Crypto.Cipher import AES
 from hashlib import sha1
 import hmac
 
 import packet as mnetpacket
 import kex
 import kexdhgroup14sha1
+import kexresume
 import rsakey
+import sshcipher
+import sshcompress
 import sshtype
 from sshexception import SshException
 from mutil import hex_dump
 
 MAX_PACKET_LENGTH = 35000
 
+# Consumed data at the front of the receive buffer is only compacted away once
+# it is at least this big, otherwise the read offset is just advanced.
+RECEIVE_BUFFER_COMPACT_SIZE = 0x10000
+
+# Outbound packets are collected in a write buffer which is handed to the
+# transport at the end of the event loop iteration, or as soon as it holds this
+# much.
+WRITE_BUFFER_FLUSH_SIZE = 0x10000
+
+# Decoding of inbound packets stops, and reading from the transport is paused,
+# once this many decoded packets are waiting to be read. Both resume when the
+# queue has been drained down to the low water mark.
+PACKET_QUEUE_HIGH_WATER = 128
+PACKET_QUEUE_LOW_WATER = 32
+
+# Window we advertise for each channel, and the largest packet we accept.
+CHANNEL_WINDOW_SIZE = 65535
+CHANNEL_MAX_PACKET_SIZE = 65535
+
+# Bytes each channel with queued data may send per round of the outbound
+# (deficit round robin) channel scheduler.
+CHANNEL_QUANTUM = 0x4000
+
+# A new key exchange is started on a connection once this many bytes have gone
+# through it either way (RFC 4253 9), or this many seconds after the last one.
+REKEY_BYTES = 1 << 30
+REKEY_INTERVAL = 3600
+
+# Peers from this version on send WINDOW_ADJUST, so their windows can be
+# enforced.
+MNET_VERSION = (0, 0, 3)
+FLOW_CONTROL_MIN_MNET_VERSION = (0, 0, 2)
+# Peers from this version on handle a KEXINIT on an established connection, and
+# resumption tickets.
+REKEY_MIN_MNET_VERSION = (0, 0, 3)
+RESUMPTION_MIN_MNET_VERSION = (0, 0, 3)
+
 log = logging.getLogger(__name__)
 
 server_key = None
 client_key = None
 
 cleartext_transport_enabled = False
+compression_enabled = False
 
 def enable_cleartext_transport():
     global cleartext_transport_enabled
     cleartext_transport_enabled = True
 
+def enable_compression():
+    "Prefer compression on the connections we make. It is always accepted on"\
+    " those made to us if the remote end prefers it."
+
+    global compression_enabled
+    compression_enabled = True
+
+def _parse_mnet_version(banner):
+    "Returns the mNet version in the banner as a tuple, or None if it isn't"\
+    " an mNet banner."
+
+    i = banner.find("-mNet_")
+    if i == -1:
+        return None
+
+    version = banner[i + 6:].split('+', 1)[0]
+
+    try:
+        return tuple(int(v) for v in version.split('.'))
+    except ValueError:
+        return None
+
 class Status(Enum):
     new = 0
     ready = 10
     closed = 20
     disconnected = 30
 
+class ChannelQueue(asyncio.Queue):
+    "Inbound queue of a channel; reports the data taken from it to the"\
+    " protocol so that it can give the window back to the remote end."
+
+    def __init__(self, protocol, local_cid):
+        super().__init__()
+
+        self.protocol = protocol
+        self.local_cid = local_cid
+
+    def _get(self):
+        item = super()._get()
+
+        if type(item) in (bytes, bytearray, memoryview):
+            self.protocol._channel_data_consumed(self.local_cid, len(item))
+
+        return item
+
+class ChannelFlow(object):
+    "Flow control and scheduling state of a channel."
+
+    def __init__(self, remote_window=CHANNEL_WINDOW_SIZE):
+        # What the remote end still allows us to send, and the window it
+        # started with.
+        self.remote_window = remote_window
+        self.initial_remote_window = remote_window
+        # Data received and consumed locally, not yet given back.
+        self.consumed = 0
+
+        self.pending = deque() # (remote_cid, data) waiting to be sent.
+        self.deficit = 0
+        self.active = False # In the scheduler's active list.
+        self.close_packet = None # CHANNEL_CLOSE to send once drained.
+
+    def can_send(self, size):
+        # A single message larger than the window is let through when nothing
+        # is outstanding, as channel messages can't be split.
+        return size <= self.remote_window\
+            or self.remote_window >= self.initial_remote_window
+
 class ChannelStatus(Enum):
     opening = -1
     closing = -2
@@ -71,24 +174,38 @@ class SshProtocol(asyncio.Protocol):
         self.k = None
         self.h = None
         self.session_id = None
-        self.inCipher = None
+        # Algorithms agreed upon in the KexInit exchange, per direction.
+        self.kex_algorithm = None
+        self.cipher_cs = "aes256-cbc"
+        self.cipher_sc = "aes256-cbc"
+        self.mac_cs = "hmac-sha1"
+        self.mac_sc = "hmac-sha1"
+        self.compression_cs = sshcompress.NONE
+        self.compression_sc = sshcompress.NONE
+        self.inCipher = None # sshcipher.SshCipher or SshGcmCipher.
         self.outCipher = None
-        self.inHmacKey = None
-        self.outHmacKey = None
         self.inHmacSize = 0
         self.outHmacSize = 0
         self.waitingForNewKeys = False
+        self.inCompressor = None # sshcompress.SshZlibDecompressor.
+        self.outCompressor = None # sshcompress.SshZlibCompressor.
 
         self.waiter = None
         self.ready_waiters = []
-        self.buf = bytearray()
-        self.cbuf = self.buf
-        self.packet = None
+        self.buf = bytearray() # Receive buffer.
+        self.buf_pos = 0 # Read offset into buf; data before it is consumed.
+        self.cbuf = None # Clear text of the packet currently being framed.
+        self.cbuf_len = 0
+        self.packets = deque() # Decoded packets waiting for read_packet().
+        self.reading_paused = False
         self.bpLength = None
 
         self.inPacketId = 0
         self.outPacketId = 0
 
+        self.obuf = bytearray() # Write buffer.
+        self._flush_scheduled = False
+
         self.remote_banner = None
         self.local_kex_init_message = None
         self.remote_kex_init_message = None
@@ -98,6 +215,20 @@ class SshProtocol(asyncio.Protocol):
 
         self._implicit_channels_enabled = False
 
+        self._flow_control_enabled = False
+        self._channel_flows = {} # {local_cid, ChannelFlow}
+        self._active_channels = deque() # local_cid with data to send.
+        self._writing_paused = False
+
+        self._rekey_enabled = False
+        self._resumption_enabled = False
+        # Set from sending our KexInit on an established connection until our
+        # NEWKEYS is sent, other packets written meanwhile are held back.
+        self._kex_in_progress = False
+        self._kex_deferred_writes = deque()
+        self._kex_bytes = 0 # Bytes either way since the last key exchange.
+        self._rekey_timer = None
+
     def connection_handler(self, value):
         self.connection_handler = value
 
@@ -108,7 +239,9 @@ class SshProtocol(asyncio.Protocol):
         return self.transport
 
     def close(self):
+        self._cancel_rekey_timer()
         if self.transport:
+            self.flush()
             self.transport.close()
         self.status = Status.closed
 
@@ -138,7 +271,9 @@ class SshProtocol(asyncio.Protocol):
         else:
             local_cid = self._open_channel(channel_type)
 
-        queue = self._create_channel_queue()
+        self._channel_flows[local_cid] = ChannelFlow()
+
+        queue = self._create_channel_queue(local_cid)
         self.channel_queues[local_cid] = queue
 
         if self._implicit_channels_enabled:
@@ -163,8 +298,8 @@ class SshProtocol(asyncio.Protocol):
         msg = mnetpacket.SshChannelOpenMessage()
         msg.channel_type = channel_type
         msg.sender_channel = local_cid
-        msg.initial_window_size = 65535
-        msg.maximum_packet_size = 65535
+        msg.initial_window_size = CHANNEL_WINDOW_SIZE
+        msg.maximum_packet_size = CHANNEL_MAX_PACKET_SIZE
 
         self._channel_map[local_cid] = msg
 
@@ -180,8 +315,8 @@ class SshProtocol(asyncio.Protocol):
         msg = mnetpacket.SshChannelOpenMessage()
         msg.channel_type = channel_type
         msg.sender_channel = local_cid
-        msg.initial_window_size = 65535
-        msg.maximum_packet_size = 65535
+        msg.initial_window_size = CHANNEL_WINDOW_SIZE
+        msg.maximum_packet_size = CHANNEL_MAX_PACKET_SIZE
         msg.encode()
 
         self.write_packet(msg)
@@ -277,6 +412,7 @@ class SshProtocol(asyncio.Protocol):
 
         if type(remote_cid) is mnetpacket.SshChannelOpenMessage:
             del self._channel_map[local_cid]
+            self._channel_flows.pop(local_cid, None)
         else:
             msg = mnetpacket.SshChannelCloseMessage()
 
@@ -287,14 +423,53 @@ class SshProtocol(asyncio.Protocol):
             msg.recipient_channel = remote_cid
             msg.encode()
 
-            self.write_packet(msg)
+            flow = self._channel_flows.get(local_cid)
+            if flow is not None and flow.pending:
+                # Send the close after the data that was written before it.
+                flow.close_packet = msg
+            else:
+                self._channel_flows.pop(local_cid, None)
+                self.write_packet(msg)
 
             self._channel_map[local_cid] = ChannelStatus.closing
 
         yield from self.channel_handler.channel_closed(self, local_cid)
 
-    def _create_channel_queue(self):
-        return asyncio.Queue()
+    def _create_channel_queue(self, local_cid):
+        return ChannelQueue(self, local_cid)
+
+    def _channel_data_consumed(self, local_cid, size):
+        if not self._flow_control_enabled:
+            return
+
+        flow = self._channel_flows.get(local_cid)
+        if flow is None:
+            return
+
+        flow.consumed += size
+        if flow.consumed < CHANNEL_WINDOW_SIZE // 2:
+            return
+
+        remote_cid = self._channel_map.get(local_cid)
+        if type(remote_cid) is not int\
+                and remote_cid is not ChannelStatus.implicit_data_sent:
+            # Closing, no need to give any window back.
+            return
+
+        msg = mnetpacket.SshChannelWindowAdjustMessage()
+        msg.bytes_to_add = flow.consumed
+        flow.consumed = 0
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Sending WINDOW_ADJUST (local_cid=[{}],"\
+                " bytes_to_add=[{}]).".format(local_cid, msg.bytes_to_add))
+
+        if remote_cid is ChannelStatus.implicit_data_sent:
+            self._write_implicit_channel_data(local_cid, remote_cid, msg)
+        else:
+            msg.recipient_channel = remote_cid
+            msg.encode()
+            self.write_packet(msg)
 
     def _allocate_channel_id(self):
         nid = self._next_channel_id
@@ -317,6 +492,10 @@ class SshProtocol(asyncio.Protocol):
 
         log.info("Signature validated correctly!")
 
+        if self.status is Status.ready:
+            # Rekeying, the server is still the one that was authenticated.
+            return True
+
         r = yield from self.connection_handler.peer_authenticated(self)
 
         return r
@@ -331,50 +510,71 @@ class SshProtocol(asyncio.Protocol):
     def set_inbound_enabled(self, val):
         self.inboundEnabled = val
 
+        if val and self.binaryMode and self._buffered():
+            # Packets may have been left undecoded in the buffer while
+            # inbound processing was disabled.
+            self.process_buffer()
+
     @property
     def local_banner(self):
+        banner = "SSH-2.0-mNet_" + '.'.join(str(v) for v in MNET_VERSION)
         if cleartext_transport_enabled:
-            return "SSH-2.0-mNet_0.0.1+cleartext"
+            return banner + "+cleartext"
         else:
-            return "SSH-2.0-mNet_0.0.1"
+            return banner
 
     def init_outbound_encryption(self):
         log.info("Initializing outbound encryption.")
-        # use: AES.MODE_CBC: bs: 16, ks: 32. hmac-sha1=20 key size.
         if not self.server_mode:
-            iiv = self.generateKey(b'A', 16)
-            ekey = self.generateKey(b'C', 32)
-            ikey = self.generateKey(b'E', 20)
+            self.outCipher = self._create_cipher(\
+                self.cipher_cs, self.mac_cs, b'A', b'C', b'E')
         else:
-            iiv = self.generateKey(b'B', 16)
-            ekey = self.generateKey(b'D', 32)
-            ikey = self.generateKey(b'F', 20)
-
-        if log.isEnabledFor(logging.DEBUG):
-            log.debug("ekey=[{}], iiv=[{}].".format(ekey, iiv))
+            self.outCipher = self._create_cipher(\
+                self.cipher_sc, self.mac_sc, b'B', b'D', b'F')
 
-        self.outCipher = AES.new(ekey, AES.MODE_CBC, iiv)
-        self.outHmacKey = ikey
-        self.outHmacSize = 20
+        self.outHmacSize = self.outCipher.mac_size
 
     def init_inbound_encryption(self):
         log.info("Initializing inbound encryption.")
-        # use: AES.MODE_CBC: bs: 16, ks: 32. hmac-sha1=20 key size.
         if not self.server_mode:
-            iiv = self.generateKey(b'B', 16)
-            ekey = self.generateKey(b'D', 32)
-            ikey = self.generateKey(b'F', 20)
+            self.inCipher = self._create_cipher(\
+                self.cipher_sc, self.mac_sc, b'B', b'D', b'F')
         else:
-            iiv = self.generateKey(b'A', 16)
-            ekey = self.generateKey(b'C', 32)
-            ikey = self.generateKey(b'E', 20)
+            self.inCipher = self._create_cipher(\
+                self.cipher_cs, self.mac_cs, b'A', b'C', b'E')
+
+        self.inHmacSize = self.inCipher.mac_size
+
+    def start_outbound_compression(self):
+        name = self.compression_sc if self.server_mode else self.compression_cs
+        self.outCompressor = sshcompress.create_compressor(name)
+
+        if self.outCompressor and log.isEnabledFor(logging.INFO):
+            log.info("Starting outbound compression [{}] (address=[{}])."\
+                .format(name, self.address))
+
+    def start_inbound_compression(self):
+        name = self.compression_cs if self.server_mode else self.compression_sc
+        self.inCompressor =\
+            sshcompress.create_decompressor(name, MAX_PACKET_LENGTH)
+
+        if self.inCompressor and log.isEnabledFor(logging.INFO):
+            log.info("Starting inbound compression [{}] (address=[{}])."\
+                .format(name, self.address))
+
+    def _create_cipher(self, cipher_name, mac_name, iv_c, key_c, mac_key_c):
+        key_size, iv_size, mac_key_size =\
+            sshcipher.get_key_sizes(cipher_name, mac_name)
+
+        iiv = self.generateKey(iv_c, iv_size)
+        ekey = self.generateKey(key_c, key_size)
+        ikey = self.generateKey(mac_key_c, mac_key_size)
 
         if log.isEnabledFor(logging.DEBUG):
-            log.debug("ekey=[{}], iiv=[{}].".format(ekey, iiv))
+            log.debug("cipher=[{}], mac=[{}], ekey=[{}], iiv=[{}]."\
+                .format(cipher_name, mac_name, ekey, iiv))
 
-        self.inCipher = AES.new(ekey, AES.MODE_CBC, iiv)
-        self.inHmacKey = ikey
-        self.inHmacSize = 20
+        return sshcipher.create_cipher(cipher_name, mac_name, ekey, iiv, ikey)
 
     def generateKey(self, extra, needed_bytes):
         assert isinstance(extra, bytes) and len(extra) == 1
@@ -418,6 +618,14 @@ class SshProtocol(asyncio.Protocol):
             if "-mNet_" in self.remote_banner:
                 self._implicit_channels_enabled = True
 
+                version = _parse_mnet_version(self.remote_banner)
+                if version and version >= FLOW_CONTROL_MIN_MNET_VERSION:
+                    self._flow_control_enabled = True
+                if version and version >= REKEY_MIN_MNET_VERSION:
+                    self._rekey_enabled = True
+                if version and version >= RESUMPTION_MIN_MNET_VERSION:
+                    self._resumption_enabled = True
+
             if cleartext_transport_enabled\
                     and self.remote_banner.endswith("+cleartext"):
                 r = yield from connectTaskInsecure(self, self.server_mode)
@@ -441,6 +649,9 @@ class SshProtocol(asyncio.Protocol):
         # Connected and fully authenticated at this point.
         self.status = Status.ready
 
+        if self._rekey_enabled and self.outCipher:
+            self._schedule_rekey()
+
         for waiter in self.ready_waiters:
             waiter.set_result(False)
         self.ready_waiters.clear()
@@ -454,6 +665,100 @@ class SshProtocol(asyncio.Protocol):
 
             yield from self._process_ssh_packet(packet)
 
+    def _schedule_rekey(self):
+        self._cancel_rekey_timer()
+        self._rekey_timer = self.loop.call_later(REKEY_INTERVAL, self.rekey)
+
+    def _cancel_rekey_timer(self):
+        if self._rekey_timer:
+            self._rekey_timer.cancel()
+            self._rekey_timer = None
+
+    def rekey(self):
+        "Starts a new key exchange on the established connection by sending"\
+        " our KexInit; _rekey() completes it once the remote end answers with"\
+        " its own."
+
+        if self._kex_in_progress or self.status is not Status.ready\
+                or not self._rekey_enabled or not self.outCipher:
+            return
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Rekeying connection (address=[{}], bytes=[{}])."\
+                .format(self.address, self._kex_bytes))
+
+        self._send_kex_init()
+
+    def _send_kex_init(self):
+        self._cancel_rekey_timer()
+        self._kex_in_progress = True
+        self._kex_bytes = 0
+
+        msg = _create_kex_init_message([kexdhgroup14sha1.KexDhGroup14Sha1.name])
+        self.local_kex_init_message = msg.buf
+
+        self.write_packet(msg)
+
+    @asyncio.coroutine
+    def _rekey(self, packet):
+        if not self._rekey_enabled:
+            raise SshException("Remote end sent a KEXINIT on an established"\
+                " connection but doesn't support rekeying.")
+
+        if not self._kex_in_progress:
+            # The remote end started it.
+            self._send_kex_init()
+
+        self.remote_kex_init_message = packet
+
+        local_msg = mnetpacket.SshKexInitMessage(self.local_kex_init_message)
+        remote_msg = mnetpacket.SshKexInitMessage(packet)
+
+        if not _negotiate_algorithms(self, local_msg, remote_msg):
+            self.close()
+            return
+
+        if self.kex_algorithm != kexdhgroup14sha1.KexDhGroup14Sha1.name:
+            raise SshException("Remote end chose kex [{}] for rekeying."\
+                .format(self.kex_algorithm))
+
+        self.waitingForNewKeys = True
+
+        ke = kexdhgroup14sha1.KexDhGroup14Sha1(self)
+        r = yield from ke.run()
+        if not r:
+            self.close()
+            return
+
+        self.init_outbound_encryption()
+
+        self._kex_in_progress = False
+        deferred = self._kex_deferred_writes
+        while deferred and not self._kex_in_progress:
+            self.write_data(deferred.popleft())
+
+        packet = yield from self.read_packet()
+        if not packet:
+            return
+
+        mnetpacket.SshNewKeysMessage(packet)
+
+        if not self.server_mode:
+            # See connectTaskSecure(..), but here the NEWKEYS is read before
+            # switching as the remote end may have sent other packets before
+            # its KexInit.
+            self.init_inbound_encryption()
+            self.set_inbound_enabled(True)
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Rekeyed connection (address=[{}])."\
+                .format(self.address))
+
+        self._schedule_rekey()
+
+        if self._resumption_enabled:
+            kexresume.issue_ticket(self)
+
     def _fix_implicit_msg(self, msg):
         "Returns remote_cid."
 
@@ -503,7 +808,7 @@ class SshProtocol(asyncio.Protocol):
                     log.info("Channel [{}] opened (address=[{}])."\
                         .format(local_cid, self.address))
 
-                queue = self._create_channel_queue()
+                queue = self._create_channel_queue(local_cid)
                 self.channel_queues[local_cid] = queue
 
                 yield from self.channel_handler.channel_opened(\
@@ -542,6 +847,11 @@ class SshProtocol(asyncio.Protocol):
 
             self._channel_map[msg.recipient_channel] = msg.sender_channel
 
+            flow = self._channel_flows.get(msg.recipient_channel)
+            if flow is not None:
+                flow.remote_window = flow.initial_remote_window =\
+                    msg.initial_window_size
+
             if log.isEnabledFor(logging.INFO):
                 log.info("Channel [{}] opened (address=[{}])."\
                     .format(msg.recipient_channel, self.address))
@@ -590,7 +900,11 @@ class SshProtocol(asyncio.Protocol):
             r = yield from self.channel_handler.channel_data(\
                 self, msg.recipient_channel, msg.data)
 
-            if not r:
+            if r:
+                # Handled without going through the channel queue.
+                self._channel_data_consumed(\
+                    msg.recipient_channel, len(msg.data))
+            else:
                 log.info(\
                     "Adding protocol (address={}) channel [{}] data"\
                     " to queue (remote_cid=[{}])."\
@@ -598,6 +912,30 @@ class SshProtocol(asyncio.Protocol):
                 yield from self.channel_queues[msg.recipient_channel]\
                     .put(msg.data)
 
+        elif t == mnetpacket.SSH_MSG_CHANNEL_WINDOW_ADJUST:
+            msg = mnetpacket.SshChannelWindowAdjustMessage(packet, offset)
+
+            if offset:
+                local_cid = self._reverse_channel_map.get(msg.recipient_channel)
+            else:
+                local_cid = msg.recipient_channel
+
+            flow = self._channel_flows.get(local_cid)
+            if flow is None:
+                log.info("Received WINDOW_ADJUST for unknown channel;"\
+                    " ignoring.")
+                return
+
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Received WINDOW_ADJUST (local_cid=[{}],"\
+                    " bytes_to_add=[{}]).".format(local_cid, msg.bytes_to_add))
+
+            flow.remote_window += msg.bytes_to_add
+
+            if flow.pending:
+                self._activate_channel(local_cid, flow)
+                self._send_pending_channel_data()
+
         elif t == mnetpacket.SSH_MSG_CHANNEL_CLOSE:
             msg = mnetpacket.SshChannelCloseMessage(packet)
 
@@ -636,6 +974,13 @@ class SshProtocol(asyncio.Protocol):
                         msg.want_reply))
 
             yield from self.channel_handler.channel_request(self, msg)
+        elif t == mnetpacket.SSH_MSG_KEXINIT:
+            try:
+                yield from self._rekey(packet)
+            except Exception as e:
+                log.warning("Error rekeying connection (address=[{}]): {}"\
+                    .format(self.address, e))
+                self.close()
         else:
             log.warning("Unhandled packet of type [{}].".format(t))
 
@@ -649,14 +994,17 @@ class SshProtocol(asyncio.Protocol):
         self._channel_map[local_cid] = req_msg.sender_channel
         self._reverse_channel_map[req_msg.sender_channel] = local_cid
 
+        self._channel_flows[local_cid] =\
+            ChannelFlow(req_msg.initial_window_size)
+
         if self._implicit_channels_enabled:
             return local_cid
 
         cm = mnetpacket.SshChannelOpenConfirmationMessage()
         cm.recipient_channel = req_msg.sender_channel
         cm.sender_channel = local_cid
-        cm.initial_window_size = 65535
-        cm.maximum_packet_size = 65535
+        cm.initial_window_size = CHANNEL_WINDOW_SIZE
+        cm.maximum_packet_size = CHANNEL_MAX_PACKET_SIZE
 
         cm.encode()
 
@@ -684,6 +1032,9 @@ class SshProtocol(asyncio.Protocol):
         if remote_cid is None:
             return False
 
+        # Anything still queued can no longer be delivered.
+        self._channel_flows.pop(local_cid, None)
+
         # This means we didn't open it yet so other end can't close it.
         assert type(remote_cid) is not mnetpacket.SshChannelOpenMessage
 
@@ -728,9 +1079,20 @@ class SshProtocol(asyncio.Protocol):
     def connection_lost(self, exc):
         log.info("X: Connection lost to [{}].".format(self.address))
 
+        c = self.outCompressor
+        if c and log.isEnabledFor(logging.INFO):
+            log.info("Compression (address=[{}]): deflated [{}] bytes to [{}],"\
+                " stored [{}] packets.".format(self.address, c.deflated,\
+                    c.deflated_size, c.stored))
+
         self.status = Status.closed
 
+        self._cancel_rekey_timer()
+        self._kex_deferred_writes.clear()
+
         self._channel_map.clear()
+        self._channel_flows.clear()
+        self._active_channels.clear()
 
         self._close_queues()
 
@@ -755,8 +1117,8 @@ class SshProtocol(asyncio.Protocol):
             log.debug("X: Received: [\n{}].".format(hex_dump(data)))
 
         if self.binaryMode:
-            self.buf += data
-            if not self.packet and self.inboundEnabled:
+            self._append_buffer(data)
+            if self.inboundEnabled:
                 self.process_buffer()
             log.debug("data_received(..): end (binaryMode).")
             return
@@ -765,23 +1127,42 @@ class SshProtocol(asyncio.Protocol):
         end = data.find(b"\r\n")
         if end != -1:
             self.buf += data[0:end]
-            self.packet = self.buf
-            self.buf = data[end+2:]
+            self.packets.append(self.buf)
+            self.buf = bytearray(data[end+2:])
+            self.buf_pos = 0
             self.binaryMode = True
 
             if self.waiter != None:
                 self.waiter.set_result(False)
                 self.waiter = None
 
-            # The following would overwrite packet if it were a complete
-            # packet in the buf.
-#            if len(self.buf) > 0:
-#                self.process_buffer()
+            if self.inboundEnabled and self._buffered():
+                self.process_buffer()
         else:
             self.buf += data
 
         log.debug("data_received(..): end.")
 
+    def _append_buffer(self, data):
+        buf = self.buf
+        pos = self.buf_pos
+
+        if pos:
+            # Drop the consumed front of the buffer only when it is all of it
+            # or when it has grown big, instead of reslicing every packet.
+            if pos == len(buf):
+                buf.clear()
+                self.buf_pos = 0
+            elif pos >= RECEIVE_BUFFER_COMPACT_SIZE:
+                del buf[:pos]
+                self.buf_pos = 0
+
+        buf += data
+
+    def _buffered(self):
+        "Returns the amount of unprocessed bytes in the receive buffer."
+        return len(self.buf) - self.buf_pos
+
     @asyncio.coroutine
     def do_wait(self):
         if self.waiter is not None:
@@ -806,39 +1187,24 @@ class SshProtocol(asyncio.Protocol):
             log.debug(errstr)
             raise SshException(errstr)
 
-        if self.packet != None:
-            packet = self.packet
-            self.packet = None
-
-            if packet[0] == 0x01:
-                yield from\
-                    self._peer_disconnected(\
-                        mnetpacket.SshDisconnectMessage(packet))
+        if not self.packets:
+            if self.status is Status.closed\
+                    or self.status is Status.disconnected:
                 return None
 
-            log.info("P: Returning next packet.")
+            log.info("P: Waiting for packet.")
+            yield from self.do_wait()
 
-            #asyncio.call_soon(self.process_buffer())
-            # For now, call process_buffer in this event.
-            if len(self.buf) > 0:
-                self.process_buffer()
-
-            return packet
-
-        if self.status is Status.closed or self.status is Status.disconnected:
-            return None
-
-        log.info("P: Waiting for packet.")
-        yield from self.do_wait()
+            if self.status is Status.closed\
+                    or self.status is Status.disconnected:
+                return None
 
-        if self.status is Status.closed or self.status is Status.disconnected:
-            return None
+            log.info("P: Notified of packet.")
 
-        assert self.packet != None
-        packet = self.packet
-        self.packet = None
+        packet = self.packets.popleft()
 
-        log.info("P: Notified of packet.")
+        if self.inCompressor:
+            packet = self.inCompressor.decompress(packet)
 
         if packet[0] == 0x01:
             yield from\
@@ -846,12 +1212,27 @@ class SshProtocol(asyncio.Protocol):
                     mnetpacket.SshDisconnectMessage(packet))
             return None
 
-        # For now, call process_buffer in this event.
-        if len(self.buf) > 0:
-            self.process_buffer()
+        log.info("P: Returning next packet.")
+
+        if self.reading_paused\
+                and len(self.packets) <= PACKET_QUEUE_LOW_WATER:
+            self._resume_inbound()
 
         return packet
 
+    def _resume_inbound(self):
+        # Decode what was left in the buffer when the queue filled up before
+        # reading more from the transport.
+        if self.inboundEnabled and self._buffered():
+            self.process_buffer()
+
+        if self.reading_paused\
+                and len(self.packets) < PACKET_QUEUE_HIGH_WATER\
+                and self.status is not Status.closed:
+            log.debug("Resuming reading from transport.")
+            self.reading_paused = False
+            self.transport.resume_reading()
+
     def _peer_disconnected(self, msg):
         if log.isEnabledFor(logging.INFO):
             log.info("Remote end (address=[{}]) send Disconnect message"\
@@ -878,29 +1259,124 @@ class SshProtocol(asyncio.Protocol):
         if remote_cid is None:
             return False
 
+        flow = self._channel_flows.get(local_cid)
+
+        # The first data of an implicit channel carries the open, so it is
+        # never held back.
+        if flow is not None\
+                and type(remote_cid) is not mnetpacket.SshChannelOpenMessage\
+                and (flow.pending or self._writing_paused\
+                    or (self._flow_control_enabled\
+                        and not flow.can_send(len(data)))):
+            flow.pending.append((remote_cid, data))
+            self._activate_channel(local_cid, flow)
+            self._send_pending_channel_data()
+            return True
+
+        self._write_channel_data(local_cid, remote_cid, data, flow)
+        return True
+
+    def _write_channel_data(self, local_cid, remote_cid, data, flow):
         msg = mnetpacket.SshChannelDataMessage()
 
+        if flow is not None:
+            flow.remote_window -= len(data)
+
         if self._implicit_channels_enabled:
             if type(remote_cid) is not int:
                 self._write_implicit_channel_data(\
                     local_cid, remote_cid, msg, data)
-                return True
+                return
 
         msg.recipient_channel = remote_cid
 
         self.write_data((msg.encode(), data))
-        return True
+
+    def _activate_channel(self, local_cid, flow):
+        if not flow.active:
+            flow.active = True
+            self._active_channels.append(local_cid)
+
+    def _send_pending_channel_data(self):
+        "Sends queued channel data, deficit round robin between the channels"\
+        " so that a bulk transfer can't starve the others, until writing is"\
+        " paused or no channel can send anymore."
+
+        active = self._active_channels
+        flow_control = self._flow_control_enabled
+
+        while active and not self._writing_paused:
+            local_cid = active.popleft()
+            flow = self._channel_flows.get(local_cid)
+            if flow is None or not flow.active:
+                # Closed since.
+                continue
+
+            flow.deficit += CHANNEL_QUANTUM
+            pending = flow.pending
+            window_blocked = False
+
+            while pending and not self._writing_paused:
+                remote_cid, data = pending[0]
+                size = len(data)
+
+                if flow_control and not flow.can_send(size):
+                    window_blocked = True
+                    break
+                if size > flow.deficit:
+                    break
+
+                pending.popleft()
+                flow.deficit -= size
+
+                self._write_channel_data(local_cid, remote_cid, data, flow)
+
+            if not pending:
+                flow.active = False
+                flow.deficit = 0
+
+                if flow.close_packet:
+                    self.write_packet(flow.close_packet)
+                    del self._channel_flows[local_cid]
+            elif window_blocked:
+                # Reactivated when a WINDOW_ADJUST arrives.
+                flow.active = False
+                flow.deficit = 0
+            else:
+                active.append(local_cid)
+
+    def pause_writing(self):
+        log.info("Pausing writing to connection (address=[{}])."\
+            .format(self.address))
+        self._writing_paused = True
+
+    def resume_writing(self):
+        log.info("Resuming writing to connection (address=[{}])."\
+            .format(self.address))
+        self._writing_paused = False
+        self._send_pending_channel_data()
 
     def write_data(self, datas):
         if self.status in [Status.closed, Status.disconnected]:
             log.info("ProtocolHandler closed, ignoring write_data(..) call.")
             return
 
+        if self._kex_in_progress and datas[0][0] >= 50:
+            # Only transport layer messages (1 to 49) may be sent during a key
+            # exchange (RFC 4253 7.1). The caller may reuse its buffers.
+            self._kex_deferred_writes.append([bytes(data) for data in datas])
+            return
+
+        if self.outCompressor:
+            datas = self.outCompressor.compress(datas)
+
+        cipher = self.outCipher
+
         mod_size = None
-        if self.outCipher == None:
+        if cipher == None:
             mod_size = 8 # RFC says 8 minimum.
         else:
-            mod_size = 16 # bs of current cipher is 16.
+            mod_size = cipher.block_size
 
         length = 0
         for data in datas:
@@ -910,7 +1386,11 @@ class SshProtocol(asyncio.Protocol):
             log.info("Writing {} bytes of data to connection (address=[{}])."\
                 .format(length, self.address))
 
-        extra = (length + 5) % mod_size;
+        if cipher and cipher.aead:
+            # The packet_length field is not encrypted so isn't counted.
+            extra = (length + 1) % mod_size;
+        else:
+            extra = (length + 5) % mod_size;
         if extra != 0:
             padding = mod_size - extra
             if padding < 4:
@@ -918,36 +1398,68 @@ class SshProtocol(asyncio.Protocol):
         else:
             padding = mod_size; #Minimum padding is 4.
 
-        if self.outCipher == None:
-            self.transport.write(struct.pack(">L", 1 + length + padding))
-            self.transport.write(struct.pack("B", padding & 0xff))
-            for data in datas:
-                self.transport.write(data)
-            for i in range(0, padding):
-                self.transport.write(struct.pack("B", 0))
+        obuf = self.obuf
+        start = len(obuf)
+
+        obuf += struct.pack(">LB", 1 + length + padding, padding & 0xff)
+        for data in datas:
+            obuf += data
+
+        if cipher == None:
+            obuf += bytes(padding)
         else:
-            buf = bytearray()
-            buf += struct.pack(">L", 1 + length + padding)
-            buf += struct.pack("B", padding & 0xff)
-            for data in datas:
-                buf += data
-            buf += os.urandom(padding)
+            obuf += os.urandom(padding)
 
             if log.isEnabledFor(logging.DEBUG):
-                log.debug("len(buf)=[{}], padding=[{}].".format(len(buf), padding))
-
-            if self.outHmacSize != 0:
-                tmac = hmac.new(self.outHmacKey, digestmod=sha1)
-                tmac.update(struct.pack(">L", self.outPacketId))
-                tmac.update(buf)
+                log.debug("len(buf)=[{}], padding=[{}]."\
+                    .format(len(obuf) - start, padding))
 
-                out = self.outCipher.encrypt(bytes(buf))
+            with memoryview(obuf) as mobuf, mobuf[start:] as pbuf:
+                if cipher.aead:
+                    mac = cipher.seal_in_place(pbuf[:4], pbuf[4:])
+                else:
+                    mac = cipher.calc_mac(self.outPacketId, pbuf)
+                    cipher.encrypt_in_place(pbuf)
 
-                self.transport.write(out)
-                self.transport.write(tmac.digest())
+            obuf += mac
 
         self.outPacketId = (self.outPacketId + 1) & 0xFFFFFFFF
 
+        self._kex_bytes += length
+        if self._kex_bytes >= REKEY_BYTES:
+            self.rekey()
+
+        if len(obuf) >= WRITE_BUFFER_FLUSH_SIZE:
+            self.flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.loop.call_soon(self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        self._flush_scheduled = False
+        self.flush()
+
+    def flush(self):
+        "Hands everything in the write buffer to the transport in one write."
+
+        if not self.obuf:
+            return
+
+        if self.status is Status.closed:
+            self.obuf.clear()
+            return
+
+        # The transport may keep a reference to what it is given if it can't
+        # send it all right away, so give it this buffer and start a new one.
+        obuf = self.obuf
+        self.obuf = bytearray()
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Flushing {} bytes to connection (address=[{}])."\
+                .format(len(obuf), self.address))
+
+        self.transport.write(obuf)
+
     def process_buffer(self):
         try:
             self._process_buffer()
@@ -958,160 +1470,168 @@ class SshProtocol(asyncio.Protocol):
 
     def _process_buffer(self):
         if log.isEnabledFor(logging.DEBUG):
-            log.debug("P: process_buffer(): called (binaryMode={}), buf=[\n{}].".format(self.binaryMode, hex_dump(self.buf)))
+            log.debug("P: process_buffer(): called (binaryMode={}),"\
+                " buffered=[{}].".format(self.binaryMode, self._buffered()))
 
         assert self.binaryMode
 
-        r = self._process_encrypted_buffer()
-        if not r:
-            return
+        packets = self.packets
+        cnt = 0
+
+        # Decode every complete packet in the buffer in one pass.
+        while self.inboundEnabled and len(packets) < PACKET_QUEUE_HIGH_WATER:
+            payload = self._frame_packet()
+            if payload is None:
+                break
+
+            if self.waitingForNewKeys:
+                # Skip the compression flag, transport layer messages are
+                # never deflated.
+                packet_type = mnetpacket.SshPacket.parse_type(\
+                    payload, 1 if self.inCompressor else 0)
+                if packet_type == mnetpacket.SSH_MSG_NEWKEYS:
+                    if self.server_mode:
+                        self.init_inbound_encryption()
+                    else:
+                        # Disable further processing until inbound
+                        # encryption is setup. It may not have yet as
+                        # parameters and newkeys may have come in same tcp
+                        # packet.
+                        self.set_inbound_enabled(False)
+                    self.waitingForNewKeys = False
+
+            packets.append(payload)
+            self.inPacketId = (self.inPacketId + 1) & 0xFFFFFFFF
+            self._kex_bytes += len(payload)
+            cnt += 1
+
+        if len(packets) >= PACKET_QUEUE_HIGH_WATER\
+                and not self.reading_paused:
+            log.debug("Packet queue full, pausing reading from transport.")
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+        if cnt and self.waiter != None:
+            self.waiter.set_result(False)
+            self.waiter = None
 
-        # cbuf is clear text buf.
-        while True:
-            if self.bpLength is None:
-                assert not self.inCipher
+        if self._kex_bytes >= REKEY_BYTES:
+            self.rekey()
+
+    def _frame_packet(self):
+        "Frames the next packet out of the receive buffer. The packet is"\
+        " decrypted (or copied in cleartext mode) exactly once, straight"\
+        " from the receive buffer into a clear text buffer allocated for that"\
+        " packet only, so the returned payload can be handed up as a"\
+        " memoryview without further copying. Returns None if the packet is"\
+        " not complete yet."
+
+        cipher = self.inCipher
+        if not cipher:
+            blksize = 1
+            head_size = 4
+            aead = False
+        else:
+            blksize = cipher.block_size
+            aead = cipher.aead
+            if aead:
+                # Only the packet_length is needed, and it is in the clear.
+                head_size = 4
+            else:
+                head_size = blksize
 
-                if len(self.cbuf) < 4:
-                    return
+        buf = self.buf
+        pos = self.buf_pos
+        avail = len(buf) - pos
 
-                if log.isEnabledFor(logging.DEBUG):
-                    log.debug("t=[{}].".format(self.cbuf[:4]))
+        with memoryview(buf) as mbuf:
+            cbuf = self.cbuf
+
+            if cbuf is None:
+                if avail < head_size:
+                    return None
 
-                packet_length = struct.unpack(">L", self.cbuf[:4])[0]
+                head = mbuf[pos:pos + head_size]
+                if cipher and not aead:
+                    head_out = bytearray(head_size)
+                    cipher.decrypt_into(head, memoryview(head_out))
+                    head = head_out
+
+                packet_length = struct.unpack_from(">L", head)[0]
 
                 if log.isEnabledFor(logging.DEBUG):
                     log.debug("packet_length=[{}].".format(packet_length))
 
-                if packet_length > MAX_PACKET_LENGTH:
+                # Add size of packet_length as we leave it in cbuf.
+                bp_length = packet_length + 4
+
+                if packet_length > MAX_PACKET_LENGTH or packet_length < 5\
+                        or bp_length < head_size\
+                        or (packet_length if aead else bp_length) % blksize:
                     errmsg = "Illegal packet_length [{}] received."\
                         .format(packet_length)
                     log.warning(errmsg)
                     raise SshException(errmsg)
 
-                self.bpLength = packet_length + 4 # Add size of packet_length as we leave it in buf.
-            else:
-                if len(self.cbuf) < self.bpLength or len(self.buf) < self.inHmacSize:
-                    return;
-
-                if log.isEnabledFor(logging.DEBUG):
-                    log.debug("PACKET READ (bpLength={}, inHmacSize={}, len(self.cbuf)={}, len(self.buf)={})".format(self.bpLength, self.inHmacSize, len(self.cbuf), len(self.buf)))
+                self.bpLength = bp_length
+                cbuf = self.cbuf = bytearray(bp_length)
+                cbuf[:head_size] = head
+                self.cbuf_len = head_size
 
-                padding_length = struct.unpack("B", self.cbuf[4:5])[0]
-                log.debug("padding_length=[{}].".format(padding_length))
+                pos += head_size
+                avail -= head_size
 
-                padding_offset = self.bpLength - padding_length
+            remaining = self.bpLength - self.cbuf_len
 
-                payload = self.cbuf[5:padding_offset]
-                padding = self.cbuf[padding_offset:self.bpLength]
-#                mac = self.cbuf[self.bpLength:self.bpLength + self.inHmacSize]
-                mac = self.buf[:self.inHmacSize]
+            if avail < remaining + self.inHmacSize:
+                # Wait for the rest of the packet so that it is decrypted
+                # with a single call instead of one per TCP segment.
+                self.buf_pos = pos
+                return None
 
-                if log.isEnabledFor(logging.DEBUG):
-                    log.debug("payload=[\n{}], padding=[\n{}], mac=[\n{}] len(mac)={}.".format(hex_dump(payload), hex_dump(padding), hex_dump(mac), len(mac)))
-
-                if self.inHmacSize != 0:
-                    self.buf = self.buf[self.inHmacSize:]
-
-                    mbuf = struct.pack(">L", self.inPacketId)
-                    tmac = hmac.new(self.inHmacKey, digestmod=sha1)
-                    tmac.update(mbuf)
-                    tmac.update(self.cbuf)
-                    cmac = tmac.digest()
-                    if log.isEnabledFor(logging.DEBUG):
-                        log.debug("inPacketId={} len(cmac)={}, cmac=[\n{}].".format(self.inPacketId, len(cmac), hex_dump(cmac)))
-                    r = hmac.compare_digest(cmac, mac)
+            start = self.cbuf_len
+            end = pos + remaining
+            mac = mbuf[end:end + self.inHmacSize]
+
+            if aead:
+                with memoryview(cbuf) as mcbuf:
+                    cipher.open_into(\
+                        mcbuf[:start], mbuf[pos:end], mac, mcbuf[start:])
+            elif remaining:
+                with memoryview(cbuf) as mcbuf:
+                    if cipher:
+                        cipher.decrypt_into(mbuf[pos:end], mcbuf[start:])
+                    else:
+                        mcbuf[start:] = mbuf[pos:end]
+
+            self.cbuf_len += remaining
+            pos = end + self.inHmacSize
+
+            if self.inHmacSize and not aead:
+                r = hmac.compare_digest(\
+                    cipher.calc_mac(self.inPacketId, cbuf), mac)
+                if log.isEnabledFor(logging.INFO):
                     log.info("HMAC check result: [{}].".format(r))
-                    if not r:
-                        raise SshException("HMAC check failure, packetId={}.".format(self.inPacketId))
-
-                newbuf = self.cbuf[self.bpLength + self.inHmacSize:]
-                if self.cbuf == self.buf:
-                    self.cbuf = bytearray()
-                    self.buf = newbuf
-                else:
-                    self.cbuf = newbuf
-
-                if self.waitingForNewKeys:
-                    packet_type = mnetpacket.SshPacket.parse_type(payload)
-                    if packet_type == mnetpacket.SSH_MSG_NEWKEYS:
-                        if self.server_mode:
-                            self.init_inbound_encryption()
-                        else:
-                            # Disable further processing until inbound
-                            # encryption is setup. It may not have yet as
-                            # parameters and newkeys may have come in same tcp
-                            # packet.
-                            self.set_inbound_enabled(False)
-                        self.waitingForNewKeys = False
-
-                self.packet = payload
-                self.inPacketId = (self.inPacketId + 1) & 0xFFFFFFFF
-
-                self.bpLength = None
-
-                if self.waiter != None:
-                    self.waiter.set_result(False)
-                    self.waiter = None
-
-                break;
-
-    def _process_encrypted_buffer(self):
-        blksize = 16
-
-        if self.inCipher != None:
-#            if len(self.buf) > 20: # max(blksize, 20): bs, hmacSize
-            if len(self.buf) < blksize:
-                return False
-
-            if len(self.cbuf) == 0:
-                out = self.inCipher.decrypt(self.buf[:blksize])
-                if log.isEnabledFor(logging.DEBUG):
-                    log.debug("Decrypted [\n{}] to [\n{}]."\
-                        .format(hex_dump(self.buf[:blksize]), hex_dump(out)))
-                self.cbuf += out
-                packet_length = struct.unpack(">L", out[:4])[0]
-                log.debug("packet_length=[{}].".format(packet_length))
-                if packet_length > MAX_PACKET_LENGTH:
-                    errmsg = "Illegal packet_length [{}] received."\
-                        .format(packet_length)
-                    log.warning(errmsg)
-                    raise SshException(errmsg)
-
-                # Add size of packet_length as we leave it in buf.
-                self.bpLength = packet_length + 4
-
-                self.buf = self.buf[blksize:]
-
-                if self.bpLength == blksize:
-                    return True
+                if not r:
+                    raise SshException("HMAC check failure, packetId={}."\
+                        .format(self.inPacketId))
 
-            if len(self.buf) < min(\
-                    1024, self.bpLength - len(self.cbuf) + self.inHmacSize):
-                return True
+            self.buf_pos = pos
 
-            l = min(len(self.buf), self.bpLength - len(self.cbuf))
-            if not l:
-                return True
+        padding_offset = self.bpLength - cbuf[4]
+        if padding_offset < 5:
+            raise SshException("Illegal padding_length [{}] received."\
+                .format(cbuf[4]))
 
-            dsize = l - (l % blksize)
-            blks = self.buf[:dsize]
-            self.buf = self.buf[dsize:]
-            assert len(blks) % blksize == 0,\
-                "len(blks)=[{}], dsize=[{}], l=[{}],"\
-                " len(self.buf)=[{}], len(self.cbuf)=[{}], blksize=[{}],"\
-                " self.bpLength=[{}], type(blks)=[{}]."\
-                    .format(len(blks), dsize, l, len(self.buf),\
-                        len(self.cbuf), blksize, self.bpLength, type(blks))
-            out = self.inCipher.decrypt(blks)
-            self.cbuf += out
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("PACKET READ (bpLength={}, inHmacSize={},"\
+                " buffered={}).".format(\
+                    self.bpLength, self.inHmacSize, self._buffered()))
 
-            if log.isEnabledFor(logging.DEBUG):
-                log.debug("Decrypted [\n{}] to [\n{}].".format(hex_dump(blks), hex_dump(out)))
-                log.debug("len(cbuf)={}, cbuf=[\n{}]".format(len(self.cbuf), hex_dump(self.cbuf)))
-        else:
-            self.cbuf = self.buf
+        self.cbuf = None
+        self.bpLength = None
 
-        return True
+        return memoryview(cbuf)[5:padding_offset]
 
 class SshServerProtocol(SshProtocol):
     def __init__(self, loop):
@@ -1211,25 +1731,117 @@ def connectTaskInsecure(protocol, server_mode):
 
     return True
 
-# Returns True on success, False on failure.
-@asyncio.coroutine
-def connectTaskSecure(protocol, server_mode):
-    # Send KexInit packet.
+def _negotiate_algorithms(protocol, local_kex_init, remote_kex_init):
+    "Picks the cipher and MAC for each direction from the two KexInit"\
+    " messages. Returns False if there is no algorithm in common."
+
+    if protocol.server_mode:
+        ckex, skex = remote_kex_init, local_kex_init
+    else:
+        ckex, skex = local_kex_init, remote_kex_init
+
+    kex_algorithm = sshcipher.choose_algorithm(\
+        ckex.kex_algorithms, skex.kex_algorithms)
+
+    if not kex_algorithm:
+        log.warning("No kex algorithm in common with peer (address=[{}]),"\
+            " disconnecting.".format(protocol.address))
+        return False
+
+    cipher_cs = sshcipher.choose_algorithm(\
+        ckex.encryption_algorithms_client_to_server,\
+        skex.encryption_algorithms_client_to_server)
+    cipher_sc = sshcipher.choose_algorithm(\
+        ckex.encryption_algorithms_server_to_client,\
+        skex.encryption_algorithms_server_to_client)
+
+    if not cipher_cs or not cipher_sc:
+        log.warning("No cipher in common with peer (address=[{}]),"\
+            " disconnecting.".format(protocol.address))
+        return False
+
+    # The MAC is implicit with an AEAD cipher.
+    if sshcipher.is_aead(cipher_cs):
+        mac_cs = None
+    else:
+        mac_cs = sshcipher.choose_algorithm(\
+            ckex.mac_algorithms_client_to_server,\
+            skex.mac_algorithms_client_to_server)
+    if sshcipher.is_aead(cipher_sc):
+        mac_sc = None
+    else:
+        mac_sc = sshcipher.choose_algorithm(\
+            ckex.mac_algorithms_server_to_client,\
+            skex.mac_algorithms_server_to_client)
+
+    if (not mac_cs and not sshcipher.is_aead(cipher_cs))\
+            or (not mac_sc and not sshcipher.is_aead(cipher_sc)):
+        log.warning("No MAC in common with peer (address=[{}]),"\
+            " disconnecting.".format(protocol.address))
+        return False
+
+    compression_cs = sshcipher.choose_algorithm(\
+        ckex.compression_algorithms_client_to_server,\
+        skex.compression_algorithms_client_to_server)
+    compression_sc = sshcipher.choose_algorithm(\
+        ckex.compression_algorithms_server_to_client,\
+        skex.compression_algorithms_server_to_client)
+
+    if not compression_cs or not compression_sc:
+        log.warning("No compression in common with peer (address=[{}]),"\
+            " disconnecting.".format(protocol.address))
+        return False
+
+    if log.isEnabledFor(logging.INFO):
+        log.info("Negotiated kex=[{}], cipher_cs=[{}], mac_cs=[{}],"\
+            " compression_cs=[{}], cipher_sc=[{}], mac_sc=[{}],"\
+            " compression_sc=[{}] with peer (address=[{}])."\
+                .format(kex_algorithm, cipher_cs, mac_cs, compression_cs,\
+                    cipher_sc, mac_sc, compression_sc, protocol.address))
+
+    protocol.kex_algorithm = kex_algorithm
+    protocol.cipher_cs = cipher_cs
+    protocol.cipher_sc = cipher_sc
+    protocol.mac_cs = mac_cs
+    protocol.mac_sc = mac_sc
+    protocol.compression_cs = compression_cs
+    protocol.compression_sc = compression_sc
+
+    return True
+
+def _create_kex_init_message(kex_algorithms):
     opobj = mnetpacket.SshKexInitMessage()
     opobj.cookie = os.urandom(16)
 #    opobj.kex_algorithms = "diffie-hellman-group-exchange-sha256"
-    opobj.kex_algorithms = "diffie-hellman-group14-sha1"
+    opobj.kex_algorithms = ','.join(kex_algorithms)
     opobj.server_host_key_algorithms = "ssh-rsa"
-    opobj.encryption_algorithms_client_to_server = "aes256-cbc"
-    opobj.encryption_algorithms_server_to_client = "aes256-cbc"
-#    opobj.mac_algorithms_client_to_server = "hmac-sha2-512"
-#    opobj.mac_algorithms_server_to_client = "hmac-sha2-512"
-    opobj.mac_algorithms_client_to_server = "hmac-sha1"
-    opobj.mac_algorithms_server_to_client = "hmac-sha1"
-    opobj.compression_algorithms_client_to_server = "none"
-    opobj.compression_algorithms_server_to_client = "none"
+    opobj.encryption_algorithms_client_to_server =\
+        ','.join(sshcipher.ENCRYPTION_ALGORITHMS)
+    opobj.encryption_algorithms_server_to_client =\
+        ','.join(sshcipher.ENCRYPTION_ALGORITHMS)
+    opobj.mac_algorithms_client_to_server = ','.join(sshcipher.MAC_ALGORITHMS)
+    opobj.mac_algorithms_server_to_client = ','.join(sshcipher.MAC_ALGORITHMS)
+    if compression_enabled:
+        compression = [sshcompress.ZLIB, sshcompress.NONE]
+    else:
+        compression = [sshcompress.NONE, sshcompress.ZLIB]
+    opobj.compression_algorithms_client_to_server = ','.join(compression)
+    opobj.compression_algorithms_server_to_client = ','.join(compression)
     opobj.encode()
 
+    return opobj
+
+# Returns True on success, False on failure, or None if the resumption ticket
+# was rejected.
+@asyncio.coroutine
+def _exchange_keys(protocol, offer_resume, resume_ticket):
+    kex_algorithms = [kexdhgroup14sha1.KexDhGroup14Sha1.name]
+    if offer_resume:
+        kex_algorithms.insert(0, kexresume.NAME)
+
+    # Send KexInit packet.
+    opobj = _create_kex_init_message(kex_algorithms)
+
     protocol.local_kex_init_message = opobj.buf
 
     protocol.write_packet(opobj)
@@ -1249,7 +1861,6 @@ def connectTaskSecure(protocol, server_mode):
 
     if packet_type != 20:
         log.warning("Peer sent unexpected packet_type[{}], disconnecting.".format(packet_type))
-        protocol.close()
         return False
 
     protocol.remote_kex_init_message = packet
@@ -1260,19 +1871,52 @@ def connectTaskSecure(protocol, server_mode):
     if log.isEnabledFor(logging.INFO):
         log.info("keyExchangeAlgorithms=[{}].".format(pobj.kex_algorithms))
 
+    if not _negotiate_algorithms(protocol, opobj, pobj):
+        return False
+
     protocol.waitingForNewKeys = True
 
-#    ke = kex.KexGroup14(protocol)
-#    log.info("Calling start_kex()...")
-#    r = yield from ke.do_kex()
-    ke = kexdhgroup14sha1.KexDhGroup14Sha1(protocol)
+    if protocol.kex_algorithm == kexresume.NAME:
+        ke = kexresume.KexResumeSha256(protocol, resume_ticket)
+    else:
+#        ke = kex.KexGroup14(protocol)
+#        log.info("Calling start_kex()...")
+#        r = yield from ke.do_kex()
+        ke = kexdhgroup14sha1.KexDhGroup14Sha1(protocol)
+
     log.info("Calling kex->run()...")
     r = yield from ke.run()
 
-    if not r:
-        # Client is rejected for some reason by higher level.
-        protocol.close()
-        return False
+    return r
+
+# Returns True on success, False on failure.
+@asyncio.coroutine
+def connectTaskSecure(protocol, server_mode):
+    resume_ticket = None
+    if server_mode:
+        offer_resume = protocol._resumption_enabled
+    else:
+        if protocol._resumption_enabled:
+            resume_ticket = kexresume.take_client_ticket(protocol)
+        offer_resume = resume_ticket is not None
+
+    while True:
+        r = yield from _exchange_keys(protocol, offer_resume, resume_ticket)
+
+        if r is None:
+            # Resumption ticket was rejected, start over with a full key
+            # exchange.
+            protocol.waitingForNewKeys = False
+            offer_resume = False
+            resume_ticket = None
+            continue
+
+        if not r:
+            # Client is rejected for some reason by higher level.
+            protocol.close()
+            return False
+
+        break
 
     # Setup encryption now that keys are exchanged.
     protocol.init_outbound_encryption()
@@ -1293,6 +1937,17 @@ def connectTaskSecure(protocol, server_mode):
     m = mnetpacket.SshNewKeysMessage(packet)
     log.debug("Received SSH_MSG_NEWKEYS.")
 
+    if protocol.kex_algorithm == kexresume.NAME:
+        # Both ends proved they hold the ticket of an earlier authenticated
+        # session, so there is no userauth.
+        log.info("Session resumed (server={}).".format(server_mode))
+        kexresume.issue_ticket(protocol)
+
+        # Both NEWKEYS are through, anything after is compressed.
+        protocol.start_outbound_compression()
+        protocol.start_inbound_compression()
+        return True
+
     if protocol.server_mode:
         packet = yield from protocol.read_packet()
         if not packet:
@@ -1390,6 +2045,11 @@ def connectTaskSecure(protocol, server_mode):
         mr.encode()
 
         protocol.write_packet(mr)
+
+        # Delayed compression starts after the USERAUTH_SUCCESS, the client
+        # sends nothing more until it got it.
+        protocol.start_outbound_compression()
+        protocol.start_inbound_compression()
     else:
         # client mode.
         m = mnetpacket.SshServiceRequestMessage()
@@ -1436,6 +2096,12 @@ def connectTaskSecure(protocol, server_mode):
         m = mnetpacket.SshUserauthSuccessMessage(packet)
         log.info("Userauth accepted.")
 
+        protocol.start_outbound_compression()
+        protocol.start_inbound_compression()
+
+    if protocol._resumption_enabled:
+        kexresume.issue_ticket(protocol)
+
     log.info("Connect task done (server={}).".format(server_mode))
 
 #    if not server_mode:
@@ -0,0 +1,91 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+import llog
+
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# Entries are pruned every this many additions.
+PRUNE_PERIOD = 256
+
+class NegativeEntry(object):
+    def __init__(self):
+        self.failures = 0
+        self.probes = 0 # Of the last failure.
+        self.retry_factor = 1 # The highest that failed.
+        self.time = None # time.monotonic() of the last failure.
+        self.expires = None
+
+class NegativeCache(object):
+    "Remembers recent failures by key for a TTL, which doubles from base_ttl"\
+    " upto max_ttl with each consecutive failure. The count is only forgotten"\
+    " once a failure is older than max_ttl, or on success."
+
+    def __init__(self, base_ttl, max_ttl, name=None):
+        self.base_ttl = base_ttl
+        self.max_ttl = max_ttl
+        self.name = name
+
+        self.entries = {} # {key: NegativeEntry}
+
+        self._adds = 0
+
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def check(self, key, retry_factor=1):
+        "Returns the NegativeEntry if key failed within its TTL, else None."\
+        " A retry_factor higher than any that failed is let through, so that"\
+        " escalating retries still run."
+
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() >= entry.expires\
+                or retry_factor > entry.retry_factor:
+            return None
+
+        self.hits += 1
+
+        return entry
+
+    def add(self, key, probes=0, retry_factor=1):
+        "Records a failure for key, returning its NegativeEntry."
+
+        now = time.monotonic()
+
+        entry = self.entries.get(key)
+        if entry is None or now - entry.time > self.max_ttl:
+            entry = NegativeEntry()
+            self.entries[key] = entry
+
+        entry.failures += 1
+        entry.probes = probes
+        entry.retry_factor = max(entry.retry_factor, retry_factor)
+        entry.time = now
+        entry.expires = now\
+            + min(self.base_ttl * (1 << min(entry.failures - 1, 31)),\
+                self.max_ttl)
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Recorded {} failure #{} for {:.1f} seconds."\
+                .format(self.name, entry.failures, entry.expires - now))
+
+        self._adds += 1
+        if self._adds >= PRUNE_PERIOD:
+            self._prune(now)
+
+        return entry
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+
+    def _prune(self, now):
+        self._adds = 0
+
+        for key in [key for key, entry in self.entries.items()\
+                if now - entry.time > self.max_ttl]:
+            del self.entries[key]
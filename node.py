@@ -14,9 +14,14 @@ import packet as mnetpacket
 import rsakey
 import mn1
 from mutil import hex_dump, hex_string
+import blockcache
+import blockjournal
+import blockstore
 import chord
 import peer
 import db
+import scrubber
+import storeworker
 
 # NodeState keys.
 NSK_DATASTORE_SIZE = "datastore_size"
@@ -49,11 +54,20 @@ class Node():
         self.node_key = None
 
         self.data_block_path = "data/store-{}"
-        self.data_block_file_path =\
-            self.data_block_path + "/{}.blk"
+        # Store the blocks in packed segment files instead of one file each.
+        self.segmented_store = False
+        self.block_store = None
+        self.block_journal = None
+        self.store_worker = None
+        self.block_scrubber = None
+        self._compact_store_handle = None
 
         self.datastore_max_size = 0 # In bytes.
         self.datastore_size = 0 # In bytes.
+        # Separate budget for verified blocks kept for others, in bytes.
+        self.transit_cache_max_size = blockcache.DEFAULT_TRANSIT_MAX_BYTES
+        # Bytes per second the block scrubber may read; 0 disables it.
+        self.scrub_rate = scrubber.DEFAULT_RATE
 
         if dburl:
             self.db = db.Db(loop, dburl, 'n' + str(instance_id))
@@ -128,6 +142,8 @@ class Node():
                     sess.execute(stmt)
 
                     sess.query(db.DataBlock).delete(synchronize_session=False)
+                    sess.query(db.DataBlockJournal)\
+                        .delete(synchronize_session=False)
 
                     sess.commit()
 
@@ -175,6 +191,49 @@ class Node():
 
         assert type(self.chord_engine.furthest_data_block) is bytes
 
+        if self.segmented_store:
+            self.block_store = blockstore.SegmentBlockStore(d)
+        else:
+            self.block_store = blockstore.FileBlockStore(d)
+
+        yield from self.loop.run_in_executor(None, self.block_store.open)
+
+        self.block_journal = blockjournal.BlockJournal(self)
+
+        freed = yield from\
+            self.loop.run_in_executor(None, self.block_journal.recover)
+        self.datastore_size -= freed
+
+        self.store_worker = storeworker.StoreWorker(self)
+        self.store_worker.start()
+
+        self.block_scrubber = scrubber.BlockScrubber(self, self.scrub_rate)
+        self.block_scrubber.start()
+
+        if self.segmented_store:
+            self._schedule_compact_store()
+
+    def _schedule_compact_store(self):
+        self._compact_store_handle = self.loop.call_later(\
+            blockstore.COMPACT_INTERVAL, self._async_compact_store)
+
+    def _async_compact_store(self):
+        asyncio.async(self._compact_store(), loop=self.loop)
+
+    @asyncio.coroutine
+    def _compact_store(self):
+        try:
+            freed = yield from\
+                self.loop.run_in_executor(None, self.block_store.compact)
+
+            if freed and log.isEnabledFor(logging.INFO):
+                log.info("Compacting the block store freed [{}] bytes."\
+                    .format(freed))
+        except Exception:
+            log.exception("block_store.compact()")
+
+        self._schedule_compact_store()
+
     @asyncio.coroutine
     def start(self):
         if not self._db_initialized:
@@ -223,6 +282,17 @@ class Node():
         if self.chord_engine:
             self.chord_engine.stop()
 
+        if self._compact_store_handle:
+            self._compact_store_handle.cancel()
+        if self.block_scrubber:
+            self.block_scrubber.stop()
+        if self.store_worker:
+            self.store_worker.stop()
+        if self.block_journal:
+            self.block_journal.stop()
+        if self.block_store:
+            self.block_store.close()
+
     def load_key(self):
         self.node_key = self._load_key()
 
@@ -298,8 +368,14 @@ def __main():
         help="Add a node to peer list.", action="append")
     parser.add_argument("--bind",\
         help="Specify bind address (host:port).")
+    parser.add_argument("--cachesize", type=int,\
+        help="Specify the size of the cache of popular blocks passing through"\
+            " this node, in MBs (default is 64), in addition to the datastore.")
     parser.add_argument("--cleartexttransport", action="store_true",\
         help="Clear text transport and no authentication.")
+    parser.add_argument("--compression", action="store_true",\
+        help="Prefer zlib compression on the connections this node makes"\
+            " (for metered links).")
     parser.add_argument("--dbpoolsize", type=int,\
         help="Specify the maximum amount of database connections.")
     parser.add_argument("--dburl",\
@@ -348,6 +424,14 @@ def __main():
     parser.add_argument("--reinitds", action="store_true",\
         help="Allow reinitialization of the Datastore. This will only happen"\
             " if the Datastore directory has already been manually deleted.")
+    parser.add_argument("--scrubrate", type=int,\
+        help="Specify the rate at which the stored blocks are read back and"\
+            " checked for corruption, in KBs per second (default is 1024, 0"\
+            " disables it).")
+    parser.add_argument("--segmentstore", action="store_true",\
+        help="Store the data blocks packed in segment files instead of one"\
+            " file each. An existing datastore must first be converted by"\
+            " running blockstore.py.")
     parser.add_argument("--tormode", action="store_true",\
         help="Enable torify mode. This makes MORPHiS work better over torify"\
             " or proxychains. Currently it fixes the remote address check so"\
@@ -373,6 +457,9 @@ def __main():
     if args.cleartexttransport:
         log.info("Enabling cleartext transport.")
         mn1.enable_cleartext_transport()
+    if args.compression:
+        log.info("Enabling compression.")
+        mn1.enable_compression()
     db_pool_size = args.dbpoolsize
     dburl = args.dburl
     dssize = args.dssize if args.dssize else 1024
@@ -410,6 +497,14 @@ def __main():
                 node.tormode = True
             if args.offline:
                 node.offline_mode = True
+            if args.segmentstore:
+                node.segmented_store = True
+            if args.cachesize is not None:
+                # Convert MBs to bytes.
+                node.transit_cache_max_size = args.cachesize << 20
+            if args.scrubrate is not None:
+                # Convert KBs to bytes.
+                node.scrub_rate = args.scrubrate << 10
 
             nodes.append(node)
 
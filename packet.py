@@ -17,6 +17,10 @@ SSH_MSG_SERVICE_ACCEPT = 6
 SSH_MSG_KEXINIT = 20
 SSH_MSG_NEWKEYS = 21
 
+# Key exchange method specific (30-49); used by resume-sha256@mnet.
+SSH_MSG_KEX_RESUME_INIT = 30
+SSH_MSG_KEX_RESUME_REPLY = 31
+
 SSH_MSG_USERAUTH_REQUEST = 50
 SSH_MSG_USERAUTH_FAILURE = 51
 SSH_MSG_USERAUTH_SUCCESS = 52
@@ -99,14 +103,32 @@ class SshKexInitMessage(SshPacket):
         super().__init__(SSH_MSG_KEXINIT, buf)
 
     def parse(self):
-        super().parse()
-
-        i = 17;
-        self.cookie = self.buf[1:i]
+        i = super().parse()
 
-        l, v = sshtype.parseNameList(self.buf[i:])
-        self.kex_algorithms = v
-        i += l
+        self.cookie = self.buf[i:i+16]
+        i += 16
+
+        i, self.kex_algorithms = sshtype.parse_string_from(self.buf, i)
+        i, self.server_host_key_algorithms =\
+            sshtype.parse_string_from(self.buf, i)
+        i, self.encryption_algorithms_client_to_server =\
+            sshtype.parse_string_from(self.buf, i)
+        i, self.encryption_algorithms_server_to_client =\
+            sshtype.parse_string_from(self.buf, i)
+        i, self.mac_algorithms_client_to_server =\
+            sshtype.parse_string_from(self.buf, i)
+        i, self.mac_algorithms_server_to_client =\
+            sshtype.parse_string_from(self.buf, i)
+        i, self.compression_algorithms_client_to_server =\
+            sshtype.parse_string_from(self.buf, i)
+        i, self.compression_algorithms_server_to_client =\
+            sshtype.parse_string_from(self.buf, i)
+        i, self.languages_client_to_server =\
+            sshtype.parse_string_from(self.buf, i)
+        i, self.languages_server_to_client =\
+            sshtype.parse_string_from(self.buf, i)
+        self.first_kex_packet_follows =\
+            struct.unpack_from("?", self.buf, i)[0]
 
     def encode(self):
         nbuf = super().encode()
@@ -142,9 +164,9 @@ class SshKexdhInitMessage(SshPacket):
         self.e = e
 
     def parse(self):
-        super().parse()
+        i = super().parse()
 
-        self.e = sshtype.parseMpint(self.buf[1:])[1]
+        i, self.e = sshtype.parse_mpint_from(self.buf, i)
 
     def encode(self):
         nbuf = super().encode()
@@ -181,14 +203,11 @@ class SshKexdhReplyMessage(SshPacket):
         self.signature = val
 
     def parse(self):
-        super().parse()
+        i = super().parse()
 
-        i = 1
-        l, self.host_key = sshtype.parseBinary(self.buf[i:])
-        i += l
-        l, self.f = sshtype.parseMpint(self.buf[i:])
-        i += l
-        l, self.signature = sshtype.parseBinary(self.buf[i:])
+        i, self.host_key = sshtype.parse_binary_from(self.buf, i)
+        i, self.f = sshtype.parse_mpint_from(self.buf, i)
+        i, self.signature = sshtype.parse_binary_from(self.buf, i)
 
     def encode(self):
         nbuf = super().encode()
@@ -207,6 +226,57 @@ class SshNewKeysMessage(SshPacket):
         nbuf = super().encode()
         return nbuf
 
+class SshKexResumeInitMessage(SshPacket):
+    def __init__(self, buf=None):
+        if buf == None:
+            self.ticket_id = None
+            self.nonce = None
+            self.proof = None
+
+        super().__init__(SSH_MSG_KEX_RESUME_INIT, buf)
+
+    def parse(self):
+        i = super().parse()
+
+        i, self.ticket_id = sshtype.parse_binary_from(self.buf, i)
+        i, self.nonce = sshtype.parse_binary_from(self.buf, i)
+        i, self.proof = sshtype.parse_binary_from(self.buf, i)
+
+    def encode(self):
+        nbuf = super().encode()
+
+        nbuf += sshtype.encodeBinary(self.ticket_id)
+        nbuf += sshtype.encodeBinary(self.nonce)
+        nbuf += sshtype.encodeBinary(self.proof)
+
+        return nbuf
+
+class SshKexResumeReplyMessage(SshPacket):
+    def __init__(self, buf=None):
+        if buf == None:
+            self.accepted = False
+            self.nonce = b""
+            self.proof = b""
+
+        super().__init__(SSH_MSG_KEX_RESUME_REPLY, buf)
+
+    def parse(self):
+        i = super().parse()
+
+        self.accepted = struct.unpack_from("?", self.buf, i)[0]
+        i += 1
+        i, self.nonce = sshtype.parse_binary_from(self.buf, i)
+        i, self.proof = sshtype.parse_binary_from(self.buf, i)
+
+    def encode(self):
+        nbuf = super().encode()
+
+        nbuf += struct.pack("?", self.accepted)
+        nbuf += sshtype.encodeBinary(self.nonce)
+        nbuf += sshtype.encodeBinary(self.proof)
+
+        return nbuf
+
 class SshServiceRequestMessage(SshPacket):
     def __init__(self, buf = None):
         if buf == None:
@@ -215,10 +285,9 @@ class SshServiceRequestMessage(SshPacket):
         super().__init__(SSH_MSG_SERVICE_REQUEST, buf)
 
     def parse(self):
-        super().parse()
+        i = super().parse()
 
-        i = 1
-        l, self.service_name = sshtype.parseString(self.buf[i:])
+        i, self.service_name = sshtype.parse_string_from(self.buf, i)
 
     def encode(self):
         nbuf = super().encode()
@@ -235,10 +304,9 @@ class SshServiceAcceptMessage(SshPacket):
         super().__init__(SSH_MSG_SERVICE_ACCEPT, buf)
 
     def parse(self):
-        super().parse()
+        i = super().parse()
 
-        i = 1
-        l, self.service_name = sshtype.parseString(self.buf[i:])
+        i, self.service_name = sshtype.parse_string_from(self.buf, i)
 
     def encode(self):
         nbuf = super().encode()
@@ -252,14 +320,12 @@ class SshDisconnectMessage(SshPacket):
         super().__init__(SSH_MSG_DISCONNECT, buf)
 
     def parse(self):
-        super().parse()
+        i = super().parse()
 
-        i = 1
-        self.reason_code = struct.unpack(">L", self.buf[i:i+4])[0]
+        self.reason_code = struct.unpack_from(">L", self.buf, i)[0]
         i += 4
-        l, self.description = sshtype.parseString(self.buf[i:])
-        i += l
-        l, self.language_code = sshtype.parseString(self.buf[i:])
+        i, self.description = sshtype.parse_string_from(self.buf, i)
+        i, self.language_code = sshtype.parse_string_from(self.buf, i)
 
     def encode(self):
         nbuf = super().encode()
@@ -280,26 +346,21 @@ class SshUserauthRequestMessage(SshPacket):
         super().__init__(SSH_MSG_USERAUTH_REQUEST, buf)
 
     def parse(self):
-        super().parse()
+        i = super().parse()
 
-        i = 1
-        l, self.user_name = sshtype.parseString(self.buf[i:])
-        i += l
-        l, self.service_name = sshtype.parseString(self.buf[i:])
-        i += l
-        l, self.method_name = sshtype.parseString(self.buf[i:])
-        i += l
+        i, self.user_name = sshtype.parse_string_from(self.buf, i)
+        i, self.service_name = sshtype.parse_string_from(self.buf, i)
+        i, self.method_name = sshtype.parse_string_from(self.buf, i)
 
         if self.method_name == "publickey":
-            self.signature_present = struct.unpack("?", self.buf[i:i+1])[0]
+            self.signature_present = struct.unpack_from("?", self.buf, i)[0]
             i += 1
-            l, self.algorithm_name = sshtype.parseString(self.buf[i:])
-            i += l
-            l, self.public_key = sshtype.parseBinary(self.buf[i:])
+            i, self.algorithm_name = sshtype.parse_string_from(self.buf, i)
+            i, self.public_key = sshtype.parse_binary_from(self.buf, i)
             if self.signature_present:
-                i += l
-                l, self.signature = sshtype.parseBinary(self.buf[i:])
-                self.signature_length = l
+                start = i
+                i, self.signature = sshtype.parse_binary_from(self.buf, i)
+                self.signature_length = i - start
 
     def encode(self):
         nbuf = super().encode()
@@ -326,12 +387,10 @@ class SshUserauthFailureMessage(SshPacket):
         super().__init__(SSH_MSG_USERAUTH_FAILURE, buf)
 
     def parse(self):
-        super().parse()
+        i = super().parse()
 
-        i = 1
-        l, self.auths = sshtype.parseNamelist(self.buf[i:])
-        i += l
-        self.partial_success = struct.decode("?", self.buf[i:])
+        i, self.auths = sshtype.parse_name_list_from(self.buf, i)
+        self.partial_success = struct.unpack_from("?", self.buf, i)[0]
 
     def encode(self):
         nbuf = super().encode()
@@ -357,12 +416,10 @@ class SshUserauthPkOkMessage(SshPacket):
         super().__init__(SSH_MSG_USERAUTH_PK_OK, buf)
 
     def parse(self):
-        super().parse()
+        i = super().parse()
 
-        i = 1
-        l, self.algorithm_name = sshtype.parseString(self.buf[i:])
-        i += l
-        l, self.public_key = sshtype.parseBinary(self.buf[i:])
+        i, self.algorithm_name = sshtype.parse_string_from(self.buf, i)
+        i, self.public_key = sshtype.parse_binary_from(self.buf, i)
 
     def encode(self):
         nbuf = super().encode()
@@ -379,20 +436,15 @@ class SshChannelOpenMessage(SshPacket):
         super().__init__(SSH_MSG_CHANNEL_OPEN, buf)
 
     def parse(self):
-        super().parse()
+        i = super().parse()
 
-        i = 1
-        l, self.channel_type = sshtype.parseString(self.buf[i:])
-        i += l
-        self.sender_channel = struct.unpack(">L", self.buf[i:i+4])[0]
-        i += 4
-        self.initial_window_size = struct.unpack(">L", self.buf[i:i+4])[0]
-        i += 4
-        self.maximum_packet_size = struct.unpack(">L", self.buf[i:i+4])[0]
-        i += 4
+        i, self.channel_type = sshtype.parse_string_from(self.buf, i)
+        self.sender_channel, self.initial_window_size,\
+            self.maximum_packet_size = struct.unpack_from(">LLL", self.buf, i)
+        i += 12
 
         if i < len(self.buf):
-            self.data_packet = self.buf[i:]
+            self.data_packet = memoryview(self.buf)[i:]
 
     def encode(self):
         nbuf = super().encode()
@@ -412,17 +464,11 @@ class SshChannelOpenConfirmationMessage(SshPacket):
         super().__init__(SSH_MSG_CHANNEL_OPEN_CONFIRMATION, buf)
 
     def parse(self):
-        super().parse()
+        i = super().parse()
 
-        i = 1
-        self.recipient_channel = struct.unpack(">L", self.buf[i:i+4])[0]
-        i += 4
-        self.sender_channel = struct.unpack(">L", self.buf[i:i+4])[0]
-        i += 4
-        self.initial_window_size = struct.unpack(">L", self.buf[i:i+4])[0]
-        i += 4
-        self.maximum_packet_size = struct.unpack(">L", self.buf[i:i+4])[0]
-        i += 4
+        self.recipient_channel, self.sender_channel,\
+            self.initial_window_size, self.maximum_packet_size =\
+                struct.unpack_from(">LLLL", self.buf, i)
 
     def encode(self):
         nbuf = super().encode()
@@ -439,16 +485,13 @@ class SshChannelOpenFailureMessage(SshPacket):
         super().__init__(SSH_MSG_CHANNEL_OPEN_FAILURE, buf)
 
     def parse(self):
-        super().parse()
+        i = super().parse()
 
-        i = 1
-        self.recipient_channel = struct.unpack(">L", self.buf[i:i+4])[0]
-        i += 4
-        self.reason_code = struct.unpack(">L", self.buf[i:i+4])[0]
-        i += 4
-        l, self.description = sshtype.parseString(self.buf[i:])
-        i += l
-        l, self.language_tag = sshtype.parseString(self.buf[i:])
+        self.recipient_channel, self.reason_code =\
+            struct.unpack_from(">LL", self.buf, i)
+        i += 8
+        i, self.description = sshtype.parse_string_from(self.buf, i)
+        i, self.language_tag = sshtype.parse_string_from(self.buf, i)
 
     def encode(self):
         nbuf = super().encode()
@@ -468,13 +511,12 @@ class SshChannelCloseMessage(SshPacket):
         super().__init__(SSH_MSG_CHANNEL_CLOSE, buf)
 
     def parse(self):
-        super().parse()
+        i = super().parse()
 
-        i = 1
-        self.recipient_channel = struct.unpack(">L", self.buf[i:i+4])[0]
+        self.recipient_channel = struct.unpack_from(">L", self.buf, i)[0]
         i += 4
         if i < len(self.buf):
-            self.implicit_channel = struct.unpack("?", self.buf[i:i+1])[0]
+            self.implicit_channel = struct.unpack_from("?", self.buf, i)[0]
 
     def encode(self):
         nbuf = super().encode()
@@ -485,6 +527,28 @@ class SshChannelCloseMessage(SshPacket):
 
         return nbuf
 
+class SshChannelWindowAdjustMessage(SshPacket):
+    def __init__(self, buf=None, offset=0):
+        self.recipient_channel = None
+        self.bytes_to_add = None
+
+        super().__init__(SSH_MSG_CHANNEL_WINDOW_ADJUST, buf, offset)
+
+    def parse(self):
+        i = super().parse()
+
+        self.recipient_channel = struct.unpack_from(">L", self.buf, i)[0]
+        i += 4
+        self.bytes_to_add = struct.unpack_from(">L", self.buf, i)[0]
+
+    def encode(self):
+        nbuf = super().encode()
+
+        nbuf += struct.pack(">L", self.recipient_channel)
+        nbuf += struct.pack(">L", self.bytes_to_add)
+
+        return nbuf
+
 class SshChannelDataMessage(SshPacket):
     def __init__(self, buf=None, offset=0):
         self.recipient_channel = None
@@ -497,7 +561,7 @@ class SshChannelDataMessage(SshPacket):
 
         self.recipient_channel = struct.unpack_from(">L", self.buf, i)[0]
         i += 4
-        self.data = self.buf[i:]
+        self.data = memoryview(self.buf)[i:]
 
     def encode(self):
         nbuf = super().encode()
@@ -518,12 +582,11 @@ class SshChannelExtendedDataMessage(SshPacket):
         super().__init__(SSH_MSG_CHANNEL_EXTENDED_DATA, buf, offset)
 
     def parse(self):
-        super().parse()
+        i = super().parse()
 
-        i = 1
         self.recipient_channel = struct.unpack_from(">L", self.buf, i)[0]
         i += 4
-        self.data_type_code = struct.unpack(">L", self.buf, i)[0]
+        self.data_type_code = struct.unpack_from(">L", self.buf, i)[0]
         i += 4
         self.data_offset = i
 
@@ -551,16 +614,15 @@ class SshChannelRequest(SshPacket):
     def parse(self):
         i = super().parse()
 
-        self.recipient_channel = struct.unpack(">L", self.buf[i:i+4])[0]
+        self.recipient_channel = struct.unpack_from(">L", self.buf, i)[0]
         i += 4
-        l, self.request_type = sshtype.parseString(self.buf[i:])
-        i += l
-        self.want_reply = struct.unpack("?", self.buf[i:i+1])[0]
+        i, self.request_type = sshtype.parse_string_from(self.buf, i)
+        self.want_reply = struct.unpack_from("?", self.buf, i)[0]
         i += 1
 
         if i == len(self.buf):
             return
-        self.payload = self.buf[i:]
+        self.payload = memoryview(self.buf)[i:]
 
     def encode(self):
         nbuf = super().encode()
@@ -0,0 +1,161 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+# Micro-benchmark of the message classes in packet.py and chord_packet.py.
+# Each message type is encoded and then parsed back out of a memoryview, as
+# it is when it comes off the wire, and the rates of both are printed. The
+# size of the variable length fields (channel data, data blocks, peer lists)
+# can be raised to check that parsing stays linear in the message size.
+
+import llog
+
+import argparse
+import logging
+import os
+import time
+
+import chord_packet as cp
+import db
+import packet as mnp
+
+log = logging.getLogger(__name__)
+
+def _create_ssh_messages(data_size):
+    m = mnp.SshKexdhReplyMessage()
+    m.host_key = os.urandom(279)
+    m.f = int.from_bytes(os.urandom(256), "big")
+    m.signature = os.urandom(271)
+    yield m
+
+    m = mnp.SshUserauthRequestMessage()
+    m.user_name = "bench"
+    m.service_name = "ssh-connection"
+    m.method_name = "publickey"
+    m.signature_present = False
+    m.algorithm_name = "ssh-rsa"
+    m.public_key = os.urandom(279)
+    yield m
+
+    m = mnp.SshChannelOpenMessage()
+    m.channel_type = "mpeer"
+    m.sender_channel = 0
+    m.initial_window_size = 65535
+    m.maximum_packet_size = 65535
+    m.data_packet = os.urandom(data_size)
+    yield m
+
+    m = mnp.SshChannelOpenFailureMessage()
+    m.recipient_channel = 0
+    m.reason_code = 1
+    m.description = "Rejected."
+    m.language_tag = "en"
+    yield m
+
+    m = mnp.SshChannelWindowAdjustMessage()
+    m.recipient_channel = 0
+    m.bytes_to_add = 65535
+    yield m
+
+    m = mnp.SshChannelDataMessage()
+    m.recipient_channel = 0
+    m.data = os.urandom(data_size)
+    yield m
+
+    m = mnp.SshChannelRequest()
+    m.recipient_channel = 0
+    m.request_type = "bench"
+    m.want_reply = True
+    m.payload = os.urandom(data_size)
+    yield m
+
+def _create_chord_messages(data_size, peer_count):
+    m = cp.ChordRelay()
+    m.index = 0
+    m.packets = [os.urandom(data_size)]
+    yield m
+
+    m = cp.ChordRelayPath()
+    m.path = [0, 1, 2]
+    m.payload = os.urandom(data_size)
+    yield m
+
+    peers = []
+    for i in range(peer_count):
+        peer = db.Peer()
+        peer.address = "192.168.{}.{}:4250".format(i // 256, i % 256)
+        peer.node_id = os.urandom(64)
+        peer.pubkey = os.urandom(279)
+        peers.append(peer)
+    yield cp.ChordPeerList(peers=peers)
+
+    m = cp.ChordFindNode()
+    m.node_id = os.urandom(64)
+    m.data_mode = cp.DataMode.get
+    m.version = 1
+    m.significant_bits = 32
+    m.target_key = os.urandom(64)
+    yield m
+
+    m = cp.ChordDataResponse()
+    m.data = os.urandom(data_size)
+    m.original_size = data_size
+    m.version = 1
+    m.signature = os.urandom(512)
+    m.epubkey = os.urandom(279)
+    m.pubkeylen = 279
+    yield m
+
+    m = cp.ChordStoreData()
+    m.data = os.urandom(data_size)
+    m.pubkey = os.urandom(279)
+    m.path_hash = os.urandom(64)
+    m.version = 1
+    m.signature = os.urandom(512)
+    yield m
+
+    m = cp.ChordStoreKey()
+    m.data = os.urandom(data_size)
+    yield m
+
+def _time(f, count):
+    start = time.perf_counter()
+    for i in range(count):
+        f()
+    return time.perf_counter() - start
+
+def _run(msg, count):
+    buf = bytes(msg.encode())
+    mbuf = memoryview(buf)
+    cls = type(msg)
+
+    encode_elapsed = _time(msg.encode, count)
+    parse_elapsed = _time(lambda: cls(mbuf), count)
+
+    print("{:>32s}: {:8d} bytes, encode {:10.0f} msgs/s,"\
+        " parse {:10.0f} msgs/s, parse {:9.2f} MB/s."\
+            .format(cls.__name__, len(buf), count / encode_elapsed,\
+                count / parse_elapsed,\
+                len(buf) * count / parse_elapsed / 1000000))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-size", type=int, default=32768,\
+        help="Size of the variable length data fields.")
+    parser.add_argument("--peer-count", type=int, default=64,\
+        help="Number of peers in the ChordPeerList.")
+    parser.add_argument("--count", type=int, default=10000,\
+        help="Number of times each message is encoded and parsed.")
+    args = parser.parse_args()
+
+    print("Encoding and parsing each message {} times, data_size=[{}],"\
+        " peer_count=[{}]."\
+            .format(args.count, args.data_size, args.peer_count))
+
+    for msg in _create_ssh_messages(args.data_size):
+        _run(msg, args.count)
+
+    for msg in _create_chord_messages(args.data_size, args.peer_count):
+        _run(msg, args.count)
+
+if __name__ == "__main__":
+    main()
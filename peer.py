@@ -11,9 +11,41 @@ import rsakey
 import mn1
 import mutil
 import enc
+import xordist
 
 log = logging.getLogger(__name__)
 
+class RttEstimator(object):
+    "Smoothed round trip time and its mean deviation, kept like TCP does"\
+    " (RFC 6298) in order to derive how long to wait for a response."
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+            return
+
+        self.rttvar = (1 - self.BETA) * self.rttvar\
+            + self.BETA * abs(self.srtt - rtt)
+        self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+
+    def rto(self):
+        "Returns the time after which a response is late, or None if there"\
+        " are no samples yet."
+
+        if self.srtt is None:
+            return None
+
+        return self.srtt + self.K * self.rttvar
+
 class Peer():
     def __init__(self, engine, dbpeer=None):
         self.engine = engine
@@ -34,6 +66,11 @@ class Peer():
 
         self.connection_coop_lock = asyncio.Lock()
 
+        # Of root level FindNodeS sent to the Peer, and of FindNodeS relayed
+        # further through it.
+        self.rtt = RttEstimator()
+        self.relay_rtt = RttEstimator()
+
         if dbpeer:
             self.dbid = dbpeer.id
             if dbpeer.pubkey:
@@ -60,7 +97,7 @@ class Peer():
 
     def update_distance(self):
         self.distance, self.direction =\
-            mutil.calc_log_distance(self.engine.node_id, self.node_id)
+            xordist.log_distance(self.engine.node_id, self.node_id)
 
     def _peer_authenticated(self, key):
         self.node_key = key
@@ -0,0 +1,277 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+# Checks the blocks in the block store against DataBlock.checksum, since
+# serving a corrupt block gets us penalized and costs the requester another
+# lookup. _retrieve_data checks each block it reads through read_block(..), and
+# BlockScrubber walks the whole DataBlock table in the background, reading at
+# most rate bytes per second. A corrupt block is rewritten from a verified copy
+# of it in the transit cache if there is one, as the encryption is
+# deterministic, or else it is dropped. Blocks stored before there were
+# checksums get theirs from their data, if of the right size, when scrubbed.
+
+import llog
+
+import asyncio
+import logging
+
+from sqlalchemy import func
+
+import blockjournal
+import blockstore
+from db import DataBlock, DataBlockJournal, NodeState
+import node as mnnode
+
+log = logging.getLogger(__name__)
+
+# Bytes read per second.
+DEFAULT_RATE = 1024 * 1024
+# DataBlock rows per executor call.
+SCRUB_BATCH = 32
+# Seconds between the passes over the store.
+PASS_INTERVAL = 3600
+
+def read_block(store, data_block):
+    "Returns the data of the block and whether it is intact, or None and True"\
+    " if it is missing. Blocking."
+
+    data = store.read(data_block.id)
+    if data is None:
+        return None, True
+
+    if data_block.checksum is None:
+        intact = len(data)\
+            == blockjournal.encrypted_size(data_block.original_size)
+    else:
+        intact = blockstore.checksum(data) == data_block.checksum
+
+    return data, intact
+
+class BlockScrubber(object):
+    def __init__(self, node, rate=DEFAULT_RATE):
+        self.node = node
+        self.loop = node.loop
+
+        self.rate = rate
+
+        self.last_id = 0 # Of the last DataBlock scrubbed this pass.
+
+        self._scrub_handle = None
+
+        self.passes = 0
+        self.scrubbed = 0
+        self.corrupt = 0
+        self.repaired = 0
+        self.dropped = 0
+
+    def start(self):
+        if self.rate:
+            self._schedule_scrub(PASS_INTERVAL)
+
+    def stop(self):
+        if self._scrub_handle:
+            self._scrub_handle.cancel()
+            self._scrub_handle = None
+
+    def _schedule_scrub(self, delay):
+        self._scrub_handle =\
+            self.loop.call_later(delay, self._async_scrub)
+
+    def _async_scrub(self):
+        asyncio.async(self._scrub(), loop=self.loop)
+
+    @asyncio.coroutine
+    def _scrub(self):
+        try:
+            delay = yield from self._scrub_batch()
+        except Exception:
+            log.exception("BlockScrubber._scrub_batch()")
+            delay = PASS_INTERVAL
+
+        if self._scrub_handle:
+            # Not stopped.
+            self._schedule_scrub(delay)
+
+    @asyncio.coroutine
+    def _scrub_batch(self):
+        "Scrubs the next SCRUB_BATCH blocks, returning the seconds to wait"\
+        " before the next batch to keep within rate."
+
+        store = self.node.block_store
+        last_id = self.last_id
+
+        def threadcall():
+            with self.node.db.open_session() as sess:
+                data_blocks = sess.query(DataBlock)\
+                    .filter(DataBlock.id > last_id)\
+                    .filter(DataBlock.original_size != 0)\
+                    .order_by(DataBlock.id)\
+                    .limit(SCRUB_BATCH)\
+                    .all()
+
+                for data_block in data_blocks:
+                    sess.expunge(data_block)
+
+            results = []
+            nbytes = 0
+            checksums = {} # {DataBlock.id: checksum}
+
+            for data_block in data_blocks:
+                data, intact = read_block(store, data_block)
+                if data is not None:
+                    nbytes += len(data)
+
+                    if intact and data_block.checksum is None:
+                        checksums[data_block.id] = blockstore.checksum(data)
+
+                results.append((data_block, data is not None and intact))
+
+            if checksums:
+                with self.node.db.open_session() as sess:
+                    for block_id, block_checksum in checksums.items():
+                        sess.query(DataBlock)\
+                            .filter(DataBlock.id == block_id)\
+                            .filter(DataBlock.checksum == None)\
+                            .update({"checksum": block_checksum},\
+                                synchronize_session=False)
+
+                    sess.commit()
+
+            return results, nbytes
+
+        results, nbytes = yield from self.loop.run_in_executor(None, threadcall)
+
+        if not results:
+            self.passes += 1
+            self.last_id = 0
+
+            if log.isEnabledFor(logging.INFO):
+                log.info("Finished scrubbing pass #{} (corrupt={},"\
+                    " repaired={}, dropped={})."\
+                        .format(self.passes, self.corrupt, self.repaired,\
+                            self.dropped))
+
+            return PASS_INTERVAL
+
+        for data_block, intact in results:
+            if not intact:
+                yield from self.repair(data_block)
+
+        self.last_id = results[-1][0].id
+        self.scrubbed += len(results)
+
+        return nbytes / self.rate
+
+    @asyncio.coroutine
+    def repair(self, data_block):
+        "Rewrites the corrupt or missing block from the transit cache if it"\
+        " has a copy, else drops it. Returns the data, or None if dropped."
+
+        self.corrupt += 1
+
+        tasks = self.node.chord_engine.tasks
+
+        version =\
+            int(data_block.version) if data_block.version is not None else None
+
+        tblock = tasks.transit_cache.blocks.get(data_block.data_id)
+        if tblock and tblock.version == version\
+                and data_block.checksum is not None:
+            r = yield from self.loop.run_in_executor(\
+                None, self._rewrite, data_block, tblock.data)
+
+            if r:
+                log.warning("Block id=[{}] was corrupt or missing; repaired"\
+                    " it from the transit cache.".format(data_block.id))
+
+                self.repaired += 1
+                return tblock.data
+
+        freed, entry_id =\
+            yield from self.loop.run_in_executor(None, self._drop, data_block)
+
+        if entry_id is None:
+            if log.isEnabledFor(logging.INFO):
+                log.info("Block id=[{}] was corrupt or missing, but is being"\
+                    " written or has been updated since."\
+                        .format(data_block.id))
+        else:
+            log.warning("Block id=[{}] was corrupt or missing; dropped it."\
+                .format(data_block.id))
+
+            self.node.datastore_size -= freed
+            self.node.block_journal.complete([entry_id])
+            self.dropped += 1
+
+        return None
+
+    def _rewrite(self, data_block, data):
+        if blockstore.checksum(data) != data_block.checksum:
+            return False
+
+        with self.node.db.open_session() as sess:
+            self.node.db.lock_table(sess, DataBlock)
+
+            # Unless it was updated meanwhile; the StoreWorker writes the new
+            # data after committing the row, so then ours would be stale.
+            r = sess.query(func.count("*")).select_from(DataBlock)\
+                .filter(DataBlock.id == data_block.id)\
+                .filter(DataBlock.version == data_block.version)\
+                .filter(DataBlock.checksum == data_block.checksum)\
+                .scalar()
+
+            if not r:
+                return False
+
+            # Under the lock so that no update can come in between.
+            self.node.block_store.write(data_block.id, data)
+
+        return True
+
+    def _drop(self, data_block):
+        with self.node.db.open_session() as sess:
+            self.node.db.lock_table(sess, DataBlock)
+
+            # Unless its data may just not have been written yet; the
+            # StoreWorker commits the row before writing it.
+            pending = sess.query(func.count("*"))\
+                .select_from(DataBlockJournal)\
+                .filter(DataBlockJournal.data_block_id == data_block.id)\
+                .filter(DataBlockJournal.action == blockjournal.ACTION_CREATE)\
+                .scalar()
+
+            if pending:
+                return 0, None
+
+            # Or if it was updated meanwhile.
+            r = sess.query(DataBlock)\
+                .filter(DataBlock.id == data_block.id)\
+                .filter(DataBlock.version == data_block.version)\
+                .filter(DataBlock.checksum == data_block.checksum)\
+                .delete(synchronize_session=False)
+
+            if not r:
+                return 0, None
+
+            # Rule: only update this NodeState row when holding a lock on the
+            # DataBlock table.
+            node_state = sess.query(NodeState)\
+                .filter(NodeState.key == mnnode.NSK_DATASTORE_SIZE)\
+                .first()
+
+            if node_state:
+                node_state.value =\
+                    str(int(node_state.value) - data_block.original_size)
+
+            entry = blockjournal.add_entry(\
+                sess, data_block.id, blockjournal.ACTION_DELETE)
+
+            # Get the id for the journal entry.
+            sess.flush()
+            entry_id = entry.id
+
+            sess.commit()
+
+        self.node.block_store.remove(data_block.id)
+
+        return data_block.original_size, entry_id
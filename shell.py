@@ -16,7 +16,8 @@ import enc
 import mbase32
 import mn1
 import multipart
-from mutil import hex_dump, hex_string, decode_key, calc_raw_distance
+from mutil import hex_dump, hex_string, decode_key
+import xordist
 import node
 import rsakey
 import sshtype
@@ -360,7 +361,7 @@ class Shell(cmd.Cmd):
             self.writeln("nid[{}] FOUND: {:22} id=[{}] diff=[{}]"\
                 .format(r.id, r.address, hex_string(r.node_id),\
                     hex_string(\
-                        calc_raw_distance(\
+                        xordist.raw_distance(\
                             r.node_id, node_id))))
 
     @asyncio.coroutine
@@ -660,6 +661,47 @@ class Shell(cmd.Cmd):
                     mbase32.encode(engine.node_id), engine._bind_port,\
                     len(engine.peers)))
 
+        tasks = engine.tasks
+
+        self.writeln("Stabilize:\n\tpasses={}\n\tlast_duration=[{}]\n"\
+            "\tlast_lookups={}\n\tlast_skipped_buckets={}"\
+                .format(tasks.stabilize_count,\
+                    tasks.last_stabilize_duration,\
+                    tasks.last_stabilize_lookups,\
+                    tasks.last_stabilize_skipped))
+
+        self.writeln("GetData:\n\tcount={}\n\thedged={}\n\thedge_wins={}\n"\
+            "\thedge_delay=[{:.3f}]"\
+                .format(tasks.get_data_count, tasks.get_data_hedged,\
+                    tasks.get_data_hedge_wins,\
+                    tasks.get_data_hedge_delay()))
+
+        store_worker = engine.node.store_worker
+        if store_worker:
+            self.writeln("StoreWorker:\n\tstored={}\n\tbatches={}\n"\
+                "\tjobs={}".format(store_worker.stored, store_worker.batches,\
+                    store_worker.jobs))
+
+        block_scrubber = engine.node.block_scrubber
+        if block_scrubber:
+            self.writeln("Scrubber:\n\tpasses={}\n\tscrubbed={}\n"\
+                "\tcorrupt={}\n\trepaired={}\n\tdropped={}"\
+                    .format(block_scrubber.passes, block_scrubber.scrubbed,\
+                        block_scrubber.corrupt, block_scrubber.repaired,\
+                        block_scrubber.dropped))
+
+        self.writeln("Caches:\n\tblock=[{} blocks, {} bytes, {} hits,"\
+            " {} misses]\n\ttransit=[{} blocks, {} bytes, {} hits, {} misses]"\
+                .format(len(tasks.block_cache), tasks.block_cache.size,\
+                    tasks.block_cache.hits, tasks.block_cache.misses,\
+                    len(tasks.transit_cache), tasks.transit_cache.size,\
+                    tasks.transit_cache.hits, tasks.transit_cache.misses))
+
+        self.writeln("Negative caches:\n\tmissing_data=[{} keys, {} hits]\n"\
+            "\tfailed_tunnels=[{} peers, {} hits]"\
+                .format(len(tasks.missing_data), tasks.missing_data.hits,\
+                    len(tasks.failed_tunnels), tasks.failed_tunnels.hits))
+
     @asyncio.coroutine
     def do_time(self, arg):
         "Time the passed command line (wrapping call)."
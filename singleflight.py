@@ -0,0 +1,57 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+import llog
+
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+class SingleFlight(object):
+    "Coalesces concurrent calls for the same key into one; callers arriving"\
+    " while a call is in flight wait for and get the result of that call."\
+    " Keys are only kept while their call is in flight."
+
+    def __init__(self, loop, name=None):
+        self.loop = loop
+        self.name = name
+
+        self.calls = {} # {key: asyncio.Future}
+
+        self.started = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.calls)
+
+    @asyncio.coroutine
+    def do(self, key, coro_func, *args, **kwargs):
+        "Returns the result of coro_func(*args, **kwargs), or of the call"\
+        " already in flight for key. A caller being cancelled doesn't cancel"\
+        " the call that others may be waiting for."
+
+        fut = self.calls.get(key)
+
+        if fut is None:
+            fut = asyncio.async(coro_func(*args, **kwargs), loop=self.loop)
+            self.calls[key] = fut
+            fut.add_done_callback(lambda f: self._call_done(key, f))
+            self.started += 1
+        else:
+            self.coalesced += 1
+
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Joining in flight {} call.".format(self.name))
+
+        r = yield from asyncio.shield(fut, loop=self.loop)
+        return r
+
+    def _call_done(self, key, fut):
+        if self.calls.get(key) is fut:
+            del self.calls[key]
+
+        if not fut.cancelled():
+            # Mark the exception retrieved, as every caller may have been
+            # cancelled; those left are raised it.
+            fut.exception()
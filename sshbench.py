@@ -0,0 +1,282 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+# Loopback benchmark of the SshProtocol receive path. Two protocol instances
+# are keyed against each other without any sockets or event loop; one side
+# encodes CHANNEL_DATA packets and the other frames them out of TCP sized
+# segments. The same byte stream is also run through a copy of the previous
+# slice based framer so the two can be compared. The legacy framer is timed
+# bare, while the current run also includes the SshProtocol dispatch overhead.
+# Finally each supported cipher suite is timed encoding and decoding a stream.
+
+import llog
+
+import argparse
+import asyncio
+import hmac
+import logging
+import os
+import struct
+import time
+from hashlib import sha1
+
+import mn1
+import sshcipher
+
+log = logging.getLogger(__name__)
+
+class CaptureTransport(object):
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def close(self):
+        pass
+
+class CopyCounter(object):
+    def __init__(self):
+        self.value = 0
+
+def _create_pair(cipher_name="aes256-cbc", mac_name="hmac-sha1"):
+    # The loop is never run, write buffers are flushed explicitly.
+    loop = asyncio.new_event_loop()
+
+    client = mn1.SshClientProtocol(loop)
+    server = mn1.SshServerProtocol(loop)
+
+    k = int.from_bytes(os.urandom(256), "big")
+    h = sha1(os.urandom(64)).digest()
+
+    for protocol in (client, server):
+        protocol.transport = CaptureTransport()
+        protocol.binaryMode = True
+        protocol.status = mn1.Status.ready
+        protocol.k = k
+        protocol.h = h
+        protocol.session_id = h
+        protocol.cipher_cs = protocol.cipher_sc = cipher_name
+        protocol.mac_cs = protocol.mac_sc = mac_name
+        protocol.init_outbound_encryption()
+        protocol.init_inbound_encryption()
+
+    client._channel_map[0] = 0
+
+    return client, server
+
+def _generate_stream(client, packet_size, count, verbose=True):
+    data = os.urandom(packet_size)
+    transport = client.transport
+
+    for i in range(count):
+        client.write_channel_data(0, data)
+    client.flush()
+
+    if verbose:
+        print("Encoded {} packets with {} transport writes."\
+            .format(count, len(transport.chunks)))
+
+    stream = b"".join(transport.chunks)
+    transport.chunks.clear()
+
+    return stream
+
+def _segments(stream, segment_size):
+    for i in range(0, len(stream), segment_size):
+        yield stream[i:i + segment_size]
+
+def _run_current(server, stream, segment_size, counter):
+    decrypt_into = sshcipher._decrypt_into
+    def counting_decrypt_into(cipher, src, dst):
+        l = len(src)
+        if sshcipher.cipher_output_supported\
+                and l >= sshcipher.CIPHER_INTO_MIN_SIZE:
+            counter.value += l
+        else:
+            counter.value += l * 3
+        decrypt_into(cipher, src, dst)
+
+    sshcipher._decrypt_into = counting_decrypt_into
+
+    packets = 0
+    try:
+        for segment in _segments(stream, segment_size):
+            counter.value += len(segment) # Append to receive buffer.
+            server.data_received(segment)
+            while True:
+                packets += len(server.packets)
+                server.packets.clear()
+                if not server.reading_paused:
+                    break
+                server._resume_inbound()
+    finally:
+        sshcipher._decrypt_into = decrypt_into
+
+    return packets
+
+class LegacyFramer(object):
+    "The previous framing code, reslicing the receive buffer after every"\
+    " block, with every copy it makes counted."
+
+    def __init__(self, protocol, counter):
+        self.cipher = protocol.inCipher.cipher
+        self.mac = protocol.inCipher
+        self.hmac_size = protocol.inHmacSize
+        self.counter = counter
+        self.packet_id = 0
+        self.buf = bytearray()
+        self.cbuf = bytearray()
+        self.bp_length = None
+
+    def _copy(self, data):
+        self.counter.value += len(data)
+        return data
+
+    def data_received(self, data):
+        self.buf += self._copy(data)
+
+        packets = 0
+        while self._process_encrypted_buffer() and self._process_clear_buffer():
+            packets += 1
+
+        return packets
+
+    def _process_encrypted_buffer(self):
+        blksize = 16
+
+        if len(self.buf) < blksize:
+            return False
+
+        if not self.cbuf:
+            out = self.cipher.decrypt(bytes(self._copy(self.buf[:blksize])))
+            self.cbuf += self._copy(out)
+            self.bp_length = struct.unpack(">L", out[:4])[0] + 4
+            self.buf = self._copy(self.buf[blksize:])
+
+            if self.bp_length == blksize:
+                return True
+
+        if len(self.buf) < min(\
+                1024, self.bp_length - len(self.cbuf) + self.hmac_size):
+            return True
+
+        l = min(len(self.buf), self.bp_length - len(self.cbuf))
+        if not l:
+            return True
+
+        dsize = l - (l % blksize)
+        blks = self._copy(self.buf[:dsize])
+        self.buf = self._copy(self.buf[dsize:])
+        out = self.cipher.decrypt(bytes(self._copy(blks)))
+        self.cbuf += self._copy(out)
+
+        return True
+
+    def _process_clear_buffer(self):
+        if len(self.cbuf) < self.bp_length or len(self.buf) < self.hmac_size:
+            return False
+
+        padding_length = self.cbuf[4]
+        padding_offset = self.bp_length - padding_length
+
+        payload = self._copy(self.cbuf[5:padding_offset])
+        mac = self._copy(self.buf[:self.hmac_size])
+        self.buf = self._copy(self.buf[self.hmac_size:])
+
+        cmac = self.mac.calc_mac(self.packet_id, self.cbuf)
+        if not hmac.compare_digest(cmac, mac):
+            raise Exception("HMAC check failure.")
+
+        self.cbuf = self._copy(self.cbuf[self.bp_length + self.hmac_size:])
+        self.packet_id += 1
+
+        return True
+
+def _run_legacy(server, stream, segment_size, counter):
+    framer = LegacyFramer(server, counter)
+
+    packets = 0
+    for segment in _segments(stream, segment_size):
+        packets += framer.data_received(segment)
+
+    return packets
+
+def _report(name, elapsed, packets, stream_size, copied):
+    print("{:>8s}: {:8.3f}s, {:8.2f} MB/s, {:9.0f} packets/s,"\
+        " {:9.0f} bytes copied/packet."\
+            .format(name, elapsed, stream_size / elapsed / 1000000,\
+                packets / elapsed, copied / packets))
+
+def _run_suites(packet_size, count, segment_size):
+    for cipher_name in sshcipher.ENCRYPTION_ALGORITHMS:
+        if sshcipher.is_aead(cipher_name):
+            mac_names = [None]
+        else:
+            mac_names = sshcipher.MAC_ALGORITHMS
+
+        for mac_name in mac_names:
+            client, server = _create_pair(cipher_name, mac_name)
+
+            start = time.perf_counter()
+            stream = _generate_stream(client, packet_size, count, False)
+            encode_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            packets = _run_current(server, stream, segment_size, CopyCounter())
+            decode_elapsed = time.perf_counter() - start
+
+            assert packets == count, packets
+
+            name = cipher_name if mac_name is None\
+                else "{}+{}".format(cipher_name, mac_name)
+
+            print("{:>32s}: encode {:8.2f} MB/s, decode {:8.2f} MB/s."\
+                .format(name, len(stream) / encode_elapsed / 1000000,\
+                    len(stream) / decode_elapsed / 1000000))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--packet-size", type=int, default=32768,\
+        help="Size of the channel data in each packet.")
+    parser.add_argument("--count", type=int, default=1000,\
+        help="Number of packets to send.")
+    parser.add_argument("--segment-size", type=int, default=1460,\
+        help="Size of the TCP segments the stream is fed in.")
+    args = parser.parse_args()
+
+    packet_size = min(args.packet_size, mn1.MAX_PACKET_LENGTH - 64)
+
+    print("cipher_output_supported=[{}], gcm_supported=[{}]."\
+        .format(sshcipher.cipher_output_supported, sshcipher.gcm_supported))
+    print("Sending {} packets of {} bytes in {} byte segments."\
+        .format(args.count, packet_size, args.segment_size))
+
+    for name, run in (("legacy", _run_legacy), ("current", _run_current)):
+        client, server = _create_pair()
+        stream = _generate_stream(client, packet_size, args.count)
+        counter = CopyCounter()
+
+        start = time.perf_counter()
+        packets = run(server, stream, args.segment_size, counter)
+        elapsed = time.perf_counter() - start
+
+        assert packets == args.count, packets
+
+        _report(name, elapsed, packets, len(stream), counter.value)
+
+    print("Cipher suites:")
+
+    _run_suites(packet_size, args.count, args.segment_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: LGPL
+
+import llog
+
+import hmac
+import logging
+import struct
+from hashlib import sha1, sha256
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+from sshexception import SshException
+
+log = logging.getLogger(__name__)
+
+def _check_cipher_output_support():
+    "Returns True if the installed Crypto package can en/decrypt straight into"\
+    " a caller supplied buffer (PyCryptodome's output parameter)."
+
+    try:
+        AES.new(b"\x00" * 16, AES.MODE_ECB)\
+            .decrypt(b"\x00" * 16, output=bytearray(16))
+        return True
+    except TypeError:
+        return False
+
+cipher_output_supported = _check_cipher_output_support()
+# PyCrypto has no GCM mode.
+gcm_supported = hasattr(AES, "MODE_GCM")
+
+# Below this size the per call overhead of en/decrypting into a supplied buffer
+# outweighs the copies it saves.
+CIPHER_INTO_MIN_SIZE = 1024
+
+def _decrypt_into(cipher, src, dst):
+    "Decrypt the src memoryview into the equally sized dst memoryview."
+
+    if cipher_output_supported and len(src) >= CIPHER_INTO_MIN_SIZE:
+        cipher.decrypt(src, output=dst)
+    else:
+        # PyCrypto only accepts bytes, and always returns a new object.
+        dst[:] = cipher.decrypt(bytes(src))
+
+def _encrypt_in_place(cipher, buf):
+    "Encrypt the buf memoryview in place."
+
+    if cipher_output_supported and len(buf) >= CIPHER_INTO_MIN_SIZE:
+        cipher.encrypt(buf, output=buf)
+    else:
+        buf[:] = cipher.encrypt(bytes(buf))
+
+# In order of preference. GCM is supported but not preferred as the Crypto
+# package has to set up a new GCM cipher object for every packet, which makes
+# it several times slower than CTR with a separate MAC (see sshbench.py).
+ENCRYPTION_ALGORITHMS = ["aes256-ctr", "aes256-cbc"]
+if gcm_supported:
+    ENCRYPTION_ALGORITHMS.insert(1, "aes256-gcm@openssh.com")
+MAC_ALGORITHMS = ["hmac-sha2-256", "hmac-sha1"]
+
+# name: (key_size, iv_size).
+_cipher_params = {\
+    "aes256-gcm@openssh.com": (32, 12),\
+    "aes256-ctr": (32, 16),\
+    "aes256-cbc": (32, 16)}
+
+# name: (digestmod, key_size, mac_size).
+_mac_params = {\
+    "hmac-sha2-256": (sha256, 32, 32),\
+    "hmac-sha1": (sha1, 20, 20)}
+
+def is_aead(cipher_name):
+    return cipher_name.endswith("-gcm@openssh.com")
+
+def get_key_sizes(cipher_name, mac_name):
+    "Returns: key_size, iv_size, mac_key_size."
+
+    key_size, iv_size = _cipher_params[cipher_name]
+
+    if is_aead(cipher_name):
+        mac_key_size = 0
+    else:
+        mac_key_size = _mac_params[mac_name][1]
+
+    return key_size, iv_size, mac_key_size
+
+def choose_algorithm(client_algorithms, server_algorithms):
+    "Returns the first algorithm in the client's list that the server also"\
+    " supports (RFC 4253 7.1), or None. Both are comma separated name-lists."
+
+    server_algorithms = server_algorithms.split(',')
+
+    for name in client_algorithms.split(','):
+        if name in server_algorithms:
+            return name
+
+    return None
+
+def create_cipher(cipher_name, mac_name, key, iv, mac_key):
+    if is_aead(cipher_name):
+        return SshGcmCipher(key, iv)
+    else:
+        return SshCipher(cipher_name, mac_name, key, iv, mac_key)
+
+class SshCipher(object):
+    "A block cipher with a separate MAC (encrypt-and-MAC) for one direction of"\
+    " a connection."
+
+    aead = False
+    block_size = 16 # bs of AES.
+
+    def __init__(self, cipher_name, mac_name, key, iv, mac_key):
+        self.name = cipher_name
+        self.mac_name = mac_name
+
+        if cipher_name == "aes256-ctr":
+            ctr = Counter.new(128, initial_value=int.from_bytes(iv, "big"))
+            self.cipher = AES.new(key, AES.MODE_CTR, counter=ctr)
+        elif cipher_name == "aes256-cbc":
+            self.cipher = AES.new(key, AES.MODE_CBC, iv)
+        else:
+            raise SshException("Unsupported cipher [{}].".format(cipher_name))
+
+        digestmod, key_size, self.mac_size = _mac_params[mac_name]
+
+        # Keyed once, then copied for each packet.
+        self._hmac = hmac.new(mac_key, digestmod=digestmod)
+
+    def decrypt_into(self, src, dst):
+        _decrypt_into(self.cipher, src, dst)
+
+    def encrypt_in_place(self, buf):
+        _encrypt_in_place(self.cipher, buf)
+
+    def calc_mac(self, packet_id, buf):
+        tmac = self._hmac.copy()
+        tmac.update(struct.pack(">L", packet_id))
+        tmac.update(buf)
+        return tmac.digest()
+
+class SshGcmCipher(object):
+    "aes256-gcm@openssh.com (RFC 5647, with OpenSSH's negotiation) for one"\
+    " direction of a connection. The packet_length is sent in the clear as"\
+    " associated data, and the tag takes the place of the MAC."
+
+    aead = True
+    block_size = 16
+    mac_size = 16 # Tag size.
+
+    def __init__(self, key, iv):
+        self.name = "aes256-gcm@openssh.com"
+        self.mac_name = None
+
+        self.key = key
+        self.fixed = iv[:4]
+        self.invocation_counter = int.from_bytes(iv[4:], "big")
+
+    def _next_cipher(self):
+        nonce = self.fixed + self.invocation_counter.to_bytes(8, "big")
+        self.invocation_counter =\
+            (self.invocation_counter + 1) & 0xFFFFFFFFFFFFFFFF
+
+        return AES.new(self.key, AES.MODE_GCM, nonce=nonce,\
+            mac_len=self.mac_size)
+
+    def open_into(self, aad, src, tag, dst):
+        "Decrypt and authenticate the src memoryview into the dst memoryview."
+
+        cipher = self._next_cipher()
+        cipher.update(bytes(aad))
+        _decrypt_into(cipher, src, dst)
+
+        try:
+            cipher.verify(bytes(tag))
+        except ValueError:
+            raise SshException("GCM tag check failure.")
+
+    def seal_in_place(self, aad, buf):
+        "Encrypt the buf memoryview in place, returns the tag."
+
+        cipher = self._next_cipher()
+        cipher.update(bytes(aad))
+        _encrypt_in_place(cipher, buf)
+
+        return cipher.digest()
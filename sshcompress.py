@@ -0,0 +1,104 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: LGPL
+
+import llog
+
+import logging
+import zlib
+
+from sshexception import SshException
+
+log = logging.getLogger(__name__)
+
+# Like zlib@openssh.com it is delayed until the peer is authenticated and
+# uses one zlib stream per direction, flushed at the end of every packet. Each
+# payload is prefixed with a byte telling whether it was deflated or stored, so
+# that incompressible payloads (encrypted data blocks) are sent as they are
+# instead of wasting CPU on both ends.
+ZLIB = "zlib@mnet"
+NONE = "none"
+
+STORED = 0
+DEFLATED = 1
+
+# Payloads at least this big are probed by deflating a sample of them first.
+PROBE_MIN_SIZE = 1024
+PROBE_SAMPLE_SIZE = 512
+# The payload is stored if the sample doesn't shrink below this fraction.
+PROBE_MAX_RATIO = 0.97
+
+def create_compressor(name):
+    if name == ZLIB:
+        return SshZlibCompressor()
+    return None
+
+def create_decompressor(name, max_size):
+    if name == ZLIB:
+        return SshZlibDecompressor(max_size)
+    return None
+
+def _incompressible(data):
+    l = len(data)
+    start = (l - PROBE_SAMPLE_SIZE) // 2
+    sample = data[start:start + PROBE_SAMPLE_SIZE]
+
+    return len(zlib.compress(sample, 1)) >= PROBE_SAMPLE_SIZE * PROBE_MAX_RATIO
+
+class SshZlibCompressor(object):
+    def __init__(self):
+        self.compressobj = zlib.compressobj()
+
+        self.stored = 0
+        self.deflated = 0
+        self.deflated_size = 0
+
+    def compress(self, datas):
+        "Returns the list of buffers to send as the payload instead."
+
+        # Transport layer messages (1 to 49) are always stored so that the
+        # NEWKEYS of a rekey can be spotted before the payload is decompressed.
+        # The last buffer holds the channel data, if any.
+        data = datas[-1]
+        if datas[0][0] < 50\
+                or (len(data) >= PROBE_MIN_SIZE and _incompressible(data)):
+            self.stored += 1
+            return [b"\x00"] + list(datas)
+
+        c = self.compressobj
+
+        out = bytearray(b"\x01")
+        for data in datas:
+            out += c.compress(data)
+            self.deflated += len(data)
+        out += c.flush(zlib.Z_SYNC_FLUSH)
+
+        self.deflated_size += len(out) - 1
+
+        return (out,)
+
+class SshZlibDecompressor(object):
+    def __init__(self, max_size):
+        self.decompressobj = zlib.decompressobj()
+        self.max_size = max_size
+
+    def decompress(self, payload):
+        flag = payload[0]
+
+        if flag == STORED:
+            return payload[1:]
+        if flag != DEFLATED:
+            raise SshException("Illegal compression flag [{}] received."\
+                .format(flag))
+
+        d = self.decompressobj
+
+        try:
+            out = d.decompress(payload[1:], self.max_size)
+        except zlib.error as e:
+            raise SshException("Decompression failure: {}.".format(e))
+
+        if d.unconsumed_tail:
+            raise SshException("Decompressed payload exceeds [{}] bytes."\
+                .format(self.max_size))
+
+        return out
@@ -9,6 +9,14 @@ import putil
 
 log = logging.getLogger(__name__)
 
+# The parseX(buf) functions are kept for callers that parse a standalone
+# value; messages should use the parse_x_from(buf, i) functions, which read at
+# an offset instead of requiring the rest of the buffer to be sliced (copied)
+# for every field.
+
+def parse_name_list_from(buf, i):
+    return parse_string_from(buf, i)
+
 def parseNameList(buf):
     return parseString(buf)
 
@@ -17,8 +25,7 @@ def parse_string_from(buf, i):
     return l, v.decode()
 
 def parseString(buf):
-    l, v = parseBinary(buf)
-    return l, v.decode()
+    return parse_string_from(buf, 0)
 
 def parse_binary_from(buf, i):
     length = struct.unpack_from(">L", buf, i)[0]
@@ -27,16 +34,14 @@ def parse_binary_from(buf, i):
     end = start + length
 
     value = buf[start:end]
+    if type(value) is memoryview:
+        # Values outlive the packet buffer the view is into.
+        value = value.tobytes()
 
     return end, value
 
 def parseBinary(buf):
-    length = struct.unpack(">L", buf[0:4])[0]
-    if log.isEnabledFor(logging.DEBUG):
-        log.debug("length={}".format(length))
-    value = buf[4:4 + length]
-
-    return length + 4, value
+    return parse_binary_from(buf, 0)
 
 def parse_mpint_from(buf, i):
     length = struct.unpack_from(">L", buf, i)[0]
@@ -52,10 +57,7 @@ def parse_mpint_from(buf, i):
     return end, value
 
 def parseMpint(buf):
-    length = struct.unpack(">L", buf[0:4])[0]
-    if log.isEnabledFor(logging.DEBUG):
-        log.debug("length={}".format(length))
-    return length + 4, putil.inflate_long(buf[4:4+length])
+    return parse_mpint_from(buf, 0)
 
 def encodeMpint(val):
     buf = putil.deflate_long(val)
@@ -0,0 +1,424 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+# The pipeline that stores the data blocks for _store_data. A pool of threads
+# verifies and encrypts each StoreJob, and hands it to the one commit thread.
+# That thread takes the jobs arriving within BATCH_DELAY of each other and adds
+# their DataBlock rows in one transaction. It then writes the block data, and
+# the job's future is resolved back on the event loop. A job so only makes one
+# trip from the event loop, and the DataBlock table is locked once per batch.
+
+import llog
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent import futures
+
+from sqlalchemy import func
+
+import blockjournal
+import blockstore
+from db import DataBlock, NodeState
+import enc
+import mbase32
+import mutil
+import node as mnnode
+
+log = logging.getLogger(__name__)
+
+# Threads verifying and encrypting the blocks.
+DEFAULT_WORKERS = 4
+# Seconds the commit thread waits for more jobs to join a batch.
+BATCH_DELAY = 0.005
+BATCH_MAX = 64
+
+class StoreJob(object):
+    def __init__(self, data_id, dmsg, distance, need_pruning, verify):
+        self.data_id = data_id
+        self.dmsg = dmsg
+        self.distance = distance
+        self.need_pruning = need_pruning
+        # Blocking; returns the data_key and TargetedBlock or None, raising if
+        # the data is invalid.
+        self.verify = verify
+
+        self.future = None
+
+        self.data_key = None
+        self.tb = None
+        self.epubkey = None
+        self.enc_data = None
+        self.enc_data_remainder = None
+        self.checksum = None
+
+        # None if we already have it, False if there was no room for it, True
+        # if stored.
+        self.stored = None
+        self.data_block_id = None
+        self.size_diff = 0
+        self.entry_ids = [] # [DataBlockJournal.id] to complete.
+        self.pruned = False # By a later job of the same batch.
+
+        self._create_entry = None
+        self._prune_entries = []
+
+class StoreWorker(object):
+    def __init__(self, node, workers=DEFAULT_WORKERS):
+        self.node = node
+        self.loop = node.loop
+
+        self.executor = futures.ThreadPoolExecutor(workers)
+        self.queue = queue.Queue()
+        self.thread = None
+
+        self.stored = 0
+        self.batches = 0
+        self.jobs = 0
+
+    def start(self):
+        self.thread = threading.Thread(\
+            target=self._run, name="StoreWorker", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        "Finishes the jobs submitted so far and stops the threads."
+
+        self.executor.shutdown()
+
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    @asyncio.coroutine
+    def store(self, job):
+        "Stores the block of the StoreJob, returning the job once it is done."
+
+        job.future = asyncio.Future(loop=self.loop)
+
+        self.executor.submit(self._prepare, job)
+
+        return (yield from job.future)
+
+    def _prepare(self, job):
+        try:
+            job.data_key, job.tb = job.verify()
+
+            dmsg = job.dmsg
+
+            if dmsg.pubkey:
+                a, b = enc.encrypt_data_block(dmsg.pubkey, job.data_key)
+                job.epubkey = a + b
+
+            if log.isEnabledFor(logging.INFO):
+                log.info("Encrypting [{}] bytes of data."\
+                    .format(len(dmsg.data)))
+
+            # PyCrypto works in blocks, so extra than round block size goes
+            # into enc_data_remainder.
+            job.enc_data, job.enc_data_remainder =\
+                enc.encrypt_data_block(dmsg.data, job.data_key)
+
+            # So the block can be checked for corruption when read back.
+            job.checksum =\
+                blockstore.checksum(job.enc_data, job.enc_data_remainder)
+        except Exception as e:
+            self.loop.call_soon_threadsafe(self._fail, job, e)
+            return
+
+        self.queue.put(job)
+
+    def _run(self):
+        stopping = False
+
+        while not stopping:
+            job = self.queue.get()
+            if job is None:
+                break
+
+            batch = [job]
+            deadline = time.monotonic() + BATCH_DELAY
+
+            while len(batch) < BATCH_MAX:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+
+                try:
+                    job = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                if job is None:
+                    stopping = True
+                    break
+
+                batch.append(job)
+
+            try:
+                self._process_batch(batch)
+            except Exception as e:
+                log.exception("StoreWorker._process_batch(..)")
+
+                for job in batch:
+                    self.loop.call_soon_threadsafe(self._fail, job, e)
+                continue
+
+            for job in batch:
+                self.loop.call_soon_threadsafe(self._finish, job)
+
+    def _process_batch(self, batch):
+        self.batches += 1
+        self.jobs += len(batch)
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Committing a batch of [{}] blocks.".format(len(batch)))
+
+        pruned = []
+
+        with self.node.db.open_session() as sess:
+            self.node.db.lock_table(sess, DataBlock)
+
+            batch_blocks = {} # {DataBlock.id: StoreJob}
+            size_diff = 0
+
+            for job in batch:
+                pruned.extend(self._add_block(sess, job, batch_blocks))
+                size_diff += job.size_diff
+
+            _update_nodestate(sess, size_diff)
+
+            # Get the ids of the journal entries.
+            sess.flush()
+
+            for job in batch:
+                if job._create_entry:
+                    job.entry_ids.append(job._create_entry.id)
+                job.entry_ids.extend(entry.id for entry in job._prune_entries)
+
+            sess.commit()
+
+        store = self.node.block_store
+
+        for anid in pruned:
+            if not store.remove(anid):
+                if log.isEnabledFor(logging.WARNING):
+                    log.warning("Missing block pruning block id=[{}];"\
+                        " considered pruned anyways.".format(anid))
+
+        failed = []
+
+        for job in batch:
+            if not job.stored or job.pruned:
+                continue
+
+            try:
+                if log.isEnabledFor(logging.INFO):
+                    tlen = len(job.enc_data)
+                    if job.enc_data_remainder:
+                        tlen += len(job.enc_data_remainder)
+                    log.info("Storing [{}] bytes of data.".format(tlen))
+
+                store.write(\
+                    job.data_block_id, job.enc_data, job.enc_data_remainder)
+            except Exception:
+                log.exception("block_store.write(..)")
+
+                log.warning("There was an exception attempting to store the"\
+                    " data on disk.")
+
+                failed.append(job)
+
+        if failed:
+            self._undo(failed)
+
+    def _add_block(self, sess, job, batch_blocks):
+        "Adds or updates the DataBlock row of the job, returning the ids of"\
+        " the blocks pruned for it."
+
+        data_id = job.data_id
+        dmsg = job.dmsg
+        original_size = len(dmsg.data)
+
+        old_entry = None
+        if dmsg.pubkey:
+            old_entry = sess.query(DataBlock)\
+                .filter(DataBlock.data_id == data_id)\
+                .first()
+            if old_entry:
+                vint = int(old_entry.version)
+                if vint >= dmsg.version:
+                    # We only want to store newer versions.
+                    return []
+        else:
+            q = sess.query(func.count("*")).select_from(DataBlock)
+            q = q.filter(DataBlock.data_id == data_id)
+
+            if q.scalar() > 0:
+                # We already have this block.
+                return []
+
+        blocks_to_prune = []
+
+        if job.need_pruning:
+            freeable_space = 0
+
+            q = sess.query(DataBlock.id, DataBlock.original_size)\
+                .filter(DataBlock.distance > job.distance)\
+                .filter(DataBlock.original_size != 0)\
+                .order_by(DataBlock.distance.desc())
+
+            for block in mutil.page_query(q):
+                freeable_space += block.original_size
+                blocks_to_prune.append(block.id)
+
+                if freeable_space >= original_size:
+                    break
+
+            if freeable_space < original_size:
+                job.stored = False
+                return []
+
+            if log.isEnabledFor(logging.INFO):
+                log.info("Pruning {} blocks to make room."\
+                    .format(len(blocks_to_prune)))
+
+            for anid in blocks_to_prune:
+                sess.query(DataBlock)\
+                    .filter(DataBlock.id == anid)\
+                    .delete(synchronize_session=False)
+
+                pjob = batch_blocks.pop(anid, None)
+                if pjob:
+                    # Its data is yet to be written, so we just won't.
+                    pjob.pruned = True
+
+        updateable_size_diff = None
+        if old_entry:
+            data_block = old_entry
+            assert data_block.data_id == data_id
+            updateable_size_diff = original_size - data_block.original_size
+        else:
+            data_block = DataBlock()
+            data_block.data_id = data_id
+            data_block.distance = job.distance
+
+        if dmsg.pubkey:
+            data_block.version = str(dmsg.version)
+            data_block.signature = dmsg.signature
+            data_block.epubkey = job.epubkey
+            data_block.pubkeylen = len(dmsg.pubkey)
+
+        if job.tb:
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Storing TargetedBlock (target_key=[{}])."\
+                    .format(mbase32.encode(job.tb.target_key)))
+            # We don't need the following for anything coded yet, but doing it
+            # for now because then we can tell which are targeted blocks as we
+            # may want to have code purge them with more pressure than normal
+            # blocks.
+            data_block.target_key = job.tb.target_key
+
+        data_block.original_size = original_size
+        data_block.checksum = job.checksum
+        data_block.insert_timestamp = mutil.utc_datetime()
+
+        if not old_entry:
+            sess.add(data_block)
+            # Get the id for the journal entry.
+            sess.flush()
+
+        job.data_block_id = data_block.id
+        batch_blocks[data_block.id] = job
+
+        job._create_entry = blockjournal.add_entry(\
+            sess, data_block.id, blockjournal.ACTION_CREATE)
+
+        for anid in blocks_to_prune:
+            job._prune_entries.append(blockjournal.add_entry(\
+                sess, anid, blockjournal.ACTION_DELETE))
+
+        if updateable_size_diff is not None:
+            job.size_diff = updateable_size_diff
+        else:
+            job.size_diff = original_size
+
+        if job.need_pruning:
+            job.size_diff -= freeable_space
+
+        job.stored = True
+
+        return blocks_to_prune
+
+    def _undo(self, failed):
+        "Deletes the DataBlock rows of the jobs whose data failed to write."
+
+        with self.node.db.open_session() as sess:
+            self.node.db.lock_table(sess, DataBlock)
+
+            size = 0
+            for job in failed:
+                sess.query(DataBlock)\
+                    .filter(DataBlock.id == job.data_block_id)\
+                    .delete(synchronize_session=False)
+
+                size += len(job.dmsg.data)
+
+            _update_nodestate(sess, -size)
+
+            sess.commit()
+
+        for job in failed:
+            job.stored = False
+            job.size_diff -= len(job.dmsg.data)
+
+            create_entry_id = job.entry_ids.pop(0)
+
+            try:
+                self.node.block_store.remove(job.data_block_id)
+            except Exception:
+                log.exception("block_store.remove(..)")
+            else:
+                job.entry_ids.append(create_entry_id)
+
+    def _fail(self, job, e):
+        if not job.future.cancelled():
+            job.future.set_exception(e)
+
+    def _finish(self, job):
+        if job.entry_ids:
+            self.node.block_journal.complete(job.entry_ids)
+
+        self.node.datastore_size += job.size_diff
+
+        if job.stored:
+            self.stored += 1
+
+            engine = self.node.chord_engine
+
+            # Its transit copy, if any, may be of an older version.
+            engine.tasks.transit_cache.remove(job.data_id)
+
+            if job.distance > engine.furthest_data_block:
+                engine.furthest_data_block = job.distance
+
+        if not job.future.cancelled():
+            job.future.set_result(job)
+
+def _update_nodestate(sess, size_diff):
+    # Rule: only update this NodeState row when holding a lock on the
+    # DataBlock table.
+    node_state = sess.query(NodeState)\
+        .filter(NodeState.key == mnnode.NSK_DATASTORE_SIZE)\
+        .first()
+
+    if not node_state:
+        node_state = NodeState()
+        node_state.key = mnnode.NSK_DATASTORE_SIZE
+        node_state.value = 0
+        sess.add(node_state)
+
+    node_state.value = str(int(node_state.value) + size_diff)
@@ -0,0 +1,48 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+# XOR distance between node ids (and data ids). The ids are compared as big
+# endian ints, so a distance is one XOR of two ints and its log base2 is their
+# bit_length(), instead of a Python loop over every byte. Ids can be passed as
+# bytes or, where they are used over and over, converted once with to_int().
+
+import llog
+
+import logging
+
+log = logging.getLogger(__name__)
+
+def to_int(id_):
+    if type(id_) is int:
+        return id_
+    return int.from_bytes(id_, "big")
+
+def distance(id1, id2):
+    "Returns the XOR distance as an int, which is also how BitTrie keys are"\
+    " stored."
+
+    return to_int(id1) ^ to_int(id2)
+
+def raw_distance(id1, id2):
+    "Returns the XOR distance as bytes as long as id1, as they are stored in"\
+    " the database and compared to the furthest_data_block."
+
+    return (to_int(id1) ^ to_int(id2)).to_bytes(len(id1), "big")
+
+def log_distance(nid, pid):
+    "Returns: distance, direction."\
+    " distance is in log base2; the index of the highest differing bit plus"\
+    " one, or 0 if equal. direction is 1 if pid is greater than nid, -1 if it"\
+    " is lesser, or 0 if equal."
+
+    return log_distance_int(to_int(nid), to_int(pid))
+
+def log_distance_int(nid, pid):
+    "log_distance(..) of ids already converted with to_int(..)."
+
+    diff = nid ^ pid
+
+    if not diff:
+        return 0, 0
+
+    return diff.bit_length(), 1 if pid > nid else -1